@@ -0,0 +1,46 @@
+import argparse
+import os
+import time
+from werkzeug.security import generate_password_hash
+from project.hashing import PasswordHasher, DEFAULTS
+
+# Logins per second through the password hashing pool.
+#
+#   python -m benchmarks.hashing --workers 4 --seconds 5 --method pbkdf2:sha256:260000
+#
+# Each simulated login is one password check, submitted by as many threads as there are
+# workers plus queue slots so the pool stays saturated.
+def run(method, workers, seconds):
+    from concurrent.futures import ThreadPoolExecutor
+    hasher = PasswordHasher()
+    hasher.configure(method=method, workers=workers, queue_size=workers)
+    password_hash = generate_password_hash('Benchmark1!', method)
+    hasher.verify(password_hash, 'Benchmark1!')  # start the pool before timing
+
+    deadline = time.time() + seconds
+    def client():
+        done = 0
+        while time.time() < deadline:
+            hasher.verify(password_hash, 'Benchmark1!')
+            done += 1
+        return done
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=max(workers, 1) * 2) as threads:
+        logins = sum(threads.map(lambda _: client(), range(max(workers, 1) * 2)))
+    elapsed = time.time() - started
+    hasher.configure(workers=0)
+    return logins / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark password checks per second')
+    parser.add_argument('--method', default=DEFAULTS['PASSWORD_HASH_METHOD'])
+    parser.add_argument('--workers', type=int, default=DEFAULTS['PASSWORD_HASH_WORKERS'])
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    rate = run(args.method, args.workers, args.seconds)
+    cores = max(args.workers, 1)
+    print("method %s, %d worker(s) on %d cpu(s)" % (args.method, args.workers, os.cpu_count() or 1))
+    print("%.1f logins/sec, %.1f logins/sec per core" % (rate, rate / cores))
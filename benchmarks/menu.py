@@ -0,0 +1,75 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from project import create_app, db, dataset, migrations
+from project.main import menu_cache
+from project.models import Restaurant, MenuItem
+
+# Menu page render time against menu size, to check it stays linear in the number of items.
+#
+#   python -m benchmarks.menu --sizes 1000 2000 4000 8000 --repeat 20
+#
+# Each size gets a single restaurant holding that many items over a mix of the usual and made up
+# courses. Pages are rendered uncached (the anonymous menu cache is cleared before every request)
+# and the per item cost should stay roughly flat as the menu grows.
+BASE_URL = 'https://localhost'
+EXTRA_COURSES = ['Side', 'Salad', 'Soup', 'Kids Menu']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark menu page rendering against menu size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 4000, 8000])
+    parser.add_argument('--repeat', type=int, default=20, help='timed renders per size')
+    parser.add_argument('--seed', type=int, default=3310)
+    return parser.parse_args()
+
+
+def time_menu(size, repeat, seed):
+    workdir = tempfile.mkdtemp(prefix='restaurant-menu-bench-')
+    try:
+        app = create_app({
+            'DATABASE_URL': 'sqlite:///%s' % os.path.join(workdir, 'bench.db'),
+            'PASSWORD_HASH_WORKERS': 0,
+            'AUDIT_LOG_FILE': os.path.join(workdir, 'audit.log'),
+            'METRICS_ENABLED': False,
+            'QUERY_BUDGET_DEFAULT': 1000,
+        })
+        with app.app_context():
+            db.create_all()
+            migrations.upgrade()
+            dataset.generate(restaurants=1, menu_items=size, users=1, ratings=0, seed=seed)
+            restaurant_id = Restaurant.query.one().id
+            # spread some items over courses outside the usual four
+            ids = [row[0] for row in db.session.query(MenuItem.id).order_by(MenuItem.id)]
+            for index, course in enumerate(EXTRA_COURSES):
+                MenuItem.query.filter(MenuItem.id.in_(ids[index::len(EXTRA_COURSES) * 2])) \
+                    .update({MenuItem.course: course}, synchronize_session=False)
+            db.session.commit()
+            db.session.remove()
+
+        client = app.test_client()
+        url = '/restaurant/%d/menu' % restaurant_id
+        timings = []
+        for i in range(repeat + 2):
+            menu_cache.clear()
+            started = time.perf_counter()
+            response = client.get(url, base_url=BASE_URL)
+            response.get_data()
+            if i >= 2:  # first renders warm up templates and connections
+                timings.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                raise SystemExit('%s returned %d' % (url, response.status_code))
+        timings.sort()
+        return timings[len(timings) // 2]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print("%8s %12s %14s" % ('items', 'median ms', 'us per item'))
+    for size in args.sizes:
+        median = time_menu(size, args.repeat, args.seed)
+        print("%8d %12.2f %14.2f" % (size, median * 1000, median * 1e6 / size))
@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from project import create_app, db, dataset, migrations
+from project.models import User, Restaurant, MenuItem
+from project.profiling import count_queries
+
+# Route benchmarks against a seeded synthetic dataset, driven through the Flask test client.
+#
+#   python -m benchmarks.routes --save                 - run and write benchmarks/baseline.json
+#   python -m benchmarks.routes --check                - run and fail if a route regressed against it
+#   python -m benchmarks.routes --routes menu search   - only the routes whose name contains a word
+#
+# Each route reports requests/sec, p50/p95/p99 latency and SQL queries per request. --check fails when
+# a route's p95 or throughput is more than --threshold worse than the baseline, or when it runs more
+# queries than it used to. Timings only compare on the same machine, so save the baseline where the
+# checks run. The dataset is generated from --seed, so the same arguments always give the same data.
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+BASE_URL = 'https://localhost'
+PASSWORD = 'Benchmark1!'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the website routes against a seeded dataset')
+    parser.add_argument('--restaurants', type=int, default=2000)
+    parser.add_argument('--menu-items', dest='menu_items', type=int, default=50000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--ratings', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=3310)
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--routes', nargs='*', help='only run routes whose name contains one of these')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--check', action='store_true', help='compare against the baseline, exit 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown before --check fails (0.25 = 25%%)')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    return parser.parse_args()
+
+
+def routes(restaurant_ids, menu_items, terms):
+    """(name, endpoint, client, method, url function, requests scale) for every benchmarked route"""
+    restaurant = lambda i: restaurant_ids[i % len(restaurant_ids)]
+    item = lambda i: menu_items[i % len(menu_items)]
+    term = lambda i: terms[i % len(terms)]
+    return [
+        ('restaurants', 'main.showRestaurants', 'anonymous', 'GET', lambda i: '/restaurant/', 1),
+        ('restaurants_logged_in', 'main.showRestaurants', 'user', 'GET', lambda i: '/restaurant/', 1),
+        ('menu', 'main.showMenu', 'anonymous', 'GET', lambda i: '/restaurant/%d/menu' % restaurant(i), 1),
+        ('menu_logged_in', 'main.showMenu', 'user', 'GET', lambda i: '/restaurant/%d/menu' % restaurant(i), 1),
+        ('ratings', 'main.showRatings', 'user', 'GET', lambda i: '/restaurant/%d/ratings' % restaurant(i), 1),
+        ('search', 'main.search', 'anonymous', 'POST', lambda i: ('/search', {'searched': term(i)}), 1),
+        ('search_results', 'main.search_results', 'anonymous', 'GET', lambda i: '/search_results/%s' % term(i), 1),
+        ('admin', 'main.admin', 'admin', 'GET', lambda i: '/admin', 1),
+        ('top_restaurants', 'main.topRestaurants', 'anonymous', 'GET', lambda i: '/restaurant/top', 1),
+        ('json_top_restaurants', 'json.topRestaurantsJSON', 'anonymous', 'GET', lambda i: '/restaurant/top/JSON', 1),
+        ('json_restaurants', 'json.restaurantsJSON', 'anonymous', 'GET', lambda i: '/restaurant/JSON', 1),
+        ('json_menu', 'json.restaurantMenuJSON', 'anonymous', 'GET', lambda i: '/restaurant/%d/menu/JSON' % restaurant(i), 1),
+        ('json_ratings', 'json.restaurantRatingsJSON', 'user', 'GET', lambda i: '/restaurant/%d/ratings/JSON' % restaurant(i), 1),
+        ('json_menu_item', 'json.menuItemJSON', 'anonymous', 'GET',
+         lambda i: '/restaurant/%d/menu/%d/JSON' % item(i), 1),
+        # the streaming exports read every row, so they get a fraction of the requests
+        ('json_restaurants_stream', 'json.restaurantsStreamJSON', 'anonymous', 'GET', lambda i: '/restaurant/JSON/stream', 0.05),
+        ('json_menu_items_stream', 'json.menuItemsStreamJSON', 'anonymous', 'GET', lambda i: '/menu_item/JSON/stream', 0.02),
+        ('json_menus', 'json.restaurantMenusJSON', 'anonymous', 'GET', lambda i: '/restaurant/menus/JSON', 0.02),
+    ]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def seed(args):
+    db.create_all()
+    migrations.upgrade()
+    dataset.generate(restaurants=args.restaurants, menu_items=args.menu_items, users=args.users,
+                     ratings=args.ratings, seed=args.seed)
+    for username, role in (('bench_admin', 'admin'), ('bench_user', 'Public User')):
+        user = User(username=username, role=role)
+        user.set_password(PASSWORD)
+        db.session.add(user)
+    db.session.commit()
+
+
+def login(app, username):
+    client = app.test_client()
+    response = client.post('/login', data={'username': username, 'password': PASSWORD}, base_url=BASE_URL)
+    if response.status_code != 302:
+        raise SystemExit("couldn't log in as %s" % username)
+    return client
+
+
+def time_route(client, method, url, count):
+    latencies, queries, statuses = [], [], {}
+    started = time.perf_counter()
+    for i in range(count):
+        target = url(i)
+        request_started = time.perf_counter()
+        with count_queries() as counter:
+            if method == 'POST':
+                response = client.post(target[0], data=target[1], base_url=BASE_URL)
+            else:
+                response = client.get(target, base_url=BASE_URL)
+            response.get_data()  # drain streamed bodies inside the timing
+        latencies.append(time.perf_counter() - request_started)
+        queries.append(counter.count)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': count,
+        'requests_per_sec': round(count / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'queries_mean': round(sum(queries) / float(count), 2),
+        'queries_max': max(queries),
+        'statuses': dict((str(status), n) for status, n in sorted(statuses.items())),
+    }
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='restaurant-bench-')
+    try:
+        app = create_app({
+            'DATABASE_URL': 'sqlite:///%s' % os.path.join(workdir, 'bench.db'),
+            'WTF_CSRF_ENABLED': False,
+            'PASSWORD_HASH_WORKERS': 0,
+            'AUDIT_LOG_FILE': os.path.join(workdir, 'audit.log'),
+            'METRICS_ENABLED': False,
+            'QUERY_BUDGET_DEFAULT': 1000,
+        })
+        with app.app_context():
+            started = time.time()
+            seed(args)
+            print("seeded in %.1fs" % (time.time() - started))
+
+            picker = random.Random(args.seed)
+            restaurant_ids = [row[0] for row in db.session.query(Restaurant.id).order_by(Restaurant.id)]
+            restaurant_ids = picker.sample(restaurant_ids, min(len(restaurant_ids), 500))
+            menu_items = [tuple(row) for row in db.session.query(MenuItem.restaurant_id, MenuItem.id)
+                          .order_by(MenuItem.id).limit(5000)]
+            menu_items = picker.sample(menu_items, min(len(menu_items), 500))
+            terms = sorted(set(word.lower() for (name,) in db.session.query(MenuItem.name).limit(2000)
+                               for word in name.split() if len(word) > 3))[:50] or ['burger']
+            db.session.remove()
+
+            clients = {'anonymous': app.test_client(), 'user': login(app, 'bench_user'),
+                       'admin': login(app, 'bench_admin')}
+            selected = [route for route in routes(restaurant_ids, menu_items, terms)
+                        if not args.routes or any(word in route[0] for word in args.routes)]
+
+            covered = set(route[1] for route in routes(restaurant_ids, menu_items, terms))
+            for rule in app.url_map.iter_rules():
+                if rule.endpoint.startswith('json.') and rule.endpoint not in covered:
+                    print("warning: %s (%s) has no benchmark" % (rule.endpoint, rule.rule))
+
+            results = {}
+            for name, endpoint, client, method, url, scale in selected:
+                count = max(10, int(args.requests * scale))
+                time_route(clients[client], method, url, min(count, 5))  # warm up caches and connections
+                results[name] = time_route(clients[client], method, url, count)
+                result = results[name]
+                print("%-24s %8.1f req/s  p50 %7.2fms  p95 %7.2fms  p99 %7.2fms  %5.1f queries"
+                      % (name, result['requests_per_sec'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                         result['queries_mean']))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'dataset': {'restaurants': args.restaurants, 'menu_items': args.menu_items, 'users': args.users,
+                    'ratings': args.ratings, 'seed': args.seed},
+        'python': sys.version.split()[0],
+        'routes': results,
+    }
+
+
+def regressions(results, baseline, threshold):
+    problems = []
+    if baseline.get('dataset') != results['dataset']:
+        problems.append("baseline was recorded with a different dataset %s" % baseline.get('dataset'))
+        return problems
+    for name, result in sorted(results['routes'].items()):
+        before = baseline['routes'].get(name)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + threshold):
+            problems.append("%s p95 went from %.2fms to %.2fms" % (name, before['p95_ms'], result['p95_ms']))
+        if result['requests_per_sec'] < before['requests_per_sec'] / (1 + threshold):
+            problems.append("%s throughput went from %.1f to %.1f req/s"
+                            % (name, before['requests_per_sec'], result['requests_per_sec']))
+        if result['queries_max'] > before['queries_max']:
+            problems.append("%s now runs up to %d queries (was %d)" % (name, result['queries_max'], before['queries_max']))
+    return problems
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.check:
+        # load it before the (slow) run so a missing baseline fails straight away
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            sys.exit("no baseline at %s, run python -m benchmarks.routes --save first" % args.baseline)
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.check:
+        problems = regressions(results, baseline, args.threshold)
+        for problem in problems:
+            print("REGRESSION: " + problem)
+        if problems:
+            sys.exit(1)
+        print("no regressions against %s" % args.baseline)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("saved baseline to %s" % args.baseline)
@@ -0,0 +1,50 @@
+import argparse
+import time
+from project import db, create_app
+from project import dataset
+
+# Bulk data loading for staging and load tests.
+#
+#   python bulk_load.py import --restaurants restaurants.csv --menu-items menu_items.csv --users users.csv --ratings ratings.json
+#   python bulk_load.py generate --restaurants 100000 --menu-items 5000000 --users 50000 --ratings 10000000 --seed 3310
+#
+# Import files can be .csv (with a header row), .json (a list of objects) or .ndjson.
+# Columns match the table columns, users may give a plain "password" instead of "password_hash".
+def parse_args():
+    parser = argparse.ArgumentParser(description='Bulk load restaurants, menu items, users and ratings')
+    parser.add_argument('--batch-size', type=int, default=dataset.BATCH_SIZE, help='rows per executemany batch')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    load = commands.add_parser('import', help='load rows from CSV/JSON files')
+    load.add_argument('--users')
+    load.add_argument('--restaurants')
+    load.add_argument('--menu-items', dest='menu_items')
+    load.add_argument('--ratings')
+
+    generate = commands.add_parser('generate', help='append a seeded synthetic dataset')
+    generate.add_argument('--restaurants', type=int, default=1000)
+    generate.add_argument('--menu-items', dest='menu_items', type=int, default=50000)
+    generate.add_argument('--users', type=int, default=1000)
+    generate.add_argument('--ratings', type=int, default=100000)
+    generate.add_argument('--seed', type=int, default=3310)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+  args = parse_args()
+  app = create_app()
+  with app.app_context():
+    db.create_all()
+    started = time.time()
+    if args.command == 'import':
+        counts = dataset.import_files({'users': args.users, 'restaurants': args.restaurants,
+                                       'menu_items': args.menu_items, 'ratings': args.ratings},
+                                      batch_size=args.batch_size)
+    else:
+        counts = dataset.generate(restaurants=args.restaurants, menu_items=args.menu_items, users=args.users,
+                                  ratings=args.ratings, seed=args.seed, batch_size=args.batch_size)
+    for kind in dataset.LOAD_ORDER:
+        if kind in counts:
+            print("loaded %d %s" % (counts[kind], kind))
+    print("done in %.1fs!" % (time.time() - started))
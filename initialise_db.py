@@ -1,239 +1,105 @@
-from project import db, create_app, models
-from project.models import Restaurant, MenuItem, User
+from project import db, create_app, models, search, migrations
+from project.hashing import passwords
+from project.models import Restaurant, MenuItem, User, Rating, RatingSummary
 from werkzeug.security import generate_password_hash
 from flask_login import UserMixin
 def clear_database():
-    # Delete all MenuItem records
+    # Delete everything in one transaction, children before the rows they point at
+    RatingSummary.query.delete()
+    Rating.query.delete()
     MenuItem.query.delete()
-    db.session.commit()
-
-    # Delete all Restaurant records
     Restaurant.query.delete()
-    db.session.commit()
-
-    # Delete all User records
     User.query.delete()
     db.session.commit()
 
 
+# (restaurant name, [(name, description, price, course), ...])
+SEED_MENUS = [
+    ('Urban Burger', [
+        ('French Fries', 'with garlic and parmesan', '$2.99', 'Appetizer'),
+        ('Chicken Burger', 'Juicy grilled chicken patty with tomato mayo and lettuce', '$5.50', 'Entree'),
+        ('Chocolate Cake', 'fresh baked and served with ice cream', '$3.99', 'Dessert'),
+        ('Sirloin Burger', 'Made with grade A beef', '$7.99', 'Entree'),
+        ('Root Beer', '16oz of refreshing goodness', '$1.99', 'Beverage'),
+        ('Iced Tea', 'with Lemon', '$.99', 'Beverage'),
+        ('Grilled Cheese Sandwich', 'On texas toast with American Cheese', '$3.49', 'Entree'),
+        ('Veggie Burger', 'Made with freshest of ingredients and home grown spices', '$5.99', 'Entree'),
+    ]),
+    ('Super Stir Fry', [
+        ('Chicken Stir Fry', 'with your choice of noodles vegetables and sauces', '$7.99', 'Entree'),
+        ('Peking Duck', ' a famous duck dish from Beijing[1] that has been prepared since the imperial era. The meat is prized for its thin, crisp skin, with authentic versions of the dish serving mostly the skin and little meat, sliced in front of the diners by the cook', '$25', 'Entree'),
+        ('Spicy Tuna Roll', '', '', ''),
+        ('Nepali Momo ', '', '', ''),
+        ('Beef Noodle Soup', '', '', ''),
+        ('Ramen', '', '', ''),
+    ]),
+    ('Panda Garden', [
+        ('Pho', 'a Vietnamese noodle soup consisting of broth, linguine-shaped rice noodles called banh pho, a few herbs, and meat.', '', ''),
+        ('Chinese Dumplings', 'a common Chinese dumpling which generally consists of minced meat and finely chopped vegetables wrapped into a piece of dough skin. The skin can be either thin and elastic or thicker.', '', ''),
+        ('Gyoza', 'The most prominent differences between Japanese-style gyoza and Chinese-style jiaozi are the rich garlic flavor, which is less noticeable in the Chinese version, the light seasoning of Japanese gyoza with salt and soy sauce, and the fact that gyoza wrappers are much thinner', '', ''),
+        ('Stinky Tofu', 'Taiwanese dish, deep fried fermented tofu served with pickled cabbage.', '', ''),
+    ]),
+    ('Thyme for That Vegetarian Cuisine ', [
+        ('Tres Leches Cake', 'Rich, luscious sponge cake soaked in sweet milk and topped with vanilla bean whipped cream and strawberries.', '', ''),
+        ('Mushroom risotto', 'Portabello mushrooms in a creamy risotto', '', ''),
+        ('Honey Boba Shaved Snow', 'Milk snow layered with honey boba, jasmine tea jelly, grass jelly, caramel, cream, and freshly made mochi', '', ''),
+        ('Cauliflower Manchurian', 'Golden fried cauliflower florets in a midly spiced soya,garlic sauce cooked with fresh cilantro, celery, chilies,ginger & green onions', '', ''),
+        ('Aloo Gobi Burrito', 'Vegan goodness. Burrito filled with rice, garbanzo beans, curry sauce, potatoes (aloo), fried cauliflower (gobi) and chutney. Nom Nom', '', ''),
+    ]),
+    ("Tony's Bistro ", [
+        ('Shellfish Tower', '', '', ''),
+        ('Chicken and Rice', '', '', ''),
+        ("Mom's Spaghetti", '', '', ''),
+        ("Choc Full O' Mint (Smitten's Fresh Mint Chip ice cream)", '', '', ''),
+        ('Tonkatsu Ramen', 'Noodles in a delicious pork-based broth with a soft-boiled egg', '', ''),
+    ]),
+    ("Andala's", [
+        ('Lamb Curry', 'Slow cook that thang in a pool of tomatoes, onions and alllll those tasty Indian spices. Mmmm.', '', ''),
+        ('Chicken Marsala', 'Chicken cooked in Marsala wine sauce with mushrooms', '', ''),
+        ('Potstickers', 'Delicious chicken and veggies encapsulated in fried dough.', '', ''),
+        ('Nigiri SamplerMaguro, Sake, Hamachi, Unagi, Uni, TORO!', '', '', ''),
+    ]),
+    ("Auntie Ann's Diner ", [
+        ('Chicken Fried Steak', 'Fresh battered sirloin steak fried and smothered with cream gravy', '$8.99', 'Entree'),
+        ('Boysenberry Sorbet', 'An unsettlingly huge amount of ripe berries turned into frozen (and seedless) awesomeness', '', ''),
+        ('Broiled salmon', 'Salmon fillet marinated with fresh herbs and broiled hot & fast', '', ''),
+        ('Morels on toast (seasonal)', 'Wild morel mushrooms fried in butter, served on herbed toast slices', '', ''),
+        ('Tandoori Chicken', 'Chicken marinated in yoghurt and seasoned with a spicy mix(chilli, tamarind among others) and slow cooked in a cylindrical clay or metal oven which gets its heat from burning charcoal.', '', ''),
+    ]),
+    ('Cocina Y Amor ', [
+        ('Super Burrito Al Pastor', 'Marinated Pork, Rice, Beans, Avocado, Cilantro, Salsa, Tortilla', '', ''),
+        ('Cachapa', 'Golden brown, corn-based venezuelan pancake; usually stuffed with queso telita or queso de mano, and possibly lechon. ', '', ''),
+    ]),
+]
+
+
 def populate_db():
     clear_database()
     session = db.session()
     # Create the owner and admin user please reconfigure on actual deployment
-    owner = User(username="owner", password_hash=generate_password_hash("owner", method='sha256'), role='owner')
-    session.add(owner)
-    session.commit()
+    owner = User(username="owner", password_hash=generate_password_hash("owner", method=passwords.method), role='owner')
+    admin = User(username="admin", password_hash=generate_password_hash("admin", method=passwords.method), role='admin')
+    session.add_all([owner, admin])
+    session.flush()
 
-    admin = User(username="admin", password_hash=generate_password_hash("admin", method='sha256'), role='admin')
-    session.add(admin)
-    session.commit()
-    
-    
-    #Menu for UrbanBurger
-    restaurant1 = Restaurant(name = "Urban Burger", ownerid = owner.id) 
-    session.add(restaurant1)
-    session.commit()
-    
-    menuItem1 = MenuItem(name = "French Fries", description = "with garlic and parmesan", price = "$2.99", course = "Appetizer", restaurant = restaurant1)
-    session.add(menuItem1)
-    session.commit()
-    
-    menuItem2 = MenuItem(name = "Chicken Burger", description = "Juicy grilled chicken patty with tomato mayo and lettuce", price = "$5.50", course = "Entree", restaurant = restaurant1)
-    session.add(menuItem2)
-    session.commit()
-    
-    menuItem3 = MenuItem(name = "Chocolate Cake", description = "fresh baked and served with ice cream", price = "$3.99", course = "Dessert", restaurant = restaurant1)
-    session.add(menuItem3)
-    session.commit()
-    
-    menuItem4 = MenuItem(name = "Sirloin Burger", description = "Made with grade A beef", price = "$7.99", course = "Entree", restaurant = restaurant1)
-    session.add(menuItem4)
-    session.commit()
-    
-    menuItem5 = MenuItem(name = "Root Beer", description = "16oz of refreshing goodness", price = "$1.99", course = "Beverage", restaurant = restaurant1)
-    session.add(menuItem5)
-    session.commit()
-    
-    menuItem6 = MenuItem(name = "Iced Tea", description = "with Lemon", price = "$.99", course = "Beverage", restaurant = restaurant1)
-    session.add(menuItem6)
-    session.commit()
-    
-    menuItem7 = MenuItem(name = "Grilled Cheese Sandwich", description = "On texas toast with American Cheese", price = "$3.49", course = "Entree", restaurant = restaurant1)
-    session.add(menuItem7)
-    session.commit()
-    
-    menuItem8 = MenuItem(name = "Veggie Burger", description = "Made with freshest of ingredients and home grown spices", price = "$5.99", course = "Entree", restaurant = restaurant1)
-    session.add(menuItem8)
-    session.commit()
-    
-    #Menu for Super Stir Fry
-    restaurant2 = Restaurant(name = "Super Stir Fry", ownerid = owner.id) 
-    session.add(restaurant2)
-    session.commit()
-    
-    menuItem1 = MenuItem(name = "Chicken Stir Fry", description = "with your choice of noodles vegetables and sauces", price = "$7.99", course = "Entree", restaurant = restaurant2)
-    session.add(menuItem1)
-    session.commit()
-    
-    menuItem2 = MenuItem(name = "Peking Duck", description = " a famous duck dish from Beijing[1] that has been prepared since the imperial era. The meat is prized for its thin, crisp skin, with authentic versions of the dish serving mostly the skin and little meat, sliced in front of the diners by the cook", price = "$25", course = "Entree", restaurant = restaurant2)
-    session.add(menuItem2)
-    session.commit()
-    
-    menuItem3 = MenuItem(name = "Spicy Tuna Roll", description = "", price = "", course = "", restaurant = restaurant2)
-    session.add(menuItem3)
-    session.commit()
-    
-    menuItem4 = MenuItem(name = "Nepali Momo ", description = "", price = "", course = "", restaurant = restaurant2)
-    session.add(menuItem4)
-    session.commit()
-    
-    menuItem5 = MenuItem(name = "Beef Noodle Soup", description = "", price = "", course = "", restaurant = restaurant2)
-    session.add(menuItem5)
-    session.commit()
-    
-    menuItem6 = MenuItem(name = "Ramen", description = "", price = "", course = "", restaurant = restaurant2)
-    session.add(menuItem6)
-    session.commit()
-    
-    #Menu for Panda Garden
-    restaurant1 = Restaurant(name = "Panda Garden", ownerid = owner.id) 
-    
-    session.add(restaurant1)
-    session.commit()
-    
-    menuItem1 = MenuItem(name = "Pho", description = "a Vietnamese noodle soup consisting of broth, linguine-shaped rice noodles called banh pho, a few herbs, and meat.", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem1)
-    session.commit()
-    
-    menuItem2 = MenuItem(name = "Chinese Dumplings", description = "a common Chinese dumpling which generally consists of minced meat and finely chopped vegetables wrapped into a piece of dough skin. The skin can be either thin and elastic or thicker.", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem2)
-    session.commit()
-    
-    menuItem3 = MenuItem(name = "Gyoza", description = "The most prominent differences between Japanese-style gyoza and Chinese-style jiaozi are the rich garlic flavor, which is less noticeable in the Chinese version, the light seasoning of Japanese gyoza with salt and soy sauce, and the fact that gyoza wrappers are much thinner", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem3)
-    session.commit()
-    
-    menuItem4 = MenuItem(name = "Stinky Tofu", description = "Taiwanese dish, deep fried fermented tofu served with pickled cabbage.", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem4)
+    # everything goes in as a single transaction
+    for restaurant_name, menu in SEED_MENUS:
+        restaurant = Restaurant(name = restaurant_name, ownerid = owner.id)
+        session.add(restaurant)
+        session.add_all([MenuItem(name = name, description = description, price = price, course = course, restaurant = restaurant)
+                         for name, description, price, course in menu])
     session.commit()
-    
-    #Menu for Thyme for that
-    restaurant1 = Restaurant(name = "Thyme for That Vegetarian Cuisine ", ownerid = owner.id) 
-    session.add(restaurant1)
-    session.commit()
-    
-    menuItem1 = MenuItem(name = "Tres Leches Cake", description = "Rich, luscious sponge cake soaked in sweet milk and topped with vanilla bean whipped cream and strawberries.", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem1)
-    session.commit()
-    
-    menuItem2 = MenuItem(name = "Mushroom risotto", description = "Portabello mushrooms in a creamy risotto", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem2)
-    session.commit()
-    
-    menuItem3 = MenuItem(name = "Honey Boba Shaved Snow", description = "Milk snow layered with honey boba, jasmine tea jelly, grass jelly, caramel, cream, and freshly made mochi", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem3)
-    session.commit()
-    
-    menuItem4 = MenuItem(name = "Cauliflower Manchurian", description = "Golden fried cauliflower florets in a midly spiced soya,garlic sauce cooked with fresh cilantro, celery, chilies,ginger & green onions", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem4)
-    session.commit()
-    
-    menuItem5 = MenuItem(name = "Aloo Gobi Burrito", description = "Vegan goodness. Burrito filled with rice, garbanzo beans, curry sauce, potatoes (aloo), fried cauliflower (gobi) and chutney. Nom Nom", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem5)
-    session.commit()
-    
-    #Menu for Tony's Bistro
-    restaurant1 = Restaurant(name = "Tony\'s Bistro ", ownerid = owner.id) 
-    session.add(restaurant1)
-    session.commit()
-    
-    menuItem1 = MenuItem(name = "Shellfish Tower", description = "", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem1)
-    session.commit()
-    
-    menuItem2 = MenuItem(name = "Chicken and Rice", description = "", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem2)
-    session.commit()
-    
-    menuItem3 = MenuItem(name = "Mom's Spaghetti", description = "", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem3)
-    session.commit()
-    
-    menuItem4 = MenuItem(name = "Choc Full O\' Mint (Smitten\'s Fresh Mint Chip ice cream)", description = "", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem4)
-    session.commit()
-    
-    menuItem5 = MenuItem(name = "Tonkatsu Ramen", description = "Noodles in a delicious pork-based broth with a soft-boiled egg", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem5)
-    session.commit()
-    
-    #Menu for Andala's 
-    restaurant1 = Restaurant(name = "Andala\'s", ownerid = owner.id) 
-    session.add(restaurant1)
-    session.commit()
-    
-    menuItem1 = MenuItem(name = "Lamb Curry", description = "Slow cook that thang in a pool of tomatoes, onions and alllll those tasty Indian spices. Mmmm.", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem1)
-    session.commit()
-    
-    menuItem2 = MenuItem(name = "Chicken Marsala", description = "Chicken cooked in Marsala wine sauce with mushrooms", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem2)
-    session.commit()
-    
-    menuItem3 = MenuItem(name = "Potstickers", description = "Delicious chicken and veggies encapsulated in fried dough.", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem3)
-    session.commit()
-    
-    menuItem4 = MenuItem(name = "Nigiri SamplerMaguro, Sake, Hamachi, Unagi, Uni, TORO!", description = "", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem4)
-    session.commit()
-    
-    #Menu for Auntie Ann's
-    restaurant1 = Restaurant(name = "Auntie Ann\'s Diner ", ownerid = owner.id) 
-    session.add(restaurant1)
-    session.commit()
-    
-    menuItem9 = MenuItem(name = "Chicken Fried Steak", description = "Fresh battered sirloin steak fried and smothered with cream gravy", price = "$8.99", course = "Entree", restaurant = restaurant1)
-    session.add(menuItem9)
-    session.commit()
-    
-    menuItem1 = MenuItem(name = "Boysenberry Sorbet", description = "An unsettlingly huge amount of ripe berries turned into frozen (and seedless) awesomeness", price = "", course = "", restaurant = restaurant1)
-    
-    session.add(menuItem1)
-    session.commit()
-    
-    menuItem2 = MenuItem(name = "Broiled salmon", description = "Salmon fillet marinated with fresh herbs and broiled hot & fast", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem2)
-    session.commit()
-    
-    menuItem3 = MenuItem(name = "Morels on toast (seasonal)", description = "Wild morel mushrooms fried in butter, served on herbed toast slices", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem3)
-    session.commit()
-    
-    menuItem4 = MenuItem(name = "Tandoori Chicken", description = "Chicken marinated in yoghurt and seasoned with a spicy mix(chilli, tamarind among others) and slow cooked in a cylindrical clay or metal oven which gets its heat from burning charcoal.", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem4)
-    session.commit()
-    
-    #Menu for Cocina Y Amor
-    restaurant1 = Restaurant(name = "Cocina Y Amor ", ownerid = owner.id) 
-    session.add(restaurant1)
-    session.commit()
-    
-    menuItem1 = MenuItem(name = "Super Burrito Al Pastor", description = "Marinated Pork, Rice, Beans, Avocado, Cilantro, Salsa, Tortilla", price = "", course = "", restaurant = restaurant1)
-    session.add(menuItem1)
-    session.commit()
-    
-    menuItem2 = MenuItem(name = "Cachapa", description = "Golden brown, corn-based venezuelan pancake; usually stuffed with queso telita or queso de mano, and possibly lechon. ", price = "", course = "", restaurant = restaurant1)
-    
-    session.add(menuItem2)
-    session.commit()
-    
+
     print("added menu items!")
 
+    if search.fts_available():
+        search.rebuild_index()
+
 
 if __name__ == '__main__':
   app = create_app()
   with app.app_context():
     db.create_all()
+    migrations.upgrade() # a fresh database is already current, this just records the schema version
     populate_db()
 
@@ -0,0 +1,26 @@
+import argparse
+from project import db, create_app
+from project import migrations
+
+# Brings an existing database up to the current schema (indexes, unique ratings, new columns).
+# Safe to run repeatedly, migrations that already ran are skipped.
+def parse_args():
+    parser = argparse.ArgumentParser(description='Apply pending database schema migrations')
+    parser.add_argument('--status', action='store_true', help='list applied and pending migrations without running them')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+  args = parse_args()
+  app = create_app()
+  with app.app_context():
+    db.create_all()
+    if args.status:
+        applied = migrations.applied_versions()
+        for version, migration in migrations.MIGRATIONS:
+            print("%3d %-40s %s" % (version, migration.__name__, 'applied' if version in applied else 'pending'))
+    else:
+        ran = migrations.upgrade()
+        for version, name in ran:
+            print("applied migration %d %s" % (version, name))
+        print("schema is at version %d!" % migrations.current_version())
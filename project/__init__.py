@@ -7,22 +7,51 @@ from flask_sslify import SSLify
 # init SQLAlchemy so we can use it later in our models
 db = SQLAlchemy()
 from .models import User
-def create_app():
+def create_app(test_config=None):
     app = Flask(__name__)
 
     app.config['SECRET_KEY'] = 'secret-key-do-not-reveal'
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///restaurantmenu.db'
+    if test_config is not None:
+        app.config.update(test_config)
+
+    # database url, pool and sqlite pragmas come from config/env, see database.py
+    from . import database
+    database.configure(app)
     
     db.init_app(app)
 
+    # per request query counts, Server-Timing headers and query budgets, see profiling.py
+    from . import profiling
+    profiling.init_app(app)
+
+    # per endpoint latency histograms and status counts, shared between workers through METRICS_DIR
+    from .metrics import metrics
+    metrics.init_app(app)
+
+    # shared audit log, written to log_file.txt by a background thread
+    from .audit import audit
+    audit.init_app(app)
+
     login_manager = LoginManager()  # Create an instance of LoginManager
     login_manager.login_view = 'auth.login'  # Set the login view function
     login_manager.init_app(app)  # Initialise LoginManager with the Flask application
 
 
+    # password hashing runs in a bounded process pool, see hashing.py
+    from .hashing import passwords
+    passwords.init_app(app)
+
+    # users are cached between requests, see user_cache.py
+    from . import user_cache
+    user_cache.init_app(app)
+
+    # deleted restaurants and users are removed in the background in small batches, see purge.py
+    from .purge import purger
+    purger.init_app(app)
+
     @login_manager.user_loader
     def load_user(userid):
-        return User.query.get(int(userid))  # Load user from the database based on user ID
+        return user_cache.load_user(int(userid))  # Load user from the cache or database based on user ID
 
 
     sslify = SSLify(app) # Enable HTTPS redirection
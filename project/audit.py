@@ -0,0 +1,289 @@
+import atexit
+import glob
+import json as pyjs
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import re
+import signal
+import threading
+import time
+import traceback
+from datetime import datetime
+from flask import has_request_context, request
+from flask_login import current_user
+
+# Shared audit logging for every blueprint.
+# Request threads only put a record on an in-memory queue, a background QueueListener
+# thread formats it as one JSON line and does the disk write and rotation.
+#
+# Under run.py serve there are several worker processes, so only one process may own the file: the
+# master starts a writer process before forking (start_writer) and every worker's listener thread
+# sends its formatted lines to it over a pipe. Only the writer appends and rotates, so a rotated
+# segment is never written to again and the byte offsets audit_index.py keeps stay valid.
+AUDIT_LOGGER = 'project.audit'
+
+DEFAULTS = {
+    'AUDIT_LOG_FILE': 'log_file.txt',
+    'AUDIT_LOG_MAX_BYTES': 10 * 1024 * 1024,
+    'AUDIT_LOG_ROTATE_SECONDS': 24 * 60 * 60,
+    'AUDIT_LOG_BACKUPS': 30,
+    'AUDIT_LOG_QUEUE_SIZE': 10000,
+}
+
+SEGMENT_TIME_FORMAT = '%Y%m%d-%H%M%S-%f'
+SEGMENT_SUFFIX = re.compile(r'\.\d{8}-\d{6}-\d{6}$')
+
+
+def segment_files(path):
+    """Rotated segments of an audit log, oldest first. Their names never change once written"""
+    return sorted(name for name in glob.glob(glob.escape(path) + '.*')
+                  if SEGMENT_SUFFIX.search(name[len(path):]))
+
+
+class JSONLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'action': getattr(record, 'action', None),
+            'user_id': getattr(record, 'user_id', None),
+            'username': getattr(record, 'username', None),
+            'target': getattr(record, 'target', None),
+            'ip': getattr(record, 'ip', None),
+            'details': getattr(record, 'details', None) or {},
+        }
+        return pyjs.dumps(entry, default=str, separators=(',', ':'))
+
+
+class RotatingAuditFileHandler(logging.handlers.RotatingFileHandler):
+    """Rolls the log over when it reaches max_bytes or is older than interval seconds.
+
+    The full file is renamed to <file>.<timestamp> instead of shifting .1, .2, ... along,
+    so a rotated segment keeps its name (and any index built over it) for good.
+    """
+
+    def __init__(self, filename, max_bytes=0, interval=0, backup_count=0):
+        super(RotatingAuditFileHandler, self).__init__(filename, maxBytes=max_bytes, backupCount=backup_count,
+                                                       encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return 1
+        return super(RotatingAuditFileHandler, self).shouldRollover(record)
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            segment = '%s.%s' % (self.baseFilename, datetime.utcnow().strftime(SEGMENT_TIME_FORMAT))
+            os.rename(self.baseFilename, segment)
+        if self.backupCount > 0:
+            for old in segment_files(self.baseFilename)[:-self.backupCount]:
+                os.remove(old)
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the request thread, records are counted and dropped when the queue is full"""
+
+    def __init__(self, log_queue):
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # the listener formats the record, so skip QueueHandler's message pre-formatting
+        return record
+
+
+class ForwardingHandler(logging.Handler):
+    """Sends formatted lines to the writer process, dropping them if its queue is full"""
+
+    def __init__(self, line_queue):
+        super(ForwardingHandler, self).__init__()
+        self.line_queue = line_queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.line_queue.put_nowait(self.format(record))
+        except (queue.Full, ValueError):  # ValueError once the queue is closed at exit
+            self.dropped += 1
+
+
+def _file_handler(settings):
+    return RotatingAuditFileHandler(settings['AUDIT_LOG_FILE'], max_bytes=settings['AUDIT_LOG_MAX_BYTES'],
+                                    interval=settings['AUDIT_LOG_ROTATE_SECONDS'],
+                                    backup_count=settings['AUDIT_LOG_BACKUPS'])
+
+
+def _writer_main(line_queue, settings):
+    # Ctrl-C goes to the whole process group, the master stops the writer once the workers are done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    handler = _file_handler(settings)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    try:
+        while True:
+            line = line_queue.get()
+            if line is None:
+                break
+            handler.handle(logging.makeLogRecord({'msg': line, 'levelno': logging.INFO}))
+    finally:
+        handler.close()
+
+
+class AuditLog(object):
+    def __init__(self):
+        self.settings = dict(DEFAULTS)
+        self.logger = logging.getLogger(AUDIT_LOGGER)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.calls = 0
+        self.call_seconds = 0.0
+        self.max_call_seconds = 0.0
+        self._pid = None
+        self._handler = None
+        self._listener = None
+        self._writer_pid = None
+        self._master_pid = None
+        self._writer_queue = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def init_app(self, app):
+        for key, value in DEFAULTS.items():
+            app.config.setdefault(key, value)
+        settings = dict((key, app.config[key]) for key in DEFAULTS)
+        if settings != self.settings:
+            self.stop()
+            self.settings = settings
+
+    def _start(self):
+        # the listener thread doesn't survive a fork, so every process starts its own
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            log_queue = queue.Queue(self.settings['AUDIT_LOG_QUEUE_SIZE'])
+            if self._writer_queue is not None:
+                file_handler = ForwardingHandler(self._writer_queue)
+            else:
+                file_handler = _file_handler(self.settings)
+            file_handler.setFormatter(JSONLinesFormatter())
+            if self._handler is not None:
+                self.logger.removeHandler(self._handler)
+            self._handler = DroppingQueueHandler(log_queue)
+            self.logger.addHandler(self._handler)
+            self._listener = logging.handlers.QueueListener(log_queue, file_handler)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def start_writer(self):
+        """Fork the single writer process, call in the master before forking workers"""
+        with self._lock:
+            if self._writer_pid is not None:
+                return
+            self._writer_queue = multiprocessing.Queue(self.settings['AUDIT_LOG_QUEUE_SIZE'])
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    _writer_main(self._writer_queue, self.settings)
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                os._exit(code)  # skip the master's exit handlers
+            self._writer_pid = pid
+            self._master_pid = os.getpid()
+            atexit.register(self.stop_writer)
+
+    def stop_writer(self):
+        """Let the writer process write out everything it was sent and exit (master only)"""
+        if self._writer_pid is None or self._master_pid != os.getpid():
+            return
+        self.stop()
+        self._writer_queue.put(None)
+        self._writer_queue.close()
+        self._writer_queue.join_thread()
+        deadline = time.time() + 10
+        try:
+            while os.waitpid(self._writer_pid, os.WNOHANG)[0] == 0 and time.time() < deadline:
+                time.sleep(0.05)
+        except ChildProcessError:
+            pass  # already reaped, gunicorn's master waits on every child
+        self._writer_pid = None
+        self._writer_queue = None
+
+    def stop(self):
+        """Flush everything queued so far to disk and stop the writer thread"""
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+                for handler in self._listener.handlers:
+                    handler.close()
+                if self._writer_queue is not None and os.getpid() != self._master_pid:
+                    # a worker pushes what it has sent down the pipe before it exits
+                    self._writer_queue.close()
+                    self._writer_queue.join_thread()
+            self._listener = None
+            self._pid = None
+
+    def record(self, action, target=None, user=None, **details):
+        """Queue one audit entry. user defaults to the logged in user of the current request"""
+        started = time.perf_counter()
+        if self._pid != os.getpid():
+            self._start()
+
+        ip = None
+        if has_request_context():
+            ip = request.remote_addr
+            if user is None:
+                if current_user.is_authenticated:
+                    user = current_user
+        self.logger.info(action, extra={
+            'action': action,
+            'target': target,
+            'user_id': user.id if user is not None else None,
+            'username': user.username if user is not None else None,
+            'ip': ip,
+            'details': details,
+        })
+
+        elapsed = time.perf_counter() - started
+        with self._stats_lock:  # request threads all update these
+            self.calls += 1
+            self.call_seconds += elapsed
+            if elapsed > self.max_call_seconds:
+                self.max_call_seconds = elapsed
+
+    def stats(self):
+        """Overhead a log call adds to the request thread, plus writer queue state"""
+        log_queue = self._handler.queue if self._handler is not None else None
+        dropped = self._handler.dropped if self._handler is not None else 0
+        # under run.py serve lines can also be dropped on the way to the writer process
+        listener = self._listener
+        if listener is not None:
+            dropped += sum(handler.dropped for handler in listener.handlers if isinstance(handler, ForwardingHandler))
+        with self._stats_lock:
+            calls, call_seconds, max_call_seconds = self.calls, self.call_seconds, self.max_call_seconds
+        return {
+            'calls': calls,
+            'mean_call_us': call_seconds / calls * 1e6 if calls else 0.0,
+            'max_call_us': max_call_seconds * 1e6,
+            'queue_depth': log_queue.qsize() if log_queue is not None else 0,
+            'dropped': dropped,
+        }
+
+
+audit = AuditLog()
@@ -0,0 +1,218 @@
+import json as pyjs
+import mmap
+import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+from .audit import segment_files
+
+# Query engine for the audit log.
+# Every log file (the active one and each rotated segment) gets a sidecar index in <log>.index/
+# holding the byte ranges of its lines per hour bucket, per user and per action. Indexes are
+# extended incrementally from the last indexed byte, and queries mmap the log and only read
+# the ranges the index points at instead of scanning whole files.
+BUCKET_SECONDS = 3600
+INDEX_VERSION = 2
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+_lock = threading.Lock()
+# indexes already read from disk in this process, keyed by index path
+_loaded = {}
+
+
+def parse_ts(value):
+    """Seconds since the epoch for an audit 'ts' value or a query bound like 2023-06-04, 2023-06-04T16:30
+    or 2023-06-04T16:30+10:00. Times without an offset are UTC"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = value.strip().rstrip('Z').replace(' ', 'T')
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return (moment - datetime(1970, 1, 1)).total_seconds()
+
+
+def _add_range(ranges, start, end):
+    # merge with the previous range when the lines are next to each other
+    if ranges and ranges[-1][1] == start:
+        ranges[-1][1] = end
+    else:
+        ranges.append([start, end])
+
+
+class FileIndex(object):
+    def __init__(self, log_path, index_path):
+        self.log_path = log_path
+        self.index_path = index_path
+        self.data = self._empty()
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, encoding='utf-8') as f:
+                    data = pyjs.load(f)
+                if data.get('version') == INDEX_VERSION:
+                    self.data = data
+            except ValueError:
+                pass
+
+    @staticmethod
+    def _empty():
+        return {'version': INDEX_VERSION, 'inode': None, 'indexed_bytes': 0, 'min_ts': None, 'max_ts': None,
+                'buckets': {}, 'users': {}, 'actions': {}}
+
+    def update(self):
+        """Index whatever was appended since the last update, returns the number of new bytes indexed"""
+        stat = os.stat(self.log_path)
+        if stat.st_ino != self.data['inode'] or stat.st_size < self.data['indexed_bytes']:
+            # a different or truncated file under this name, start again
+            self.data = self._empty()
+            self.data['inode'] = stat.st_ino
+        start = self.data['indexed_bytes']
+        if stat.st_size == start:
+            return 0
+
+        data = self.data
+        offset = start
+        with open(self.log_path, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # the writer hasn't finished this line yet
+                end = offset + len(line)
+                self._index_line(line, offset, end)
+                offset = end
+        data['indexed_bytes'] = offset
+        self._save()
+        return offset - start
+
+    def _index_line(self, line, start, end):
+        try:
+            entry = pyjs.loads(line)
+            ts = parse_ts(entry['ts'])
+        except (ValueError, KeyError, TypeError):
+            return  # older plain text log lines aren't indexed
+        data = self.data
+        # lines from different threads and workers arrive slightly out of order, so an hour can own
+        # several separate ranges rather than one span that would overlap its neighbours
+        _add_range(data['buckets'].setdefault(str(int(ts // BUCKET_SECONDS)), []), start, end)
+        _add_range(data['users'].setdefault(str(entry.get('user_id')), []), start, end)
+        _add_range(data['actions'].setdefault(str(entry.get('action')), []), start, end)
+        data['min_ts'] = ts if data['min_ts'] is None else min(data['min_ts'], ts)
+        data['max_ts'] = ts if data['max_ts'] is None else max(data['max_ts'], ts)
+
+    def _save(self):
+        # a temporary file of our own, other workers may be saving the same index
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(self.index_path), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w', encoding='utf-8') as f:
+                pyjs.dump(self.data, f, separators=(',', ':'))
+            os.replace(temporary, self.index_path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def candidate_ranges(self, user_id=None, action=None, start=None, end=None):
+        """Byte ranges that can hold matching lines, taken from the most selective index"""
+        data = self.data
+        if data['min_ts'] is None:
+            return []
+        if (start is not None and data['max_ts'] < start) or (end is not None and data['min_ts'] > end):
+            return []
+
+        options = []
+        if user_id is not None:
+            options.append(data['users'].get(str(user_id), []))
+        if action:
+            options.append(data['actions'].get(action, []))
+        if start is not None or end is not None or not options:
+            low = int(start // BUCKET_SECONDS) if start is not None else None
+            high = int(end // BUCKET_SECONDS) if end is not None else None
+            options.append(sorted(r for b, ranges in data['buckets'].items()
+                                  if (low is None or int(b) >= low) and (high is None or int(b) <= high)
+                                  for r in ranges))
+        return min(options, key=lambda ranges: sum(e - s for s, e in ranges))
+
+
+class AuditQuery(object):
+    def __init__(self, log_path, index_dir=None):
+        self.log_path = log_path
+        self.index_dir = index_dir or log_path + '.index'
+
+    def files(self):
+        """Log files newest first"""
+        files = segment_files(self.log_path)
+        if os.path.exists(self.log_path):
+            files.append(self.log_path)
+        return list(reversed(files))
+
+    def _index_for(self, path):
+        index_path = os.path.join(self.index_dir, os.path.basename(path) + '.json')
+        if index_path not in _loaded:
+            _loaded[index_path] = FileIndex(path, index_path)
+        return _loaded[index_path]
+
+    def refresh(self):
+        """Bring every file's index up to date and drop indexes of segments that rotated away"""
+        with _lock:
+            if not os.path.isdir(self.index_dir):
+                os.makedirs(self.index_dir)
+            indexes = []
+            for path in self.files():
+                index = self._index_for(path)
+                index.update()
+                indexes.append(index)
+            live = set(os.path.basename(index.index_path) for index in indexes)
+            for name in os.listdir(self.index_dir):
+                if name.endswith('.json') and name not in live:
+                    os.remove(os.path.join(self.index_dir, name))
+                    _loaded.pop(os.path.join(self.index_dir, name), None)
+            return indexes
+
+    def search(self, user_id=None, action=None, target=None, start=None, end=None, limit=DEFAULT_LIMIT):
+        """Matching entries, newest first. start/end are epoch seconds, target compares as a string"""
+        limit = max(1, min(limit, MAX_LIMIT))
+        target = str(target) if target not in (None, '') else None
+        results = []
+        for index in self.refresh():
+            ranges = index.candidate_ranges(user_id, action, start, end)
+            if not ranges:
+                continue
+            inode, indexed_bytes = index.data['inode'], index.data['indexed_bytes']
+            try:
+                f = open(index.log_path, 'rb')
+            except FileNotFoundError:
+                continue  # rotated away since the refresh
+            with f:
+                stat = os.fstat(f.fileno())
+                # the writer may have rotated since the refresh, leaving a new (maybe empty) file under this
+                # name that the ranges don't describe, its lines are in a segment the next search indexes
+                if stat.st_size == 0 or stat.st_ino != inode or stat.st_size < indexed_bytes:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    for range_start, range_end in reversed(ranges):
+                        for line in reversed(mapped[range_start:range_end].splitlines()):
+                            entry = self._match(line, user_id, action, target, start, end)
+                            if entry is not None:
+                                results.append(entry)
+                                if len(results) >= limit:
+                                    return results
+        return results
+
+    @staticmethod
+    def _match(line, user_id, action, target, start, end):
+        try:
+            entry = pyjs.loads(line)
+            ts = parse_ts(entry['ts'])
+        except (ValueError, KeyError, TypeError):
+            return None
+        if user_id is not None and entry.get('user_id') != user_id:
+            return None
+        if action and entry.get('action') != action:
+            return None
+        if target is not None and str(entry.get('target')) != target:
+            return None
+        if (start is not None and ts < start) or (end is not None and ts > end):
+            return None
+        return entry
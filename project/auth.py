@@ -9,27 +9,12 @@ from flask_wtf.csrf import CSRFProtect
 import re
 from markupsafe import escape
 from flask_login import login_user, login_required, logout_user
-import logging
+from .audit import audit
+from .user_cache import invalidate_user
+from .hashing import passwords, HashPoolBusy
 
 auth = Blueprint('auth', __name__)
 
-# Create a logger and set its level to the desired logging level
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-# Create a file handler and set its level to the desired logging level
-file_handler = logging.FileHandler('log_file.txt')
-file_handler.setLevel(logging.INFO)
-
-# Create a formatter for the log messages
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-
-# Set the formatter for the file handler
-file_handler.setFormatter(formatter)
-
-# Add the file handler to the logger
-logger.addHandler(file_handler)
-
 #login function
 @auth.route('/register')
 def register_standard():
@@ -45,36 +30,42 @@ def register():
 
         # Validate the form data
         if password != confirm_password:
-            logger.info('Account %s failed to be created due to passwords not matching' % (username)) # secure logging
+            audit.record('user.register.failed', username=username, reason='passwords do not match') # secure logging
             flash('Passwords do not match. Please try again.')
             return redirect(url_for('auth.register'))
         
         # Check password complexity
         if not is_password_complex(password):
-            logger.info('Account %s failed to be created due to password complexity' % (username)) # secure logging
+            audit.record('user.register.failed', username=username, reason='password complexity') # secure logging
             flash('Password does not meet complexity requirements. Please try again.')
             return redirect(url_for('auth.register'))
 
-        # Check if username already exists
+        # Check if username already exists (a deleted user keeps the name until the purge removes them)
         existing_user = User.query.filter_by(username=username).first()
         if existing_user:
-            logger.info('Account %s failed to be created due to existing username' % (username)) # secure logging
+            audit.record('user.register.failed', username=username, reason='existing username') # secure logging
             flash('Username already exists. Please choose a different username.')
             return redirect(url_for('auth.register'))
         
         # Check for special characters in the username prevents injection type vulns
         special_char_pattern = r'[!@#$%^&*(),.?":{}|<>]'
         if re.search(special_char_pattern, username):
-            logger.info('Account failed to be created due to special characters') # secure logging
+            audit.record('user.register.failed', reason='special characters') # secure logging
             flash('Username contains invalid characters. Please choose a different username.')
             return redirect(url_for('auth.register'))
 
         new_user = User(username=username, role='Public User')
-        new_user.set_password(password)
+        try:
+            new_user.set_password(password)
+        except HashPoolBusy:
+            flash('The server is busy, please try again in a moment.')
+            return render_template('register.html'), 503
         db.session.add(new_user)
         
         db.session.commit()
-        logger.info('New user created %s ' % (username))
+        # ids can be reused after a delete, so don't let a cached old user answer for this one
+        invalidate_user(new_user.id)
+        audit.record('user.register', target=new_user.id, user=new_user)
         flash('Registration successful. You can now log in.')
         return redirect(url_for('auth.login'))
     else:
@@ -90,17 +81,33 @@ def login():
         username = escape(request.form['username'])#input sanitise
         password = escape(request.form['password'])#input sanitise
 
-        user = User.query.filter_by(username=username).first()
-
-        #username and password match
-        if not user or not user.check_password(password):
-            logger.info('Failed attempt to login to %s ' % (username))# secure logging
+        user = User.live().filter_by(username=username).first()
+
+        #username and password match, checked in the hashing pool which turns us away when it is saturated
+        try:
+            password_ok = user is not None and user.check_password(password)
+        except HashPoolBusy:
+            audit.record('user.login.busy', username=username) # secure logging
+            flash('The server is busy, please try again in a moment.')
+            return render_template('login.html', form=form), 503
+        if not password_ok:
+            audit.record('user.login.failed', username=username) # secure logging
             flash('Invalid username or password.')
             return redirect(url_for('auth.login'))
 
+        # upgrade hashes made with an older method or cost now that we know the password
+        if passwords.needs_rehash(user.password_hash):
+            try:
+                user.set_password(password)
+                db.session.commit()
+                invalidate_user(user.id)
+                audit.record('user.password.rehash', target=user.id, user=user) # secure logging
+            except HashPoolBusy:
+                db.session.rollback()  # keep the old hash, it gets upgraded on a later login
+
         # Store user ID in the session to maintain the session
         login_user(user,True)
-        logger.info('User logged in %s (ID: %s): %s' % (username, user.id, ''))# secure logging
+        audit.record('user.login', target=user.id, user=user) # secure logging
         flash('Logged in successfully.')
         return redirect(url_for('main.showRestaurants'))
     else:
@@ -110,7 +117,7 @@ def login():
 @auth.route('/logout') 
 @login_required
 def logout(): 
-    logger.info('User logged out')
+    audit.record('user.logout')
     logout_user() #securely cleans up logging out to ensure session vulnerabilities 
     return redirect(url_for('main.showRestaurants'))
 
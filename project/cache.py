@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread safe least-recently-used cache with an optional time to live (in seconds).
+
+    maxweight/weigh optionally bound the total size of the values as well as their
+    number, e.g. weigh=len with maxweight in bytes for rendered html.
+    It only lives in the current process, so anything cached here should be plain
+    data rather than ORM objects tied to a database session.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, maxweight=None, weigh=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires, weight = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        weight = self.weigh(value) if self.weigh else 0
+        if self.maxweight is not None and weight > self.maxweight:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires, weight)
+            self.weight += weight
+            while len(self._data) > self.maxsize or \
+                    (self.maxweight is not None and self.weight > self.maxweight):
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        value, expires, weight = self._data.pop(key)
+        self.weight -= weight
+        return value
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._data:
+                return self._remove(key)
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'weight': self.weight,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
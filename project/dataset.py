@@ -0,0 +1,156 @@
+import csv
+import json as pyjs
+import os
+import random
+from sqlalchemy import func
+from werkzeug.security import generate_password_hash
+from . import db
+from .models import User, Restaurant, MenuItem, Rating, RatingSummary
+from . import search
+from .hashing import passwords
+from .prices import parse_price
+
+# Bulk loading helpers used by bulk_load.py (and the benchmarks).
+# Rows go in as executemany batches with one commit per table instead of a commit per row.
+BATCH_SIZE = 5000
+
+TABLES = {
+    'users': User.__table__,
+    'restaurants': Restaurant.__table__,
+    'menu_items': MenuItem.__table__,
+    'ratings': Rating.__table__,
+}
+# parents first so foreign keys always point at rows that are already loaded
+LOAD_ORDER = ['users', 'restaurants', 'menu_items', 'ratings']
+
+
+def insert_batches(table, rows, batch_size=BATCH_SIZE):
+    """Insert an iterable of dicts into table with executemany, committing once at the end"""
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            db.session.execute(table.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+        count += len(batch)
+    db.session.commit()
+    return count
+
+
+def read_rows(path):
+    """Yield dicts from a .csv file (header row) or a .json file (list of objects) or .ndjson file"""
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline='', encoding='utf-8') as f:
+        if extension == '.csv':
+            for row in csv.DictReader(f):
+                yield row
+        elif extension in ('.ndjson', '.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield pyjs.loads(line)
+        else:
+            for row in pyjs.load(f):
+                yield row
+
+
+def _clean_rows(kind, rows):
+    columns = set(column.name for column in TABLES[kind].columns)
+    for row in rows:
+        row = dict((key, value) for key, value in row.items() if value not in (None, ''))
+        if kind == 'users' and 'password' in row:
+            row['password_hash'] = generate_password_hash(row.pop('password'), passwords.method)
+        if kind == 'users':
+            row.setdefault('role', 'Public User')
+        if kind == 'menu_items' and 'price' in row:
+            row['price_cents'] = parse_price(row.pop('price'))
+        yield dict((key, value) for key, value in row.items() if key in columns)
+
+
+def refresh_derived():
+    """Rebuild the tables that are derived from the loaded rows"""
+    RatingSummary.rebuild()
+    if search.fts_available():
+        search.rebuild_index()
+
+
+def import_files(files, batch_size=BATCH_SIZE):
+    """Load {kind: path} files, kinds being users, restaurants, menu_items and ratings"""
+    counts = {}
+    for kind in LOAD_ORDER:
+        if files.get(kind):
+            counts[kind] = insert_batches(TABLES[kind], _clean_rows(kind, read_rows(files[kind])), batch_size)
+    refresh_derived()
+    return counts
+
+
+# Synthetic data for staging and load testing. The same seed always gives the same dataset.
+ADJECTIVES = ['Urban', 'Golden', 'Rustic', 'Spicy', 'Little', 'Royal', 'Happy', 'Blue', 'Green', 'Smoky',
+              'Crispy', 'Sunny', 'Lucky', 'Hungry', 'Silver', 'Wild']
+NOUNS = ['Burger', 'Garden', 'Kitchen', 'Bistro', 'Diner', 'Grill', 'Noodle', 'Taco', 'Curry', 'Pizza',
+         'Dumpling', 'Cafe', 'Bakery', 'Smokehouse', 'Canteen', 'Wok']
+DISHES = ['Chicken', 'Beef', 'Tofu', 'Salmon', 'Lamb', 'Mushroom', 'Prawn', 'Pork', 'Veggie', 'Duck']
+STYLES = ['Burger', 'Curry', 'Salad', 'Soup', 'Noodles', 'Pie', 'Roll', 'Stir Fry', 'Skewers', 'Risotto']
+WORDS = ['fresh', 'grilled', 'with', 'garlic', 'served', 'crispy', 'house', 'sauce', 'spiced', 'herbs',
+         'slow', 'cooked', 'seasonal', 'greens', 'rice', 'butter', 'lemon', 'chilli', 'sweet', 'smoked']
+COURSES = ['Appetizer', 'Entree', 'Dessert', 'Beverage']
+SYNTHETIC_PASSWORD = 'Synthetic1!'
+
+
+def _next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def _spread(total, buckets, index):
+    # how many of total land in bucket index when spread as evenly as possible
+    return total // buckets + (1 if index < total % buckets else 0)
+
+
+def generate(restaurants=1000, menu_items=50000, users=1000, ratings=100000, seed=3310,
+             batch_size=BATCH_SIZE):
+    """Append a deterministic synthetic dataset, returns the row counts per table"""
+    rng = random.Random(seed)
+    first_user = _next_id(User)
+    first_restaurant = _next_id(Restaurant)
+    first_item = _next_id(MenuItem)
+    owners = max(1, users // 100)
+
+    # hashing is deliberately slow so every synthetic account shares one hash
+    password_hash = generate_password_hash(SYNTHETIC_PASSWORD, passwords.method)
+    user_rows = ({'id': first_user + i, 'username': 'user%07d' % (first_user + i), 'password_hash': password_hash,
+                  'role': 'owner' if i < owners else 'Public User'} for i in range(users))
+
+    restaurant_rows = ({'id': first_restaurant + i, 'ownerid': first_user + rng.randrange(owners),
+                        'name': '%s %s %d' % (rng.choice(ADJECTIVES), rng.choice(NOUNS), first_restaurant + i)}
+                       for i in range(restaurants))
+
+    def item_rows():
+        item_id = first_item
+        for r in range(restaurants):
+            for _ in range(_spread(menu_items, restaurants, r)):
+                yield {'id': item_id, 'restaurant_id': first_restaurant + r,
+                       'name': '%s %s' % (rng.choice(DISHES), rng.choice(STYLES)),
+                       'description': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 10))),
+                       'price_cents': rng.randint(1, 40) * 100 + rng.choice([0, 49, 50, 95, 99]),
+                       'course': rng.choice(COURSES)}
+                item_id += 1
+
+    def rating_rows():
+        # each user rates a restaurant at most once
+        for r in range(restaurants):
+            count = min(_spread(ratings, restaurants, r), users)
+            for offset in rng.sample(range(users), count):
+                yield {'restaurant_id': first_restaurant + r, 'user_id': first_user + offset,
+                       'rating': rng.choice([1, 2, 3, 3, 4, 4, 4, 5, 5, 5])}
+
+    counts = {
+        'users': insert_batches(User.__table__, user_rows, batch_size),
+        'restaurants': insert_batches(Restaurant.__table__, restaurant_rows, batch_size),
+        'menu_items': insert_batches(MenuItem.__table__, item_rows(), batch_size),
+        'ratings': insert_batches(Rating.__table__, rating_rows(), batch_size),
+    }
+    refresh_derived()
+    return counts
@@ -0,0 +1,100 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Password hashing and checking run in a small dedicated process pool so a burst of logins
+# queues up behind a fixed number of KDF workers instead of pinning every request thread.
+# PASSWORD_HASH_WORKERS = 0 runs them inline (handy for tests and command line scripts).
+DEFAULTS = {
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:260000',
+    'PASSWORD_HASH_WORKERS': min(4, os.cpu_count() or 1),
+    'PASSWORD_HASH_QUEUE': 32,
+    'PASSWORD_HASH_TIMEOUT': 10,
+}
+
+
+class HashPoolBusy(Exception):
+    """Raised instead of waiting when the hashing pool already has a full queue"""
+
+
+class PasswordHasher(object):
+    def __init__(self):
+        self.method = DEFAULTS['PASSWORD_HASH_METHOD']
+        self.workers = DEFAULTS['PASSWORD_HASH_WORKERS']
+        self.queue_size = DEFAULTS['PASSWORD_HASH_QUEUE']
+        self.timeout = DEFAULTS['PASSWORD_HASH_TIMEOUT']
+        self.rejected = 0
+        self._pid = None
+        self._executor = None
+        self._slots = None
+        self._prefix = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        for key, value in DEFAULTS.items():
+            app.config.setdefault(key, value)
+        self.configure(method=app.config['PASSWORD_HASH_METHOD'], workers=app.config['PASSWORD_HASH_WORKERS'],
+                       queue_size=app.config['PASSWORD_HASH_QUEUE'], timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+
+    def configure(self, method=None, workers=None, queue_size=None, timeout=None):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
+            self._pid = None
+            self._prefix = None
+            self.method = method or self.method
+            self.workers = self.workers if workers is None else workers
+            self.queue_size = self.queue_size if queue_size is None else queue_size
+            self.timeout = timeout or self.timeout
+
+    def _pool(self):
+        # a pool doesn't survive a fork, so every process starts its own on first use
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                self._slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+                self._pid = os.getpid()
+            return self._executor, self._slots
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        executor, slots = self._pool()
+        if not slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HashPoolBusy()
+        try:
+            future = executor.submit(function, *args)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda done: slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            self.rejected += 1
+            raise HashPoolBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True for hashes made with an older method or cost than the configured one"""
+        return password_hash.split('$', 1)[0] != self.prefix()
+
+    def prefix(self):
+        # werkzeug fills in defaults ('scrypt' -> 'scrypt:32768:8:1', 'pbkdf2:sha256' -> 'pbkdf2:sha256:<iterations>'),
+        # so compare against what it actually writes for the configured method, worked out once
+        if self._prefix is None:
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return self._prefix
+
+
+passwords = PasswordHasher()
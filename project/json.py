@@ -1,23 +1,46 @@
-from flask import Blueprint, jsonify, escape
-from .models import Restaurant, MenuItem
+from flask import Blueprint, jsonify, escape, request, Response, stream_with_context
+from .models import Restaurant, MenuItem, Rating, RatingSummary
+from .pagination import keyset_page, page_size
+from .prices import PriceFilter, SORTS, format_price
 from sqlalchemy import text
+from flask_login import login_required
 from . import db
 import json as pyjs
 
 json = Blueprint('json', __name__)
 
 # JSON APIs to view Restaurant Information
+# prices are stored in cents, the API keeps handing out the "$2.99" strings it always has
+MENU_ITEM_COLUMNS = "id, name, description, price_cents, course, restaurant_id"
+# menu items of deleted restaurants are left out until the purge removes them, a primary key lookup per item
+LIVE_MENU_ITEM = ("EXISTS (SELECT 1 FROM restaurant WHERE restaurant.id = menu_item.restaurant_id "
+                  "AND restaurant.deleted_at IS NULL)")
+
+def _escaped_menu_item(row):
+    # Sanitize user-generated content by escaping special characters XSS fix
+    item = dict(zip(('id', 'name', 'description', 'price', 'course', 'restaurant_id'), row))
+    item['price'] = format_price(item['price'])
+    return dict((key, escape(value)) for key, value in item.items())
+
 # Used named parameter to prevent sqli (Parameterised query)
+# ?min_price=, ?max_price= and ?sort=price|-price are applied in the query
 @json.route('/restaurant/<int:restaurant_id>/menu/JSON')
 def restaurantMenuJSON(restaurant_id):
-    # Updated SQL query using named parameter
-    query = "SELECT * FROM menu_item WHERE restaurant_id = :restaurant_id"
+    price_filter = PriceFilter.from_args(request.args)
+    query = "SELECT %s FROM menu_item WHERE restaurant_id = :restaurant_id AND %s" % (MENU_ITEM_COLUMNS, LIVE_MENU_ITEM)
+    params = {'restaurant_id': restaurant_id}
+    if price_filter.min_cents is not None:
+        query += " AND price_cents >= :min_cents"
+        params['min_cents'] = price_filter.min_cents
+    if price_filter.max_cents is not None:
+        query += " AND price_cents <= :max_cents"
+        params['max_cents'] = price_filter.max_cents
+    if price_filter.sort:
+        query += " ORDER BY price_cents %s, id" % SORTS[price_filter.sort].upper()
     
     # Executing the query with named parameter
-    result = db.session.execute(text(query), {'restaurant_id': restaurant_id})
-    
-    # Sanitize user-generated content by escaping special characters XSS fix
-    items_list = [dict((key, escape(value)) for key, value in row.items()) for row in result]
+    result = db.session.execute(text(query), params)
+    items_list = [_escaped_menu_item(row) for row in result]
     
     # Returning JSON response using Flask's jsonify function
     return jsonify(items_list)
@@ -26,25 +49,145 @@ def restaurantMenuJSON(restaurant_id):
 @json.route('/restaurant/<restaurant_id>/menu/<int:menu_id>/JSON')
 def menuItemJSON(restaurant_id, menu_id):
     # Updated SQL query using named parameter
-    query = "SELECT * FROM menu_item WHERE id = :menu_id LIMIT 1"
+    query = "SELECT %s FROM menu_item WHERE id = :menu_id AND %s LIMIT 1" % (MENU_ITEM_COLUMNS, LIVE_MENU_ITEM)
     
     # Executing the query with named parameter
     result = db.session.execute(text(query), {'menu_id': menu_id})
-    
-    # Sanitize user-generated content by escaping special characters
-    items_list = [dict((key, escape(value)) for key, value in row.items()) for row in result]
+    items_list = [_escaped_menu_item(row) for row in result]
     
     # Returning JSON response using Flask's jsonify function
     return jsonify(items_list)
 
-# Used Endpoint to retrieve all restaurant data as JSON (No user input used)
+# Used Endpoint to retrieve restaurant data as JSON, a page at a time (No user input used in the query)
 @json.route('/restaurant/JSON')
 def restaurantsJSON():
-    # Retrieve all restaurant objects from the database
-    restaurants = Restaurant.query.all()
+    # Keyset pagination on (name, id), pass the next/prev cursor back as ?after= or ?before=
+    page = keyset_page(Restaurant.live(), [Restaurant.name, Restaurant.id],
+                       key=lambda restaurant: (restaurant.name, restaurant.id),
+                       after=request.args.get('after'), before=request.args.get('before'),
+                       limit=page_size(request.args.get('limit')))
+
+    # Return the page of restaurants along with the cursors for the neighbouring pages
+    return jsonify(restaurants=[restaurant.serialize for restaurant in page.items],
+                   next=page.next_cursor, prev=page.prev_cursor)
+
+
+# Best rated restaurants by bayesian score (see RatingSummary), ?limit= up to the usual page size cap
+@json.route('/restaurant/top/JSON')
+def topRestaurantsJSON():
+    top = RatingSummary.top(page_size(request.args.get('limit')))
+    return jsonify(restaurants=[{'id': restaurant.id, 'name': escape(restaurant.name), 'score': round(summary.score, 3),
+                                 'average': round(summary.average, 2), 'count': summary.count}
+                                for restaurant, summary in top])
+
+
+# A restaurant's rating histogram, count and mean plus one page of the ratings (?after=/?before= cursors)
+@json.route('/restaurant/<int:restaurant_id>/ratings/JSON')
+@login_required
+def restaurantRatingsJSON(restaurant_id):
+    restaurant = Restaurant.live_or_404(restaurant_id)
+    stats = Rating.histogram(restaurant.id)
+    page = Rating.page(restaurant.id, after=request.args.get('after'), before=request.args.get('before'),
+                       limit=page_size(request.args.get('limit')))
+    return jsonify(restaurant_id=restaurant.id, count=stats['count'], mean=stats['mean'],
+                   histogram=dict((str(value), count) for value, count in stats['histogram'].items()),
+                   ratings=[{'id': rating.id, 'username': escape(rating.username), 'rating': rating.rating}
+                            for rating in page.items],
+                   next=page.next_cursor, prev=page.prev_cursor)
+
+
+# Streaming exports for integrations that pull the whole catalogue.
+# Rows are written straight from the database cursor, so memory use doesn't grow with the number of rows.
+# ?format=ndjson gives one JSON object per line, anything else a (chunked) JSON array.
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_FETCH_SIZE = 500
+
+def _clean(value):
+    # Sanitize user-generated content by escaping special characters XSS fix
+    return escape(value) if isinstance(value, str) else value
+
+def _rows(query, params=None):
+    # stream_results asks the driver for a server side cursor where it has one
+    result = db.session.execute(text(query).execution_options(stream_results=True), params or {})
+    try:
+        while True:
+            rows = result.fetchmany(STREAM_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
+def _encode(records, ndjson):
+    # joins the encoded records into chunks of about STREAM_CHUNK_SIZE before sending them
+    buffer = []
+    size = 0
+    if not ndjson:
+        buffer.append('[')
+    first = True
+    for record in records:
+        encoded = pyjs.dumps(record)
+        if ndjson:
+            encoded += '\n'
+        elif not first:
+            encoded = ',' + encoded
+        first = False
+        buffer.append(encoded)
+        size += len(encoded)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if not ndjson:
+        buffer.append(']')
+    if buffer:
+        yield ''.join(buffer)
+
+def _stream_response(records):
+    ndjson = request.args.get('format') == 'ndjson'
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(stream_with_context(_encode(records, ndjson)), mimetype=mimetype)
+
+def _menu_item(row, offset=0):
+    return {
+        'id': row[offset],
+        'name': _clean(row[offset + 1]),
+        'description': _clean(row[offset + 2]),
+        'price': format_price(row[offset + 3]),
+        'course': _clean(row[offset + 4]),
+    }
+
+# Every restaurant, streamed (No user input used)
+@json.route('/restaurant/JSON/stream')
+def restaurantsStreamJSON():
+    rows = _rows("SELECT id, name FROM restaurant WHERE deleted_at IS NULL ORDER BY id")
+    return _stream_response({'id': row[0], 'name': _clean(row[1])} for row in rows)
+
+# Every menu item, streamed (No user input used)
+@json.route('/menu_item/JSON/stream')
+def menuItemsStreamJSON():
+    rows = _rows("SELECT %s FROM menu_item WHERE %s ORDER BY id" % (MENU_ITEM_COLUMNS, LIVE_MENU_ITEM))
+    return _stream_response(dict(_menu_item(row), restaurant_id=row[5]) for row in rows)
+
+# Every restaurant with its menu in a single pass over one ordered join (No user input used)
+@json.route('/restaurant/menus/JSON')
+def restaurantMenusJSON():
+    rows = _rows("SELECT r.id, r.name, m.id, m.name, m.description, m.price_cents, m.course "
+                 "FROM restaurant r LEFT JOIN menu_item m ON m.restaurant_id = r.id "
+                 "WHERE r.deleted_at IS NULL ORDER BY r.id, m.id")
 
-    # Convert each restaurant object to a dictionary representation
-    rest_list = [restaurant.to_dict() for restaurant in restaurants]
+    def restaurants():
+        # rows arrive grouped by restaurant, only the current restaurant's menu is held in memory
+        current = None
+        for row in rows:
+            if current is None or current['id'] != row[0]:
+                if current is not None:
+                    yield current
+                current = {'id': row[0], 'name': _clean(row[1]), 'menu_items': []}
+            if row[2] is not None:
+                current['menu_items'].append(_menu_item(row, offset=2))
+        if current is not None:
+            yield current
 
-    # Return the list of dictionaries as a JSON response
-    return jsonify(rest_list)
+    return _stream_response(restaurants())
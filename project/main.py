@@ -1,38 +1,60 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, session, abort
-from .models import Restaurant, MenuItem, User, SearchForm, Rating
+from flask import Blueprint, render_template, request, flash, redirect, url_for, session, abort, make_response, current_app, jsonify
+from .models import Restaurant, MenuItem, User, SearchForm, Rating, RatingSummary
+from .pagination import keyset_page, page_size
+from . import search as search_index
+from .cache import LRUCache
+from .audit import audit
+from .audit_index import AuditQuery, parse_ts
+from .user_cache import invalidate_user, user_cache
+from .metrics import metrics
+from .hashing import passwords
+from .prices import parse_price, PriceFilter, NO_FILTER
+from . import menu_upload
+from . import purge
+from .purge import purger
 from . import db
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, SelectField
 from wtforms.validators import DataRequired
 from flask_wtf.csrf import CSRFProtect
-from markupsafe import escape
+from markupsafe import escape, Markup
 from flask_login import login_user, login_required, logout_user, current_user
-from sqlalchemy import asc
+from sqlalchemy import asc, text
+from sqlalchemy.orm import joinedload
 import re
-import logging
-from werkzeug.serving import WSGIRequestHandler
+import time
+from collections import OrderedDict
+from itertools import groupby
+from datetime import datetime
 
 main = Blueprint('main', __name__)
 csrf = CSRFProtect()
 
-WSGIRequestHandler.log = lambda *args, **kwargs: None
-
-# Create a logger and set its level to the desired logging level
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-# Create a file handler and set its level to the desired logging level
-file_handler = logging.FileHandler('log_file.txt')
-file_handler.setLevel(logging.INFO)
-
-# Create a formatter for the log messages
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-
-# Set the formatter for the file handler
-file_handler.setFormatter(formatter)
-
-# Add the file handler to the logger
-logger.addHandler(file_handler)
+# rendered menu item lists for anonymous visitors, keyed by (restaurant id, version)
+# bounded by the total size of the cached html as well as the number of menus
+menu_cache = LRUCache(maxsize=1024, maxweight=16 * 1024 * 1024, weigh=len)
+
+
+def process_stats():
+    # audit log, cache and password pool numbers for /admin/metrics, summed over the worker processes
+    log = audit.stats()
+    samples = [
+        ('audit_log_records_total', 'counter', 'Audit records queued.', {}, log['calls']),
+        ('audit_log_dropped_total', 'counter', 'Audit records dropped because the queue was full.', {}, log['dropped']),
+        ('audit_log_queue_depth', 'gauge', 'Audit records waiting to be written.', {}, log['queue_depth']),
+        ('password_hash_rejected_total', 'counter', 'Logins and registrations turned away by a full hashing pool.', {},
+         passwords.rejected),
+    ]
+    for name, cache in (('users', user_cache), ('search', search_index.search_cache), ('menus', menu_cache)):
+        stats = cache.stats()
+        samples += [
+            ('cache_hits_total', 'counter', 'Cache hits.', {'cache': name}, stats['hits']),
+            ('cache_misses_total', 'counter', 'Cache misses.', {'cache': name}, stats['misses']),
+            ('cache_entries', 'gauge', 'Entries currently cached.', {'cache': name}, stats['size']),
+        ]
+    return samples
+
+metrics.add_collector(process_stats)
 
 #input sanitisation code to prevent injection sequences 
 def sanitise_input(input_string):
@@ -44,21 +66,35 @@ def base():
     form = SearchForm()
     return dict(form=form)
 
+# make sure the full text search index exists before any view starts writing to it
+@main.before_app_request
+def prepare_search():
+    search_index.fts_available()
+
 
 # view all restaurants function
 @main.route('/')
 @main.route('/restaurant/')
 def showRestaurants():
-    restaurants = Restaurant.query.order_by(Restaurant.name.asc())
+    # Average ratings come from the summary table in the same query as the restaurants
+    restaurants = db.session.query(Restaurant, RatingSummary.average) \
+        .outerjoin(RatingSummary, RatingSummary.restaurant_id == Restaurant.id) \
+        .filter(Restaurant.deleted_at.is_(None))
+
+    # Keyset pagination on (name, id) so later pages cost the same as the first
+    page = keyset_page(restaurants, [Restaurant.name, Restaurant.id],
+                       key=lambda row: (row[0].name, row[0].id),
+                       after=request.args.get('after'), before=request.args.get('before'),
+                       limit=page_size(request.args.get('limit')))
 
-    # Calculate average ratings for each restaurant
-    average_ratings = {}
-    for restaurant in restaurants:
-        ratings = Rating.query.filter_by(restaurant_id=restaurant.id).all()
-        average_rating = sum(rating.rating for rating in ratings) / len(ratings) if ratings else 0
-        average_ratings[restaurant.id] = average_rating
+    return render_template('restaurants.html', restaurants=page.items, page=page)
 
-    return render_template('restaurants.html', restaurants=restaurants, average_ratings=average_ratings, ratings=ratings)
+
+# Best rated restaurants by their bayesian score, a read off the rating_summary score index
+@main.route('/restaurant/top')
+def topRestaurants():
+    limit = page_size(request.args.get('limit'))
+    return render_template('top_restaurants.html', restaurants=RatingSummary.top(limit))
 
 
 
@@ -70,13 +106,16 @@ def newRestaurant():
     if request.method == 'POST':
         newRestaurant = Restaurant(name=sanitise_input(request.form['name']), ownerid=current_user.id)  #input sanitise 
         db.session.add(newRestaurant)
+        db.session.flush()
+        search_index.index_restaurant(newRestaurant)
         db.session.commit()
 
         if current_user.role != 'admin':
             current_user.role = 'owner'
             db.session.commit()
+            invalidate_user(current_user.id)
 
-        logger.info('Restaurant created by %s (ID: %s): %s' % (current_user.username, current_user.id, newRestaurant.name)) # secure logging
+        audit.record('restaurant.create', target=newRestaurant.id, name=newRestaurant.name) # secure logging
 
         flash('Hi %s, You\'ve successfully created the New Restaurant %s' % (current_user.username, newRestaurant.name))
         return redirect(url_for('main.showRestaurants'))
@@ -88,8 +127,7 @@ def newRestaurant():
 @main.route('/restaurant/<int:restaurant_id>/edit/', methods=['GET', 'POST'])
 @login_required
 def editRestaurant(restaurant_id):
-    editedRestaurant = db.session.query(Restaurant).filter_by(id=restaurant_id).one()
-    items = db.session.query(MenuItem).filter_by(restaurant_id = restaurant_id).all()
+    editedRestaurant = Restaurant.live_or_404(restaurant_id)
     if editedRestaurant.ownerid == current_user.id or current_user.role == 'admin':
         if request.method == 'POST':
             if request.form['name']:
@@ -97,47 +135,101 @@ def editRestaurant(restaurant_id):
                 editedRestaurant.name = escape(request.form['name']) #input sanitise
                 print("New Name:", editedRestaurant.name)
                 flash('Restaurant Successfully Edited %s' % editedRestaurant.name)
+                search_index.index_restaurant(editedRestaurant)
+                Restaurant.bump_version(restaurant_id)
                 
-                logger.info('Restaurant edited by %s (ID: %s): %s' % (current_user.username, current_user.id, editedRestaurant.name))
+                audit.record('restaurant.edit', target=editedRestaurant.id, name=editedRestaurant.name)
                 db.session.commit()
                 return redirect(url_for('main.showRestaurants'))
         else:
             return render_template('editRestaurant.html', restaurant=editedRestaurant)
         
     else: 
-        logger.info('Failed attempt to edit restaurant by %s (ID: %s): %s' % (current_user.username, current_user.id, editedRestaurant.name)) # secure logging
+        audit.record('restaurant.edit.denied', target=editedRestaurant.id) # secure logging
         flash('Sorry  %s You do not have permission to delete  %s' % (current_user.username, editedRestaurant.name))
-        return render_template('menu.html',items =items, restaurant = editedRestaurant)
+        return render_menu(editedRestaurant)
 
 @main.route('/restaurant/<int:restaurant_id>/delete/', methods=['GET', 'POST'])
 @login_required
 def deleteRestaurant(restaurant_id):
-    restaurantToDelete = db.session.query(Restaurant).filter_by(id=restaurant_id).one()
-    items = db.session.query(MenuItem).filter_by(restaurant_id = restaurant_id).all()
+    restaurantToDelete = Restaurant.live_or_404(restaurant_id)
     #Access Control checks for deletion 
     if restaurantToDelete.ownerid == current_user.id or current_user.role == 'admin': 
         if request.method == 'POST':
             if 'delete' in request.form:
-                db.session.delete(restaurantToDelete)
+                delete_restaurants([restaurant_id]) # the menu and ratings are purged in the background
                 flash('%s Successfully Deleted' % restaurantToDelete.name)
-                logger.info('Restaurant deleted by %s (ID: %s): %s' % (current_user.username, current_user.id, restaurant_id)) # secure logging
-                db.session.commit()               
+                audit.record('restaurant.delete', target=restaurant_id) # secure logging
+                db.session.commit()
+                purger.wake()               
             return redirect(url_for('main.showRestaurants'))
         else:
             return render_template('deleteRestaurant.html', restaurant=restaurantToDelete)
     else: 
-        logger.info('Failed attempt to delete restaurant by %s (ID: %s): %s' % (current_user.username, current_user.id, restaurant_id)) # secure logging
+        audit.record('restaurant.delete.denied', target=restaurant_id) # secure logging
         flash('Sorry  %s You do not have permission to delete  %s' % (current_user.username, restaurantToDelete.name))
-        return render_template('menu.html',items =items, restaurant = restaurantToDelete)
+        return render_menu(restaurantToDelete)
     
 
 
+# Group items that arrive ordered by course into {course: [items]} in a single pass
+def group_courses(items):
+    courses = OrderedDict()
+    for course, course_items in groupby(items, key=lambda item: item.course or 'Other'):
+        courses.setdefault(course, []).extend(course_items)
+    return courses
+
+# Render a restaurant's menu page, anonymous views reuse the cached item list
+# price_filter (?min_price=, ?max_price=, ?sort=price|-price) is applied in SQL
+def render_menu(restaurant, price_filter=NO_FILTER):
+    anonymous = not current_user.is_authenticated
+    key = (restaurant.id, restaurant.version, price_filter)
+    menu_items = menu_cache.get(key) if anonymous else None
+    if menu_items is None:
+        # ordered by course, then price when sorting by price, then name, so one pass can group them
+        query = db.session.query(MenuItem).filter_by(restaurant_id=restaurant.id).order_by(*MenuItem.course_order())
+        items = price_filter.apply(query, MenuItem.price_cents).order_by(MenuItem.name, MenuItem.id).all()
+        menu_items = Markup(render_template('menu_items.html', courses=group_courses(items), restaurant=restaurant))
+        if anonymous:
+            menu_cache.set(key, menu_items)
+    return render_template('menu.html', restaurant=restaurant, menu_items=menu_items, price_filter=price_filter)
+
+# ETag / Last-Modified for a menu page. The page only changes with the restaurant version,
+# the viewer (edit links) and the csrf token in the search form, which is reissued every half token lifetime
+def menu_validators(restaurant, price_filter=NO_FILTER):
+    window = max(int(current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) // 2, 1)
+    window_index = int(time.time()) // window
+    viewer = current_user.get_id() if current_user.is_authenticated else 'anon'
+    etag = 'menu-%s-%s-%s-%s' % (restaurant.id, restaurant.version, viewer, window_index)
+    if price_filter.active:
+        etag += '-%s-%s-%s' % price_filter
+    last_modified = max(restaurant.updated_at, datetime.utcfromtimestamp(window_index * window))
+    return etag, last_modified.replace(microsecond=0)
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return last_modified <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
 # Show a restaurant menu
 @main.route('/restaurant/<int:restaurant_id>/menu', methods=['GET'])
 def showMenu(restaurant_id):
-    restaurant = db.session.query(Restaurant).filter_by(id=restaurant_id).one()
-    items = db.session.query(MenuItem).filter_by(restaurant_id=restaurant_id).all()
-    return render_template('menu.html', items=items, restaurant=restaurant)
+    restaurant = Restaurant.live_or_404(restaurant_id)
+    price_filter = PriceFilter.from_args(request.args)
+    etag, last_modified = menu_validators(restaurant, price_filter)
+
+    # pending flash messages have to be rendered, so they always get a full response
+    if not session.get('_flashes') and not_modified(etag, last_modified):
+        response = make_response('', 304)
+    else:
+        response = make_response(render_menu(restaurant, price_filter))
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 
 
@@ -145,91 +237,247 @@ def showMenu(restaurant_id):
 @main.route('/restaurant/<int:restaurant_id>/menu/new/',methods=['GET','POST'])
 @login_required
 def newMenuItem(restaurant_id):
-  restaurant = db.session.query(Restaurant).filter_by(id = restaurant_id).one()
-  items = db.session.query(MenuItem).filter_by(restaurant_id = restaurant_id).all()
+  restaurant = Restaurant.live_or_404(restaurant_id)
   #Access Control checks
   if restaurant.ownerid == current_user.id or current_user.role == 'admin':
     if request.method == 'POST':
+        #prices are stored as cents, anything that isn't a price is turned away
+        try:
+            price_cents = parse_price(request.form['price'])
+        except ValueError:
+            flash('Please enter a price like 2.99')
+            return render_template('newmenuitem.html', restaurant_id = restaurant_id)
         #implemented input sanitsation again
-        newItem = MenuItem(name = escape(request.form['name']), description = sanitise_input(request.form['description']), price = "$"+escape(request.form['price']), course = escape(request.form['course']), restaurant_id = restaurant_id)
+        newItem = MenuItem(name = escape(request.form['name']), description = sanitise_input(request.form['description']), price_cents = price_cents, course = escape(request.form['course']), restaurant_id = restaurant_id)
         db.session.add(newItem)
-        logger.info('Menu Item created by %s (ID: %s): %s' % (current_user.username, current_user.id, newItem.name)) # secure logging
+        db.session.flush()
+        search_index.index_menu_item(newItem)
+        Restaurant.bump_version(restaurant_id)
+        audit.record('menu_item.create', target=newItem.id, restaurant_id=restaurant_id, name=newItem.name) # secure logging
         db.session.commit()
         flash('New Menu %s Item Successfully Created' % (newItem.name))
         return redirect(url_for('main.showMenu', restaurant_id = restaurant_id))
     else:
         return render_template('newmenuitem.html', restaurant_id = restaurant_id)
   else: 
-      logger.info('Failed attempt to create menu item  by %s (ID: %s): %s' % (current_user.username, current_user.id, '')) # secure logging
+      audit.record('menu_item.create.denied', restaurant_id=restaurant_id) # secure logging
       flash('Sorry  %s You do not have permission to add a menu item to  %s' % (current_user.username, restaurant.name))
-      return render_template('menu.html',items =items, restaurant = restaurant)
+      return render_menu(restaurant)
 
 #Edit a menu item
 @main.route('/restaurant/<int:restaurant_id>/menu/<int:menu_id>/edit', methods=['GET','POST'])
 @login_required
 def editMenuItem(restaurant_id, menu_id):
-    items = db.session.query(MenuItem).filter_by(restaurant_id = restaurant_id).all()
-    editedItem = db.session.query(MenuItem).filter_by(id = menu_id).one()
-    restaurant = db.session.query(Restaurant).filter_by(id = restaurant_id).one()
+    restaurant = Restaurant.live_or_404(restaurant_id)
+    editedItem = MenuItem.query.filter_by(id = menu_id, restaurant_id = restaurant.id).first_or_404()
     #Access Control checks
     if restaurant.ownerid == current_user.id or current_user.role == 'admin':
         if request.method == 'POST':
+            #prices are stored as cents, check it before changing anything
+            try:
+                price_cents = parse_price(request.form['price']) if request.form['price'] else None
+            except ValueError:
+                flash('Please enter a price like 2.99')
+                return render_template('editmenuitem.html', restaurant_id = restaurant_id, menu_id = menu_id, item = editedItem)
             #implemented input sanitsation again
             if request.form['name']:
                 editedItem.name = escape(request.form['name'])
-                logger.info('Menu item name edited by %s (ID: %s): %s' % (current_user.username, current_user.id, editedItem.name)) # secure logging
+                audit.record('menu_item.edit', target=editedItem.id, field='name', value=editedItem.name) # secure logging
             if request.form['description']:
                 editedItem.description = sanitise_input(request.form['description']) # no special characters needed so used custom function to keep it alpha numeric
-                logger.info('Menu item description edited by %s (ID: %s): %s' % (current_user.username, current_user.id, editedItem.description)) # secure logging
-            if request.form['price']:
-                editedItem.price = escape(request.form['price'])
-                logger.info('Menu item price edited by %s (ID: %s): %s' % (current_user.username, current_user.id, editedItem.price))# secure logging
+                audit.record('menu_item.edit', target=editedItem.id, field='description', value=editedItem.description) # secure logging
+            if price_cents is not None:
+                editedItem.price_cents = price_cents
+                audit.record('menu_item.edit', target=editedItem.id, field='price', value=editedItem.price) # secure logging
             if request.form['course']:
                 editedItem.course = escape(request.form['course'])
-                logger.info('Menu item course edited by %s (ID: %s): %s' % (current_user.username, current_user.id, editedItem.course))# secure logging
+                audit.record('menu_item.edit', target=editedItem.id, field='course', value=editedItem.course) # secure logging
             db.session.add(editedItem)
+            search_index.index_menu_item(editedItem)
+            Restaurant.bump_version(restaurant_id)
             db.session.commit() 
             flash('Menu Item Successfully Edited')
             return redirect(url_for('main.showMenu', restaurant_id = restaurant_id))
         else:
             return render_template('editmenuitem.html', restaurant_id = restaurant_id, menu_id = menu_id, item = editedItem) # secure logging
     else: 
-        logger.info('Failed attempt to edit menu item  by %s (ID: %s): %s' % (current_user.username, current_user.id, '')) # secure logging
+        audit.record('menu_item.edit.denied', target=menu_id, restaurant_id=restaurant_id) # secure logging
         flash('Sorry  %s You do not have permission to edit a menu item in   %s' % (current_user.username, restaurant.name))
-        return render_template('menu.html',items =items, restaurant = restaurant)
+        return render_menu(restaurant)
 
 #Delete a menu item
 @main.route('/restaurant/<int:restaurant_id>/menu/<int:menu_id>/delete', methods=['GET', 'POST'])
 @login_required
 def deleteMenuItem(restaurant_id, menu_id):
-    restaurant = db.session.query(Restaurant).filter_by(id=restaurant_id).one()
-    itemToDelete = db.session.query(MenuItem).filter_by(id=menu_id).one()
-    items = db.session.query(MenuItem).filter_by(restaurant_id = restaurant_id).all()
+    restaurant = Restaurant.live_or_404(restaurant_id)
+    itemToDelete = MenuItem.query.filter_by(id=menu_id, restaurant_id=restaurant.id).first_or_404()
     if restaurant.ownerid == current_user.id or current_user.role == 'admin':
     
         if request.method == 'POST':
             if 'delete' in request.form:
+                search_index.remove_menu_item(itemToDelete.id)
+                Restaurant.bump_version(restaurant_id)
                 db.session.delete(itemToDelete)
-                logger.info('Menu item deleted by %s (ID: %s): %s' % (current_user.username, current_user.id, itemToDelete.name)) # secure logging
+                audit.record('menu_item.delete', target=menu_id, restaurant_id=restaurant_id, name=itemToDelete.name) # secure logging
                 db.session.commit()
                 flash('Menu Item Successfully Deleted')
             return redirect(url_for('main.showMenu', restaurant_id=restaurant_id))
         return render_template('deleteMenuItem.html', item=itemToDelete, restaurant=restaurant)
     else: 
-        logger.info('Failed attempt to delete menu item by %s (ID: %s): %s' % (current_user.username, current_user.id, itemToDelete.name)) # secure logging
+        audit.record('menu_item.delete.denied', target=menu_id, restaurant_id=restaurant_id) # secure logging
         flash('Sorry  %s You do not have permission to delete a menu item in  %s' % (current_user.username, restaurant.name))
-        return render_template('menu.html',items =items, restaurant = restaurant)
+        return render_menu(restaurant)
     
+#Replace a whole menu from a CSV/JSON document (see menu_upload.py), one permission check and one commit
+#A form upload flashes the summary, a raw application/json or text/csv body gets it back as JSON.
+#?dry_run=1 only reports what would change.
+@main.route('/restaurant/<int:restaurant_id>/menu/upload', methods=['GET', 'POST'])
+@login_required
+def uploadMenu(restaurant_id):
+    restaurant = Restaurant.live_or_404(restaurant_id)
+    api = request.method == 'POST' and request.mimetype in ('application/json', 'text/csv')
+    #Access Control checks
+    if not (restaurant.ownerid == current_user.id or current_user.role == 'admin'):
+        audit.record('menu.upload.denied', restaurant_id=restaurant_id) # secure logging
+        if api:
+            return jsonify(errors=['you do not have permission to change this menu']), 403
+        flash('Sorry  %s You do not have permission to change the menu of  %s' % (current_user.username, restaurant.name))
+        return render_menu(restaurant)
+    if request.method == 'GET':
+        return render_template('uploadmenu.html', restaurant=restaurant)
+
+    dry_run = request.values.get('dry_run') in ('1', 'true', 'on')
+    try:
+        if api:
+            rows = menu_upload.read_document(request.get_data(), content_type=request.content_type)
+        else:
+            upload = request.files.get('menu')
+            if not upload or not upload.filename:
+                raise menu_upload.UploadError(['please choose a menu file to upload'])
+            rows = menu_upload.read_document(upload.read(), content_type=upload.mimetype, filename=upload.filename)
+        changes = menu_upload.plan(restaurant_id, menu_upload.clean_rows(rows, escape, sanitise_input))
+    except menu_upload.UploadError as e:
+        db.session.rollback()
+        if api:
+            return jsonify(errors=e.errors), 400
+        for error in e.errors[:20]:
+            flash(error)
+        return render_template('uploadmenu.html', restaurant=restaurant)
+
+    if not dry_run:
+        menu_upload.apply(restaurant_id, changes)
+        audit.record('menu.upload', target=restaurant_id, created=len(changes.created), # secure logging
+                     updated=len(changes.updated), deleted=len(changes.deleted))
+        db.session.commit()
+    result = menu_upload.summary(restaurant_id, changes, dry_run=dry_run)
+    if api:
+        return jsonify(result)
+    flash('%s%d items added, %d changed, %d removed, %d unchanged'
+          % ('Dry run: ' if dry_run else '', len(result['created']), len(result['updated']),
+             len(result['deleted']), result['unchanged']))
+    if dry_run:
+        return render_template('uploadmenu.html', restaurant=restaurant)
+    return redirect(url_for('main.showMenu', restaurant_id=restaurant_id))
+
 class EditUserForm(FlaskForm):
         role = SelectField('Role', choices=[('owner', 'Owner'), ('admin', 'Admin'), ('public', 'Public User')], validators=[DataRequired()])
 
+# owner choices are filled in by the view, one page of users at a time
 class EditRestaurantOwnerForm(FlaskForm):
     ownerid = SelectField('Owner', coerce=int, validators=[DataRequired()])
     submit = SubmitField('Update Owner')
 
-    def __init__(self, *args, **kwargs):
-        super(EditRestaurantOwnerForm, self).__init__(*args, **kwargs)
-        self.ownerid.choices = [(user.id, user.username) for user in User.query.all()]
+# case sensitive prefix match written as a range so it can use the column's index (LIKE can't in SQLite)
+def starts_with(column, value):
+    return (column >= value) & (column < value + u'\U0010ffff')
+
+# one page of users ordered by id, optionally filtered on a username prefix
+def user_page(query_text, after, before, limit=None):
+    users = User.live()
+    if query_text:
+        users = users.filter(starts_with(User.username, query_text))
+    return keyset_page(users, [User.id], key=lambda user: (user.id,), after=after, before=before,
+                       limit=limit or page_size(None))
+
+
+# Deletes only mark the rows and queue a purge (see purge.py), reassigning is a single UPDATE.
+# Shared by the single and bulk admin actions, all inside the caller's transaction.
+delete_restaurants = purge.delete_restaurants
+delete_users = purge.delete_users
+
+def reassign_restaurants(restaurant_ids, owner_id):
+    return Restaurant.live().filter(Restaurant.id.in_(restaurant_ids)).update({
+        Restaurant.ownerid: owner_id,
+        Restaurant.version: Restaurant.version + 1, # the menu page's edit links depend on the owner
+        Restaurant.updated_at: datetime.utcnow(),
+    }, synchronize_session=False)
+
+# ids ticked in an admin table, anything that isn't a number is ignored
+def selected_ids(name):
+    ids = set()
+    for value in request.form.getlist(name):
+        if value.isdigit():
+            ids.add(int(value))
+    return sorted(ids)
+
+#admin panel bulk user actions (delete the ticked users)
+@main.route('/admin/users/bulk', methods=['POST'])
+@login_required
+def bulk_users():
+    #Access Control checks
+    if current_user.role != 'admin':
+        audit.record('user.bulk.denied') # secure logging
+        flash('Sorry, %s. You do not have permission to delete users.' % current_user.username, 'error')
+        return redirect(url_for('main.showRestaurants'))
+
+    #admin account can't be deleted
+    user_ids = selected_ids('user_ids')
+    deleted = delete_users(user_ids) if request.form.get('action') == 'delete' else 0
+    if not deleted:
+        flash('Please tick the users to delete.', 'warning')
+        return redirect(url_for('main.admin'))
+
+    audit.record('user.bulk_delete', count=deleted, targets=user_ids) # secure logging
+    db.session.commit()
+    purger.wake()
+    for user_id in user_ids:
+        invalidate_user(user_id)
+    flash('%d users have been deleted successfully.' % deleted, 'success')
+    return redirect(url_for('main.admin'))
+
+#admin panel bulk restaurant actions (delete the ticked restaurants or give them a new owner)
+@main.route('/admin/restaurants/bulk', methods=['POST'])
+@login_required
+def bulk_restaurants():
+    #Access Control checks
+    if current_user.role != 'admin':
+        audit.record('restaurant.bulk.denied') # secure logging
+        flash('Sorry, %s. You do not have permission to change restaurants.' % current_user.username, 'error')
+        return redirect(url_for('main.admin'))
+
+    restaurant_ids = selected_ids('restaurant_ids')
+    action = request.form.get('action')
+    if action not in ('delete', 'reassign') or not restaurant_ids:
+        flash('Please tick the restaurants to change.', 'warning')
+        return redirect(url_for('main.admin'))
+
+    if action == 'delete':
+        deleted = delete_restaurants(restaurant_ids)
+        audit.record('restaurant.bulk_delete', count=deleted, targets=restaurant_ids) # secure logging
+        db.session.commit()
+        purger.wake()
+        flash('%d restaurants have been deleted successfully.' % deleted, 'success')
+        return redirect(url_for('main.admin'))
+
+    owner = User.live().filter_by(username=request.form.get('owner', '').strip()).first()
+    if owner is None:
+        flash('Invalid user selected.', 'error')
+        return redirect(url_for('main.admin'))
+    updated = reassign_restaurants(restaurant_ids, owner.id)
+    audit.record('restaurant.bulk_owner_update', count=updated, targets=restaurant_ids, owner_id=owner.id) # secure logging
+    db.session.commit()
+    flash('%d restaurants now belong to %s.' % (updated, owner.username), 'success')
+    return redirect(url_for('main.admin'))
 
 
 #start of admin panel 
@@ -238,14 +486,114 @@ class EditRestaurantOwnerForm(FlaskForm):
 def admin():
     #Access Control checks
     if current_user.role != 'admin':
-        logger.info('Failed attempt to access admin panel by %s (ID: %s): %s' % (current_user.username, current_user.id, '')) # secure logging
+        audit.record('admin.denied') # secure logging
+        flash('Sorry, %s. You do not have permission to access this part of the website.' % current_user.username, 'error')
+        return redirect(url_for('main.showRestaurants'))
+
+    # both tables are paged and filtered in the database, restaurants come with their owner joined in
+    user_q = request.args.get('user_q', '').strip()
+    users = user_page(user_q, request.args.get('user_after'), request.args.get('user_before'))
+
+    restaurant_q = request.args.get('restaurant_q', '').strip()
+    restaurants = Restaurant.live().options(joinedload(Restaurant.user))
+    if restaurant_q:
+        restaurants = restaurants.filter(starts_with(Restaurant.name, restaurant_q))
+    restaurants = keyset_page(restaurants, [Restaurant.name, Restaurant.id],
+                              key=lambda restaurant: (restaurant.name, restaurant.id),
+                              after=request.args.get('restaurant_after'), before=request.args.get('restaurant_before'),
+                              limit=page_size(None))
+
+    # deleted restaurants and users still being purged, and the last few finished
+    purges = purge.recent_jobs()
+
+    return render_template('admin.html', users=users, restaurants=restaurants, user_q=user_q, restaurant_q=restaurant_q,
+                           purges=purges)
+
+# Audit log filters from the query string, user can be an id or a username.
+# Dates are ISO format, a plain date as the end of the range includes that whole day
+def audit_filters():
+    user = request.args.get('user', '').strip()
+    user_id = None
+    if user:
+        if user.isdigit():
+            user_id = int(user)
+        else:
+            # deleted users' history stays searchable
+            found = User.query.filter_by(username=user).first()
+            user_id = found.id if found else -1
+    end = request.args.get('to', '').strip()
+    end_ts = parse_ts(end)
+    if end_ts is not None and len(end) == 10:
+        end_ts += 24 * 60 * 60 - 1
+    return {
+        'user_id': user_id,
+        'action': request.args.get('action', '').strip() or None,
+        'target': request.args.get('target', '').strip() or None,
+        'start': parse_ts(request.args.get('from')),
+        'end': end_ts,
+        'limit': page_size(request.args.get('limit')),
+    }
+
+def search_audit_log():
+    return AuditQuery(current_app.config['AUDIT_LOG_FILE']).search(**audit_filters())
+
+#admin audit log search page
+@main.route('/admin/audit')
+@login_required
+def admin_audit():
+    #Access Control checks
+    if current_user.role != 'admin':
+        audit.record('admin.audit.denied') # secure logging
         flash('Sorry, %s. You do not have permission to access this part of the website.' % current_user.username, 'error')
         return redirect(url_for('main.showRestaurants'))
 
-    users = User.query.all()
-    restaurants = Restaurant.query.all()
+    try:
+        entries = search_audit_log()
+    except ValueError:
+        flash('Please enter dates as YYYY-MM-DD or YYYY-MM-DDTHH:MM.', 'error')
+        entries = []
+    return render_template('audit.html', entries=entries, filters=request.args)
+
+#admin audit log search API, same filters as the page
+@main.route('/admin/audit/JSON')
+@login_required
+def admin_audit_json():
+    #Access Control checks
+    if current_user.role != 'admin':
+        audit.record('admin.audit.denied') # secure logging
+        abort(403)
+
+    try:
+        entries = search_audit_log()
+    except ValueError:
+        abort(400)
+    return jsonify(entries=entries)
 
-    return render_template('admin.html', Users=users, restaurants=restaurants, User=User)
+#hit/miss counters for the in-process caches
+@main.route('/admin/cache/JSON')
+@login_required
+def admin_cache_json():
+    #Access Control checks
+    if current_user.role != 'admin':
+        audit.record('admin.cache.denied') # secure logging
+        abort(403)
+
+    return jsonify(users=user_cache.stats(), search=search_index.search_cache.stats(), menus=menu_cache.stats())
+
+
+#request latency, status and in flight counts for every worker, in prometheus text format
+@main.route('/admin/metrics')
+@login_required
+def admin_metrics():
+    #Access Control checks
+    if current_user.role != 'admin':
+        audit.record('admin.metrics.denied') # secure logging
+        abort(403)
+
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
    
 
 
@@ -257,14 +605,14 @@ def admin():
 def edit_user(user_id):
     #Access Control checks
     if current_user.role != 'admin':
-        logger.info('Failed attempt to edit user roles by %s (ID: %s): %s' % (current_user.username, current_user.id, '')) # secure logging
+        audit.record('user.edit.denied', target=user_id) # secure logging
         flash('Sorry, %s. You do not have permission to edit user roles.' % current_user.username, 'error')
         return redirect(url_for('main.showRestaurants'))
     
 
-    user = User.query.get_or_404(user_id)
+    user = User.live().filter(User.id == user_id).first_or_404()
     if user.username == 'admin':
-        logger.info('Failed attempt to edit admin user by %s (ID: %s): %s' % (current_user.username, current_user.id, '')) # secure logging
+        audit.record('user.edit.denied', target=user_id, reason='admin account') # secure logging
         flash('Sorry, you cannot edit the role of the admin user.', 'error')
         return redirect(url_for('main.admin'))
     
@@ -272,8 +620,9 @@ def edit_user(user_id):
 
     if form.validate_on_submit():
         user.role = form.role.data
-        logger.info('user role updated by %s (ID: %s): %s' % (current_user.username, current_user.id, user.id))
+        audit.record('user.role.update', target=user.id, role=user.role)
         db.session.commit()
+        invalidate_user(user.id)
         flash('User role has been updated successfully.', 'success')
         return redirect(url_for('main.admin'))
 
@@ -286,27 +635,23 @@ def delete_user(user_id):
     #Access Control checks
     
     if current_user.role != 'admin':
-        logger.info('Failed attempt to delete user by %s (ID: %s): %s' % (current_user.username, current_user.id, '')) # secure logging
+        audit.record('user.delete.denied', target=user_id) # secure logging
         flash('Sorry, %s. You do not have permission to delete users.' % current_user.username, 'error')
         return redirect(url_for('main.showRestaurants'))
     
-    user = User.query.get_or_404(user_id)
+    user = User.live().filter(User.id == user_id).first_or_404()
     #admin account can't be deleted
     if user.username == 'admin':
-        logger.info('Failed attempt to delete admin user by %s (ID: %s): %s' % (current_user.username, current_user.id, '')) # secure logging
+        audit.record('user.delete.denied', target=user_id, reason='admin account') # secure logging
         flash('Sorry, you cannot delete the admin user.', 'error')
         return redirect(url_for('main.admin'))
     
-    # Update owner IDs of associated restaurants to the admin account
-    restaurants = Restaurant.query.filter_by(ownerid=user.id).all()
-    admin_user = User.query.filter_by(username='admin').first()
-
-    for restaurant in restaurants:
-        restaurant.ownerid = admin_user.id
-
-    db.session.delete(user)
-    logger.info('user deleted by %s (ID: %s): %s' % (current_user.username, current_user.id, user.id))
+    # restaurants go to the admin account now, the user and their ratings are purged in the background
+    delete_users([user.id])
+    audit.record('user.delete', target=user_id)
     db.session.commit()
+    invalidate_user(user_id)
+    purger.wake()
     flash('User has been deleted successfully.', 'success')
     return redirect(url_for('main.admin'))
 
@@ -316,31 +661,45 @@ def delete_user(user_id):
 def edit_restaurant_owner(restaurant_id):
     #Access Control checks
     if current_user.role != 'admin':
-        logger.info('Failed attempt to edit restaurant owner by %s (ID: %s): %s' % (current_user.username, current_user.id, '')) # secure logging
+        audit.record('restaurant.owner.denied', target=restaurant_id) # secure logging
         flash('Sorry, %s. You do not have permission to edit restaurant owners.' % current_user.username, 'error')
         return redirect(url_for('main.admin'))
 
-    restaurant = Restaurant.query.get_or_404(restaurant_id)
+    restaurant = Restaurant.live().options(joinedload(Restaurant.user)).filter(Restaurant.id == restaurant_id).first_or_404()
     form = EditRestaurantOwnerForm()
 
+    owner_q = request.args.get('owner_q', '').strip()
+    owners = None
+    if request.method == 'POST':
+        # only the submitted user needs to be a valid choice
+        new_owner = User.live().filter(User.id == form.ownerid.data).first() if form.ownerid.data else None
+        form.ownerid.choices = [(new_owner.id, new_owner.username)] if new_owner else []
+    else:
+        # the current owner plus one page of users matching the search box
+        owners = user_page(owner_q, request.args.get('after'), request.args.get('before'))
+        form.ownerid.choices = [(restaurant.user.id, restaurant.user.username)] + \
+            [(user.id, user.username) for user in owners if user.id != restaurant.ownerid]
+        form.ownerid.data = restaurant.ownerid
+
     if form.validate_on_submit():
         new_owner_id = form.ownerid.data
 
         if new_owner_id == restaurant.ownerid:
             flash('The selected user is already the owner of this restaurant.', 'warning')
         else:
-            new_owner = User.query.get(new_owner_id)
+            new_owner = User.live().filter(User.id == new_owner_id).first()
             if not new_owner:
                 flash('Invalid user selected.', 'error')
             else:
                 restaurant.ownerid = new_owner_id
-                logger.info('Restaurant owner updated by %s (ID: %s): %s' % (current_user.username, current_user.id, new_owner_id)) # secure logging
+                Restaurant.bump_version(restaurant_id)
+                audit.record('restaurant.owner.update', target=restaurant_id, owner_id=new_owner_id) # secure logging
                 db.session.commit()
                 flash('Restaurant owner has been updated successfully.', 'success')
 
         return redirect(url_for('main.admin'))
 
-    return render_template('editrestaurantowner.html', form=form, restaurant=restaurant)
+    return render_template('editrestaurantowner.html', form=form, restaurant=restaurant, owners=owners, owner_q=owner_q)
 
 #easier to make new function to delete a restaurant on admin side
 @main.route('/admin/delete-restaurant/<int:restaurant_id>', methods=['POST'])
@@ -348,15 +707,17 @@ def edit_restaurant_owner(restaurant_id):
 def delete_restaurant(restaurant_id):
     #Access Control checks
     if current_user.role != 'admin':
-        logger.info('Failed attempt to delete restaurant by %s (ID: %s): %s' % (current_user.username, current_user.id, '')) # secure logging
+        audit.record('restaurant.delete.denied', target=restaurant_id) # secure logging
         flash('Sorry, %s. You do not have permission to delete restaurants.' % current_user.username, 'error')
         return redirect(url_for('main.admin'))
 
-    restaurant = Restaurant.query.get_or_404(restaurant_id)
-    db.session.delete(restaurant)
-    logger.info('Restaurant deleted by %s (ID: %s): %s' % (current_user.username, current_user.id, '')) # secure logging
+    restaurant = Restaurant.live_or_404(restaurant_id)
+    name = restaurant.name
+    delete_restaurants([restaurant_id])
+    audit.record('restaurant.delete', target=restaurant_id) # secure logging
     db.session.commit()
-    flash('Restaurant %s has been deleted successfully.' % restaurant.name, 'success')
+    purger.wake()
+    flash('Restaurant %s has been deleted successfully.' % name, 'success')
     return redirect(url_for('main.admin'))
 
 #rating form can only be 5 options 
@@ -370,8 +731,7 @@ class RatingForm(FlaskForm):
 @main.route('/restaurant/<int:restaurant_id>/ratings', methods=['GET', 'POST'])
 @login_required
 def showRatings(restaurant_id):
-    restaurant = db.session.query(Restaurant).filter_by(id=restaurant_id).one()
-    ratings = Rating.query.filter_by(restaurant_id=restaurant_id).all()
+    restaurant = Restaurant.live_or_404(restaurant_id)
 
     # Check if the user has already rated the restaurant
     user_rating = Rating.query.filter_by(restaurant_id=restaurant_id, user_id=current_user.id).first()
@@ -379,41 +739,50 @@ def showRatings(restaurant_id):
     if current_user.id != restaurant.ownerid:
         if request.method == 'POST':
             rating = int(request.form['rating'])
-
-            if user_rating:
-                # User has already rated the restaurant, update the existing rating
-                user_rating.rating = rating
+            # take the write lock before reading the rating being replaced, so two submits at once
+            # can't both see no earlier rating and both count as new
+            RatingSummary.lock(restaurant_id)
+            previous = db.session.query(Rating.rating) \
+                .filter_by(restaurant_id=restaurant_id, user_id=current_user.id).scalar()
+
+            # one statement inserts the rating or replaces the user's earlier one, the unique
+            # (restaurant_id, user_id) index means concurrent submits can't create duplicates
+            db.session.execute(text(
+                "INSERT INTO rating (restaurant_id, user_id, rating) VALUES (:restaurant_id, :user_id, :rating) "
+                "ON CONFLICT (restaurant_id, user_id) DO UPDATE SET rating = excluded.rating"),
+                {'restaurant_id': restaurant_id, 'user_id': current_user.id, 'rating': rating})
+            # O(1) delta on the summary instead of recounting the restaurant's ratings
+            if previous is None:
+                RatingSummary.adjust(restaurant_id, 1, rating)
             else:
-                # User has not rated the restaurant, create a new rating object
-                new_rating = Rating(restaurant_id=restaurant_id, user_id=current_user.id, rating=rating)
-                db.session.add(new_rating)
-                logger.info('Restaurant rated by %s (ID: %s): %s' % (current_user.username, current_user.id, restaurant_id))
+                RatingSummary.adjust(restaurant_id, 0, rating - previous)
+            audit.record('restaurant.rate', target=restaurant_id, rating=rating)
 
             db.session.commit()
 
             return redirect(url_for('main.showRatings', restaurant_id=restaurant_id))
 
-    return render_template('ratings.html', restaurant=restaurant, ratings=ratings, user_rating=user_rating)
+    # histogram, count and mean from one GROUP BY, the ratings themselves a page at a time
+    # with each rater's username loaded in the same query
+    stats = Rating.histogram(restaurant_id)
+    page = Rating.page(restaurant_id, after=request.args.get('after'), before=request.args.get('before'),
+                       limit=page_size(request.args.get('limit')))
+    return render_template('ratings.html', restaurant=restaurant, ratings=page.items, page=page, stats=stats,
+                           user_rating=user_rating)
 
 #search bar request code
 @main.route('/search', methods=["POST"])
 def search():
     form = SearchForm()
-    items = MenuItem.query
-    restaurants = Restaurant.query
     if form.validate_on_submit():
         # Receive input from submitted search
         text_searched = sanitise_input(form.searched.data) #input sanitise
-        if text_searched:
-            # Query the Database
-            items = items.filter(MenuItem.name.like('%' + text_searched + '%')).all()
-            restaurants = restaurants.filter(Restaurant.name.like('%' + text_searched + '%')).all()
-        else:
+        if not text_searched:
             # Handle blank search query
             flash('Please enter valid a search query.', 'warning')
             return redirect(url_for('main.showRestaurants'))
-        # Redirect to the search results page
-        logger.info('Search ed term %s' % (text_searched))
+        # Redirect to the search results page, which runs the search (once)
+        audit.record('search', term=text_searched)
         return redirect(url_for('main.search_results', searched=text_searched))
     
     flash('Please enter a valid search query.', 'warning')
@@ -423,6 +792,11 @@ def search():
 #search results code 
 @main.route('/search_results/<searched>')
 def search_results(searched):
-    items = MenuItem.query.filter(MenuItem.name.like('%' + searched + '%')).all()
-    restaurants = Restaurant.query.filter(Restaurant.name.like('%' + searched + '%')).all()
-    return render_template("search_results.html", searched=searched, items=items, restaurants=restaurants)
\ No newline at end of file
+    # ranked full text search with prefix matching, ?limit= caps the number of results
+    # results are cached briefly and carry their restaurant so the template doesn't query
+    # ?min_price=, ?max_price= and ?sort=price|-price narrow and order the menu items
+    price_filter = PriceFilter.from_args(request.args)
+    items, restaurants = search_index.search(searched, limit=page_size(request.args.get('limit'), search_index.DEFAULT_LIMIT),
+                                             price_filter=price_filter)
+    return render_template("search_results.html", searched=searched, items=items, restaurants=restaurants,
+                           price_filter=price_filter)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import csv
+import io
+import json as pyjs
+from collections import namedtuple
+from . import db
+from . import search as search_index
+from .models import Restaurant, MenuItem
+from .prices import parse_price, format_price
+
+# Bulk menu upload: a restaurant's whole menu as one CSV or JSON document.
+#
+# CSV has a header row with name, description, price, course and optionally id. The price can be left
+# blank for an item without one.
+# JSON is a list of objects with the same keys (or {"items": [...]}).
+#
+# The document is the new menu. Rows with an id (or else the same name) as an existing item update it,
+# other rows are new items and existing items the document leaves out are deleted. Every row is cleaned
+# with the same rules as the single item forms and the whole document is rejected if any row is bad,
+# so nothing changes unless everything can.
+MAX_ITEMS = 5000
+MAX_NAME = 80
+MAX_DESCRIPTION = 250
+
+
+class UploadError(ValueError):
+    """The document couldn't be applied, errors is a list of messages (row numbers start at 1)"""
+    def __init__(self, errors):
+        ValueError.__init__(self, '; '.join(errors))
+        self.errors = errors
+
+
+Plan = namedtuple('Plan', 'created updated deleted unchanged')
+
+
+def read_document(data, content_type=None, filename=None):
+    """Turn the uploaded bytes into a list of dicts, CSV or JSON picked by file extension or content type"""
+    kind = (filename or '').rsplit('.', 1)[-1].lower() if filename and '.' in filename else ''
+    if not kind:
+        kind = 'csv' if content_type and 'csv' in content_type else 'json'
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise UploadError(['the document has to be UTF-8'])
+
+    if kind == 'csv':
+        reader = csv.DictReader(io.StringIO(text, newline=''))
+        if not reader.fieldnames or 'name' not in reader.fieldnames:
+            raise UploadError(['the CSV needs a header row with at least a name column'])
+        rows = list(reader)
+    else:
+        try:
+            rows = pyjs.loads(text)
+        except ValueError as e:
+            raise UploadError(['not valid JSON: %s' % e])
+        if isinstance(rows, dict):
+            rows = rows.get('items')
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise UploadError(['the JSON has to be a list of menu items'])
+    if len(rows) > MAX_ITEMS:
+        raise UploadError(['a menu can have at most %d items' % MAX_ITEMS])
+    return rows
+
+
+def clean_rows(rows, escape, sanitise):
+    """Apply the per item form rules to every row, escape/sanitise are the ones the forms use"""
+    cleaned, errors = [], []
+    for number, row in enumerate(rows, 1):
+        name = str(escape(str(row.get('name') or '').strip()))
+        if not name:
+            errors.append('row %d: a name is required' % number)
+        elif len(name) > MAX_NAME:
+            errors.append('row %d: the name is longer than %d characters' % (number, MAX_NAME))
+        description = sanitise(str(row.get('description') or ''))[:MAX_DESCRIPTION]
+        # a blank or missing price is an item without a price, like leaving it empty in the edit form
+        price = row.get('price')
+        price_cents = None
+        if price is not None and str(price).strip():
+            try:
+                price_cents = parse_price(price)
+            except ValueError:
+                errors.append('row %d: %r is not a price like 2.99' % (number, price))
+        item_id = row.get('id')
+        if item_id not in (None, ''):
+            try:
+                item_id = int(item_id)
+            except (TypeError, ValueError):
+                errors.append('row %d: id %r is not a number' % (number, item_id))
+        else:
+            item_id = None
+        cleaned.append({'id': item_id, 'name': name, 'description': description, 'price_cents': price_cents,
+                        'course': str(escape(str(row.get('course') or '').strip()))})
+    if errors:
+        raise UploadError(errors)
+    return cleaned
+
+
+def plan(restaurant_id, rows):
+    """Diff cleaned rows against the restaurant's items, returns a Plan of dicts (nothing is written)"""
+    existing = dict((item.id, item) for item in MenuItem.query.filter_by(restaurant_id=restaurant_id))
+    by_name = dict((item.name, item) for item in existing.values())
+    created, updated, unchanged, errors = [], [], [], []
+    matched, names = set(), set()
+    for number, row in enumerate(rows, 1):
+        if row['name'] in names:
+            errors.append('row %d: %s is on the menu twice' % (number, row['name']))
+            continue
+        names.add(row['name'])
+        if row['id'] is not None:
+            item = existing.get(row['id'])
+            if item is None:
+                errors.append("row %d: item %d isn't on this restaurant's menu" % (number, row['id']))
+                continue
+        else:
+            item = by_name.get(row['name'])
+        if item is None or item.id in matched:
+            created.append(dict(row, id=None))
+            continue
+        matched.add(item.id)
+        changes = dict(row, id=item.id)
+        if (item.name, item.description or '', item.price_cents, item.course or '') == \
+                (row['name'], row['description'], row['price_cents'], row['course']):
+            unchanged.append(changes)
+        else:
+            updated.append(changes)
+    if errors:
+        raise UploadError(errors)
+    deleted = [{'id': item.id, 'name': item.name, 'price_cents': item.price_cents}
+               for item_id, item in sorted(existing.items()) if item_id not in matched]
+    return Plan(created, updated, deleted, unchanged)
+
+
+def apply(restaurant_id, changes):
+    """Write a Plan inside the caller's transaction, the caller commits"""
+    deleted_ids = [item['id'] for item in changes.deleted]
+    search_index.remove_menu_items(deleted_ids)
+    for start in range(0, len(deleted_ids), 500):
+        MenuItem.query.filter(MenuItem.id.in_(deleted_ids[start:start + 500])) \
+            .delete(synchronize_session=False)
+
+    if changes.updated:
+        db.session.bulk_update_mappings(MenuItem, changes.updated)
+    new_items = [MenuItem(restaurant_id=restaurant_id, name=row['name'], description=row['description'],
+                          price_cents=row['price_cents'], course=row['course']) for row in changes.created]
+    db.session.add_all(new_items)
+    db.session.flush()
+    for row, item in zip(changes.created, new_items):
+        row['id'] = item.id
+
+    changed_ids = [row['id'] for row in changes.updated + changes.created]
+    if changed_ids:
+        # populate_existing, the bulk update bypassed the copies plan() loaded into the session
+        search_index.index_menu_items(MenuItem.query.filter(MenuItem.id.in_(changed_ids)).populate_existing().all())
+    if changed_ids or deleted_ids:
+        Restaurant.bump_version(restaurant_id)
+
+
+def summary(restaurant_id, changes, dry_run=False):
+    def item(row):
+        return {'id': row['id'], 'name': row['name'], 'price': format_price(row.get('price_cents'))}
+    return {
+        'restaurant_id': restaurant_id,
+        'dry_run': dry_run,
+        'created': [item(row) for row in changes.created],
+        'updated': [item(row) for row in changes.updated],
+        'deleted': [item(row) for row in changes.deleted],
+        'unchanged': len(changes.unchanged),
+    }
@@ -0,0 +1,339 @@
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from flask import g, request
+
+# Request metrics per endpoint: a latency histogram, counts by status and the number of requests in flight.
+#
+# Recording is a dict update under a lock. A background thread in each process writes its totals to
+# METRICS_DIR/<pid>-<start ms>.json every METRICS_FLUSH_SECONDS when they have changed, and /admin/metrics merges the files from every worker into one
+# Prometheus text exposition. The start time in the name means a reused pid gets a file of its own.
+# When a process has exited its counters are folded into retired.json and its file is deleted, so
+# counters only go up while the server runs and the directory doesn't grow. run.py empties the
+# directory when a server starts, so counters start again from zero like any restarted exporter.
+DEFAULTS = {
+    'METRICS_ENABLED': True,
+    'METRICS_DIR': None,  # defaults to <instance path>/metrics
+    'METRICS_FLUSH_SECONDS': 1.0,
+}
+
+# upper bounds in seconds, the last bucket (+Inf) is implied
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+logger = logging.getLogger(__name__)
+RETIRED = 'retired.json'
+PROCESS_FILE = re.compile(r'^(\d+)-\d+\.json$')
+
+
+class Metrics(object):
+    def __init__(self):
+        self.directory = None
+        self.flush_seconds = DEFAULTS['METRICS_FLUSH_SECONDS']
+        self._lock = threading.Lock()
+        self._collectors = []
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._started = int(time.time() * 1000)
+        self._flusher = None
+        self._dirty = False
+        self.requests = {}      # (endpoint, method, status) -> count
+        self.latency = {}       # (endpoint, method) -> [bucket counts..., +Inf count, sum]
+        self.in_flight = {}     # endpoint -> count
+
+    def init_app(self, app):
+        for key, value in DEFAULTS.items():
+            app.config.setdefault(key, value)
+        if not app.config['METRICS_ENABLED']:
+            return
+        self.directory = app.config['METRICS_DIR'] or os.path.join(app.instance_path, 'metrics')
+        self.flush_seconds = app.config['METRICS_FLUSH_SECONDS']
+        os.makedirs(self.directory, exist_ok=True)
+
+        @app.before_request
+        def start_request_timer():
+            g.metrics_started = time.perf_counter()
+            g.metrics_endpoint = request.endpoint or 'unmatched'
+            self._adjust_in_flight(g.metrics_endpoint, 1)
+
+        @app.after_request
+        def remember_status(response):
+            g.metrics_status = response.status_code
+            return response
+
+        @app.teardown_request
+        def stop_request_timer(exc):
+            started = g.pop('metrics_started', None)
+            if started is None:
+                return
+            endpoint = g.pop('metrics_endpoint')
+            status = g.pop('metrics_status', 500 if exc is not None else 200)
+            self._adjust_in_flight(endpoint, -1)
+            self.observe(endpoint, request.method, status, time.perf_counter() - started)
+
+    def add_collector(self, collector):
+        """collector() returns extra (name, type, help, labels, value) samples for this process"""
+        self._collectors.append(collector)
+
+    def _check_fork(self):
+        # a forked worker starts with its parent's numbers, it counts from zero under its own pid
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _adjust_in_flight(self, endpoint, delta):
+        with self._lock:
+            self._check_fork()
+            self.in_flight[endpoint] = self.in_flight.get(endpoint, 0) + delta
+
+    def observe(self, endpoint, method, status, seconds):
+        with self._lock:
+            self._check_fork()
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get((endpoint, method))
+            if histogram is None:
+                histogram = self.latency[(endpoint, method)] = [0] * (len(BUCKETS) + 2)
+            index = 0
+            while index < len(BUCKETS) and seconds > BUCKETS[index]:
+                index += 1
+            histogram[index] += 1
+            histogram[-1] += seconds
+            self._dirty = True
+            if self._flusher is None and self.directory is not None:
+                self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        # writes this process's numbers in the background so requests never wait on the file
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_seconds)
+            if self._dirty:
+                try:
+                    self.flush()
+                except Exception:
+                    # keep the thread going, the next flush writes everything again
+                    self._dirty = True
+                    logger.exception('writing metrics to %s failed', self.directory)
+
+    def snapshot(self):
+        with self._lock:
+            self._check_fork()
+            return {
+                'pid': self._pid,
+                'started': self._started,
+                'requests': [list(key) + [count] for key, count in self.requests.items()],
+                'latency': [list(key) + [list(histogram)] for key, histogram in self.latency.items()],
+                'in_flight': dict(self.in_flight),
+                'process': [list(sample) for collector in self._collectors for sample in collector()],
+            }
+
+    def flush(self):
+        if self.directory is None:
+            return
+        self._dirty = False
+        data = self.snapshot()
+        path = os.path.join(self.directory, '%d-%d.json' % (data['pid'], data['started']))
+        # the flush thread and /admin/metrics requests can flush at the same time, each uses its own temporary file
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as f:
+                json.dump(data, f)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def clear(self):
+        """Remove every file in the directory, run.py calls this when a server starts"""
+        if self.directory is None:
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith('.json') or name.endswith('.tmp'):
+                os.remove(os.path.join(self.directory, name))
+
+    def _load(self, name):
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None  # gone, being replaced or half written, picked up next time
+
+    def _retire_exited(self):
+        # fold the files of processes that have exited into retired.json and delete them, under a lock
+        # so two workers rendering the page at once can't fold the same file twice
+        exited = [name for name in os.listdir(self.directory)
+                  if PROCESS_FILE.match(name) and not _alive(int(PROCESS_FILE.match(name).group(1)))]
+        if not exited:
+            return
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired = self._load(RETIRED) or {'pid': None, 'requests': [], 'latency': [], 'in_flight': {},
+                                              'process': [], 'folded': []}
+            # names already in folded were added before a crash stopped them being deleted
+            folded = set(retired['folded'])
+            snapshots = [retired]
+            for name in exited:
+                data = self._load(name) if name not in folded else None
+                if data is not None:
+                    data['pid'] = None  # counters only, its gauges went with the process
+                    snapshots.append(data)
+                    folded.add(name)
+            requests, latency, in_flight, process = _combine(snapshots)
+            retired = {
+                'pid': None,
+                'requests': [list(key) + [count] for key, count in requests.items()],
+                'latency': [list(key) + [histogram] for key, histogram in latency.items()],
+                'in_flight': {},
+                'process': [[name, kind, description, dict(labels), value]
+                            for (name, kind, description, labels), value in process.items()],
+                'folded': sorted(name for name in folded if os.path.exists(os.path.join(self.directory, name))),
+            }
+            path = os.path.join(self.directory, RETIRED)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(retired, f)
+            os.replace(path + '.tmp', path)
+            for name in retired['folded']:
+                os.remove(os.path.join(self.directory, name))
+
+    def _snapshots(self):
+        if self.directory is None:
+            return [self.snapshot()]
+        self.flush()
+        self._retire_exited()
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if name == RETIRED or PROCESS_FILE.match(name):
+                data = self._load(name)
+                if data is not None:
+                    snapshots.append(data)
+        return snapshots
+
+    def collect(self):
+        """Merge every process's numbers, returns (requests, latency, in_flight, process samples)"""
+        return _combine(self._snapshots())
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        requests, latency, in_flight, process = self.collect()
+        lines = [
+            '# HELP http_requests_total Requests handled by endpoint, method and status.',
+            '# TYPE http_requests_total counter',
+        ]
+        for (endpoint, method, status), count in sorted(requests.items()):
+            lines.append('http_requests_total%s %d' % (_labels(endpoint=endpoint, method=method, status=status), count))
+
+        lines += [
+            '# HELP http_request_duration_seconds Request latency by endpoint and method.',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        for (endpoint, method), histogram in sorted(latency.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram[:-1]):
+                cumulative += count
+                le = bound if bound == '+Inf' else repr(bound)
+                lines.append('http_request_duration_seconds_bucket%s %d'
+                             % (_labels(endpoint=endpoint, method=method, le=le), cumulative))
+            lines.append('http_request_duration_seconds_sum%s %.6f' % (_labels(endpoint=endpoint, method=method), histogram[-1]))
+            lines.append('http_request_duration_seconds_count%s %d' % (_labels(endpoint=endpoint, method=method), cumulative))
+
+        lines += [
+            '# HELP http_request_duration_quantile_seconds p50/p95/p99 latency estimated from the histogram buckets.',
+            '# TYPE http_request_duration_quantile_seconds gauge',
+        ]
+        for (endpoint, method), histogram in sorted(latency.items()):
+            for quantile in QUANTILES:
+                lines.append('http_request_duration_quantile_seconds%s %.6f'
+                             % (_labels(endpoint=endpoint, method=method, quantile=repr(quantile)),
+                                estimate_quantile(histogram, quantile)))
+
+        lines += [
+            '# HELP http_requests_in_flight Requests currently being handled across all workers.',
+            '# TYPE http_requests_in_flight gauge',
+        ]
+        for endpoint, count in sorted(in_flight.items()):
+            lines.append('http_requests_in_flight%s %d' % (_labels(endpoint=endpoint), count))
+
+        described = set()
+        for (name, kind, description, labels), value in sorted(process.items()):
+            if name not in described:
+                lines += ['# HELP %s %s' % (name, description), '# TYPE %s %s' % (name, kind)]
+                described.add(name)
+            lines.append('%s%s %s' % (name, _labels(**dict(labels)), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _combine(snapshots):
+    """Add up snapshots, gauges and in-flight counts only from processes that are still running"""
+    requests, latency, in_flight, process = {}, {}, {}, {}
+    for data in snapshots:
+        alive = data['pid'] is not None and _alive(data['pid'])
+        for endpoint, method, status, count in data['requests']:
+            key = (endpoint, method, status)
+            requests[key] = requests.get(key, 0) + count
+        for endpoint, method, histogram in data['latency']:
+            merged = latency.setdefault((endpoint, method), [0] * len(histogram))
+            for index, value in enumerate(histogram):
+                merged[index] += value
+        if alive:
+            for endpoint, count in data['in_flight'].items():
+                in_flight[endpoint] = in_flight.get(endpoint, 0) + count
+        for name, kind, description, labels, value in data['process']:
+            if kind == 'gauge' and not alive:
+                continue
+            key = (name, kind, description, tuple(sorted(labels.items())))
+            process[key] = process.get(key, 0) + value
+    return requests, latency, in_flight, process
+
+
+def estimate_quantile(histogram, quantile):
+    """Linear interpolation inside the bucket holding the quantile, the same way Prometheus does"""
+    counts = histogram[:-1]
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = quantile * total
+    cumulative = 0
+    for index, count in enumerate(counts):
+        if cumulative + count >= rank and count:
+            if index == len(BUCKETS):
+                return BUCKETS[-1]  # past the largest bucket, report its bound
+            lower = BUCKETS[index - 1] if index else 0.0
+            return lower + (BUCKETS[index] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return BUCKETS[-1]
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value)) for key, value in sorted(labels.items()))
+
+
+def _number(value):
+    return ('%.6f' % value) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
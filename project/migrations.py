@@ -0,0 +1,227 @@
+import sqlite3
+from datetime import datetime
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateTable
+from . import db
+from .models import User, Restaurant, MenuItem, Rating, RatingSummary, PurgeJob
+from .prices import parse_price
+
+# Versioned schema migrations.
+#
+# Every migration runs once, in order, inside its own transaction and is recorded in the schema_version
+# table. db.create_all() already builds a new database in its final shape, so migrations have to be safe
+# to run against tables that are already up to date (check before adding, CREATE INDEX IF NOT EXISTS).
+#
+#   python migrate.py            - apply pending migrations
+#   python migrate.py --status   - list applied and pending migrations
+VERSION_TABLE = 'schema_version'
+
+
+def _columns(table):
+    return set(column['name'] for column in inspect(db.session.connection()).get_columns(table))
+
+
+def _add_column(table, column, default_sql=None):
+    if column.name in _columns(table):
+        return
+    sql = 'ALTER TABLE "%s" ADD COLUMN %s %s' % (table, column.name,
+                                               column.type.compile(dialect=db.session.bind.dialect))
+    if default_sql is not None:
+        sql += ' NOT NULL DEFAULT %s' % default_sql
+    db.session.execute(text(sql))
+
+
+def _create_index(name, table, columns, unique=False, where=None):
+    db.session.execute(text('CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)%s'
+                            % ('UNIQUE ' if unique else '', name, table, ', '.join(columns),
+                               ' WHERE %s' % where if where else '')))
+
+
+def _can_drop_columns():
+    dialect = db.session.bind.dialect
+    return dialect.name != 'sqlite' or sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+def _rebuild_summaries():
+    RatingSummary.query.delete()
+    db.session.execute(text(
+        "INSERT INTO rating_summary (restaurant_id, count, total, average) "
+        "SELECT rating.restaurant_id, count(rating.id), sum(rating.rating), avg(rating.rating) "
+        "FROM rating JOIN restaurant ON restaurant.id = rating.restaurant_id "
+        "GROUP BY rating.restaurant_id"))
+
+
+def restaurant_versions_and_summaries():
+    """Restaurant version/updated_at, rating_summary and the restaurant listing index"""
+    _add_column('restaurant', Restaurant.__table__.c.version, default_sql='1')
+    if 'updated_at' not in _columns('restaurant'):
+        _add_column('restaurant', Restaurant.__table__.c.updated_at)
+        db.session.execute(text('UPDATE restaurant SET updated_at = :now'), {'now': datetime.utcnow()})
+    if 'rating_summary' not in inspect(db.session.connection()).get_table_names():
+        RatingSummary.__table__.create(db.session.connection())
+        _rebuild_summaries()
+    _create_index('ix_restaurant_name_id', 'restaurant', ['name', 'id'])
+
+
+def foreign_key_indexes():
+    """Index the foreign keys the menu and rating pages filter on"""
+    _create_index('ix_menu_item_restaurant_id', 'menu_item', ['restaurant_id'])
+    _create_index('ix_rating_user_id', 'rating', ['user_id'])
+    # covers both the restaurant_id lookups and the per restaurant rating aggregates
+    _create_index('ix_rating_restaurant_id_rating', 'rating', ['restaurant_id', 'rating'])
+
+
+def unique_user_rating():
+    """One rating per user per restaurant, keeping the newest of any duplicates"""
+    db.session.execute(text(
+        "DELETE FROM rating WHERE id NOT IN "
+        "(SELECT max(id) FROM rating GROUP BY restaurant_id, user_id)"))
+    _create_index('uq_rating_restaurant_user', 'rating', ['restaurant_id', 'user_id'], unique=True)
+    _rebuild_summaries()
+
+
+def price_cents():
+    """Store menu prices as whole cents, parsed from the old "$2.99" strings"""
+    _add_column('menu_item', MenuItem.__table__.c.price_cents)
+    if 'price' in _columns('menu_item'):
+        rows = db.session.execute(text("SELECT id, price FROM menu_item WHERE price IS NOT NULL")).fetchall()
+        updates = []
+        for item_id, price in rows:
+            try:
+                updates.append({'id': item_id, 'cents': parse_price(price)})
+            except ValueError:
+                pass  # not a price, left empty for the owner to fix
+        for start in range(0, len(updates), 5000):
+            db.session.execute(text("UPDATE menu_item SET price_cents = :cents WHERE id = :id"),
+                               updates[start:start + 5000])
+        if _can_drop_columns():
+            db.session.execute(text("ALTER TABLE menu_item DROP COLUMN price"))
+    _create_index('ix_menu_item_price_cents', 'menu_item', ['price_cents'])
+    _create_index('ix_menu_item_restaurant_id_price_cents', 'menu_item', ['restaurant_id', 'price_cents'])
+    # the composite index covers restaurant_id lookups, the single column one is just extra write work
+    db.session.execute(text('DROP INDEX IF EXISTS ix_menu_item_restaurant_id'))
+
+
+def rating_paging_index():
+    """Lets a restaurant's ratings be paged in id order without sorting them all"""
+    _create_index('ix_rating_restaurant_id_id', 'rating', ['restaurant_id', 'id'])
+
+
+def rating_scores():
+    """Bayesian score on rating_summary for the top restaurants list"""
+    _add_column('rating_summary', RatingSummary.__table__.c.score, default_sql='0')
+    mean, weight = RatingSummary.prior()
+    db.session.execute(text("UPDATE rating_summary SET score = (total + :weight * :mean) * 1.0 / (count + :weight)"),
+                       {'mean': mean, 'weight': weight})
+    _create_index('ix_rating_summary_score', 'rating_summary', ['score', 'restaurant_id'])
+
+
+def _is_sqlite():
+    return db.session.bind.dialect.name == 'sqlite'
+
+
+def _cascading(table):
+    """True when every foreign key of table already has ON DELETE CASCADE in the database"""
+    if _is_sqlite():
+        # sqlalchemy 1.3 doesn't reflect ON DELETE for sqlite, the pragma has it (7th column)
+        rows = db.session.execute(text('PRAGMA foreign_key_list(%s)' % table)).fetchall()
+        return all(row[6].upper() == 'CASCADE' for row in rows)
+    foreign_keys = inspect(db.session.connection()).get_foreign_keys(table)
+    return all((fk['options'].get('ondelete') or '').upper() == 'CASCADE' for fk in foreign_keys)
+
+
+def _rebuild_sqlite_table(table):
+    # sqlite can't alter a foreign key, so the table is recreated from the model and the rows copied over
+    columns = ', '.join(column.name for column in table.columns)
+    create = str(CreateTable(table).compile(dialect=db.session.bind.dialect)).strip()
+    db.session.execute(text(create.replace('CREATE TABLE %s ' % table.name, 'CREATE TABLE %s_new ' % table.name, 1)))
+    db.session.execute(text('INSERT INTO %s_new (%s) SELECT %s FROM %s' % (table.name, columns, columns, table.name)))
+    db.session.execute(text('DROP TABLE %s' % table.name))
+    db.session.execute(text('ALTER TABLE %s_new RENAME TO %s' % (table.name, table.name)))
+    for index in table.indexes:
+        index.create(db.session.connection())
+
+
+def cascading_deletes():
+    """ON DELETE CASCADE from menu items, ratings and summaries to their restaurant/user, orphans removed"""
+    db.session.execute(text('DELETE FROM menu_item WHERE restaurant_id NOT IN (SELECT id FROM restaurant)'))
+    db.session.execute(text('DELETE FROM rating WHERE restaurant_id NOT IN (SELECT id FROM restaurant) '
+                            'OR user_id NOT IN (SELECT id FROM "user")'))
+    db.session.execute(text('DELETE FROM rating_summary WHERE restaurant_id NOT IN (SELECT id FROM restaurant)'))
+    if 'search_index' in inspect(db.session.connection()).get_table_names():
+        db.session.execute(text('DELETE FROM search_index WHERE rowid % 2 = 1 AND rowid / 2 NOT IN (SELECT id FROM menu_item)'))
+        db.session.execute(text('DELETE FROM search_index WHERE rowid % 2 = 0 AND rowid / 2 NOT IN (SELECT id FROM restaurant)'))
+
+    for model in (MenuItem, Rating, RatingSummary):
+        table = model.__table__
+        if _cascading(table.name):
+            continue
+        if _is_sqlite():
+            _rebuild_sqlite_table(table)
+            continue
+        for fk in inspect(db.session.connection()).get_foreign_keys(table.name):
+            db.session.execute(text('ALTER TABLE %s DROP CONSTRAINT %s' % (table.name, fk['name'])))
+            db.session.execute(text('ALTER TABLE %s ADD CONSTRAINT %s FOREIGN KEY (%s) REFERENCES "%s" (%s) ON DELETE CASCADE'
+                                    % (table.name, fk['name'], ', '.join(fk['constrained_columns']),
+                                       fk['referred_table'], ', '.join(fk['referred_columns']))))
+
+
+def soft_delete():
+    """deleted_at on restaurants and users, the purge_job queue and a listing index without deleted restaurants"""
+    _add_column('restaurant', Restaurant.__table__.c.deleted_at)
+    _add_column('user', User.__table__.c.deleted_at)
+    if 'purge_job' not in inspect(db.session.connection()).get_table_names():
+        PurgeJob.__table__.create(db.session.connection())
+    _create_index('ix_restaurant_live_name_id', 'restaurant', ['name', 'id'], where='deleted_at IS NULL')
+    db.session.execute(text('DROP INDEX IF EXISTS ix_restaurant_name_id'))
+
+
+MIGRATIONS = [
+    (1, restaurant_versions_and_summaries),
+    (2, foreign_key_indexes),
+    (3, unique_user_rating),
+    (4, price_cents),
+    (5, rating_paging_index),
+    (6, rating_scores),
+    (7, cascading_deletes),
+    (8, soft_delete),
+]
+
+
+def _ensure_version_table():
+    db.session.execute(text(
+        "CREATE TABLE IF NOT EXISTS %s (version INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL)" % VERSION_TABLE))
+    db.session.commit()
+
+
+def applied_versions():
+    _ensure_version_table()
+    return set(row[0] for row in db.session.execute(text("SELECT version FROM %s" % VERSION_TABLE)))
+
+
+def pending():
+    applied = applied_versions()
+    return [(version, migration) for version, migration in MIGRATIONS if version not in applied]
+
+
+def current_version():
+    applied = applied_versions()
+    return max(applied) if applied else 0
+
+
+def upgrade():
+    """Apply every pending migration, returns the list of (version, name) that ran"""
+    ran = []
+    for version, migration in pending():
+        try:
+            migration()
+            db.session.execute(text("INSERT INTO %s (version, name, applied_at) VALUES (:version, :name, :now)"
+                                    % VERSION_TABLE),
+                               {'version': version, 'name': migration.__name__, 'now': datetime.utcnow()})
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        ran.append((version, migration.__name__))
+    return ran
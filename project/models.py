@@ -1,5 +1,11 @@
+from datetime import datetime
+from flask import current_app
 from . import db
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import func, case, text, bindparam
+from .hashing import passwords
+from .prices import parse_price, format_price
+from .pagination import keyset_page, DEFAULT_PAGE_SIZE
+from sqlalchemy.orm import contains_eager
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField
 from wtforms.validators import DataRequired
@@ -10,6 +16,13 @@ class User(UserMixin,db.Model):
     username = db.Column(db.String(50), unique=True, nullable=False)
     password_hash = db.Column(db.String(128), nullable=False)
     role = db.Column(db.String(20), nullable=False)
+    # set when the user is deleted, the row and their ratings are removed later by the purge worker (purge.py)
+    deleted_at = db.Column(db.DateTime)
+
+    @classmethod
+    def live(cls):
+        """Users that haven't been deleted"""
+        return cls.query.filter(cls.deleted_at.is_(None))
 
     @property
     def serialize(self):
@@ -32,11 +45,12 @@ class User(UserMixin,db.Model):
         confirm_password = StringField('Confirm Password', validators=[DataRequired()])
         submit = SubmitField('Register')
 
+    # hashing runs in the bounded password pool, both can raise HashPoolBusy
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)#hashes passwords
+        self.password_hash = passwords.hash(password)#hashes passwords
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.verify(self.password_hash, password)
     
 
 
@@ -46,6 +60,17 @@ class Restaurant(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False)
     ownerid = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # bumped by every change to the restaurant or its menu, used for menu page ETags and caching
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # set when the restaurant is deleted, every query skips it and the purge worker (purge.py)
+    # removes its menu, ratings and finally the row in small batches
+    deleted_at = db.Column(db.DateTime)
+
+    # backs the keyset pagination of the restaurant listing (ordered by name then id). Partial, so it only
+    # holds restaurants that haven't been deleted and queries filtering on deleted_at IS NULL can use it
+    __table_args__ = (db.Index('ix_restaurant_live_name_id', 'name', 'id', sqlite_where=text('deleted_at IS NULL'),
+                               postgresql_where=text('deleted_at IS NULL')),)
    
 
     # Form fields
@@ -60,15 +85,56 @@ class Restaurant(db.Model):
             'name'         : self.name,
             'id'           : self.id,
         }
+
+    @classmethod
+    def live(cls):
+        """Restaurants that haven't been deleted"""
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+    @classmethod
+    def live_or_404(cls, restaurant_id):
+        return cls.live().filter(cls.id == restaurant_id).first_or_404()
+
+    @classmethod
+    def bump_version(cls, restaurant_id):
+        """Mark the restaurant's menu as changed inside the caller's transaction"""
+        cls.query.filter_by(id=restaurant_id).update({
+            cls.version: cls.version + 1,
+            cls.updated_at: datetime.utcnow(),
+        }, synchronize_session=False)
     
 class MenuItem(db.Model):
     name = db.Column(db.String(80), nullable = False)
     id = db.Column(db.Integer, primary_key = True)
     description = db.Column(db.String(250))
-    price = db.Column(db.String(8))
+    # whole cents so prices can be ranged and sorted in SQL, .price is the "$2.99" form
+    price_cents = db.Column(db.Integer, index=True)
     course = db.Column(db.String(250))
-    restaurant_id = db.Column(db.Integer,db.ForeignKey('restaurant.id'))
-    restaurant = db.    relationship(Restaurant)
+    restaurant_id = db.Column(db.Integer,db.ForeignKey('restaurant.id', ondelete='CASCADE'))
+    # deleting a restaurant deletes its menu, the database does it (passive_deletes) so nothing is loaded first
+    restaurant = db.relationship(Restaurant, backref=db.backref('menu_items', cascade='all, delete-orphan',
+                                                               passive_deletes=True))
+
+    # price filtered/sorted menus of one restaurant
+    __table_args__ = (db.Index('ix_menu_item_restaurant_id_price_cents', 'restaurant_id', 'price_cents'),)
+
+    # the usual courses come first in this order, any other course follows alphabetically
+    COURSES = ('Appetizer', 'Entree', 'Dessert', 'Beverage')
+
+    @classmethod
+    def course_order(cls):
+        """ORDER BY terms that keep each course's items together, usual courses first"""
+        rank = case([(cls.course == course, index) for index, course in enumerate(cls.COURSES)],
+                    else_=len(cls.COURSES))
+        return [rank, cls.course]
+
+    @property
+    def price(self):
+        return format_price(self.price_cents)
+
+    @price.setter
+    def price(self, value):
+        self.price_cents = parse_price(value) if value not in (None, '') else None
 
     @property
     def serialize(self):
@@ -83,11 +149,42 @@ class MenuItem(db.Model):
 
 class Rating(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
     rating = db.Column(db.Integer, nullable=False)
 
-    user = db.relationship('User', backref='ratings')
+    # ratings go with the restaurant or the user they belong to
+    user = db.relationship('User', backref=db.backref('ratings', cascade='all, delete-orphan', passive_deletes=True))
+    restaurant = db.relationship(Restaurant, backref=db.backref('ratings', cascade='all, delete-orphan',
+                                                               passive_deletes=True))
+
+    # one rating per user per restaurant (showRatings upserts against it), and a covering index for the
+    # per restaurant lookups and rating aggregates. Kept in step with migrations.py
+    __table_args__ = (
+        db.Index('uq_rating_restaurant_user', 'restaurant_id', 'user_id', unique=True),
+        db.Index('ix_rating_restaurant_id_rating', 'restaurant_id', 'rating'),
+        db.Index('ix_rating_restaurant_id_id', 'restaurant_id', 'id'),  # paging a restaurant's ratings
+    )
+
+    @classmethod
+    def page(cls, restaurant_id, after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+        """One keyset page of a restaurant's ratings in id order, each rater loaded in the same query.
+        Ratings of deleted users are left out, they stay in the counts until the purge removes them"""
+        query = cls.query.join(cls.user).options(contains_eager(cls.user)) \
+            .filter(cls.restaurant_id == restaurant_id, User.deleted_at.is_(None))
+        return keyset_page(query, [cls.id], key=lambda rating: (rating.id,), after=after, before=before, limit=limit)
+
+    @classmethod
+    def histogram(cls, restaurant_id):
+        """1-5 counts, total count and mean for a restaurant from one GROUP BY over the covering index"""
+        counts = dict((value, 0) for value in range(1, 6))
+        rows = db.session.query(cls.rating, func.count(cls.id)).filter(cls.restaurant_id == restaurant_id) \
+            .group_by(cls.rating)
+        for value, count in rows:
+            counts[value] = count
+        total = sum(counts.values())
+        mean = sum(value * count for value, count in counts.items()) / float(total) if total else None
+        return {'histogram': counts, 'count': total, 'mean': round(mean, 2) if mean is not None else None}
 
     @property
     def serialize(self):
@@ -102,6 +199,157 @@ class Rating(db.Model):
     @property
     def username(self):
         return self.user.username
+
+#running rating totals per restaurant so the listing doesn't have to aggregate the rating table
+#score is a bayesian average: the ratings plus RATING_PRIOR_WEIGHT imaginary ratings of RATING_PRIOR_MEAN,
+#so a restaurant with two 5 star ratings doesn't outrank one with hundreds of 4.8s. It is indexed for the
+#top restaurants list and kept up to date with the totals. Run rebuild_ratings.py after changing the prior.
+RATING_PRIOR_MEAN = 3.0
+RATING_PRIOR_WEIGHT = 10
+
+class RatingSummary(db.Model):
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id', ondelete='CASCADE'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    average = db.Column(db.Float, nullable=False, default=0)
+    score = db.Column(db.Float, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (db.Index('ix_rating_summary_score', 'score', 'restaurant_id'),)
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializable format"""
+        return {
+            'restaurant_id': self.restaurant_id,
+            'count': self.count,
+            'total': self.total,
+            'average': self.average,
+            'score': self.score,
+        }
+
+    @staticmethod
+    def prior():
+        """(mean, weight) of the bayesian prior from the app config"""
+        return (float(current_app.config.get('RATING_PRIOR_MEAN', RATING_PRIOR_MEAN)),
+                float(current_app.config.get('RATING_PRIOR_WEIGHT', RATING_PRIOR_WEIGHT)))
+
+    @classmethod
+    def bayesian(cls, count, total):
+        """Score for count ratings adding up to total, works on numbers and SQL expressions alike"""
+        mean, weight = cls.prior()
+        return (total + weight * mean) * 1.0 / (count + weight)
+
+    @classmethod
+    def adjust(cls, restaurant_id, count_delta, total_delta):
+        """Apply a rating change to the summary inside the caller's transaction"""
+        new_count = cls.count + count_delta
+        new_total = cls.total + total_delta
+        updated = cls.query.filter_by(restaurant_id=restaurant_id).update({
+            cls.count: new_count,
+            cls.total: new_total,
+            cls.average: case([(new_count > 0, new_total * 1.0 / new_count)], else_=0),
+            cls.score: cls.bayesian(new_count, new_total),
+        }, synchronize_session=False)
+        if not updated and count_delta > 0:
+            db.session.add(cls(restaurant_id=restaurant_id, count=count_delta, total=total_delta,
+                               average=total_delta / count_delta, score=cls.bayesian(count_delta, total_delta)))
+
+    @classmethod
+    def lock(cls, restaurant_id):
+        """Write to the restaurant's summary row (creating it) so the caller's transaction holds the write
+        lock: the row lock on server databases, the database lock on SQLite. Reads after this see the
+        latest committed ratings and submits for the restaurant are applied one at a time"""
+        db.session.execute(text(
+            "INSERT INTO rating_summary (restaurant_id, count, total, average, score) "
+            "VALUES (:restaurant_id, 0, 0, 0, :score) "
+            "ON CONFLICT (restaurant_id) DO UPDATE SET count = rating_summary.count"),
+            {'restaurant_id': restaurant_id, 'score': cls.bayesian(0, 0)})
+
+    @classmethod
+    def refresh(cls, restaurant_id):
+        """Recalculate one restaurant's summary from its ratings inside the caller's transaction.
+        Submits use adjust(), this is for migrations and repairs"""
+        cls.refresh_many([restaurant_id])
+
+    @classmethod
+    def refresh_many(cls, restaurant_ids):
+        """refresh() for a set of restaurants in one statement, restaurants left without ratings go back to 0"""
+        if not restaurant_ids:
+            return
+        mean, weight = cls.prior()
+        db.session.execute(text(
+            "INSERT INTO rating_summary (restaurant_id, count, total, average, score) "
+            "SELECT restaurant.id, count(rating.rating), coalesce(sum(rating.rating), 0), "
+            "coalesce(avg(rating.rating), 0), (coalesce(sum(rating.rating), 0) + :weight * :mean) * 1.0 / "
+            "(count(rating.rating) + :weight) "
+            "FROM restaurant LEFT JOIN rating ON rating.restaurant_id = restaurant.id "
+            "WHERE restaurant.id IN :restaurant_ids GROUP BY restaurant.id "
+            "ON CONFLICT (restaurant_id) DO UPDATE SET count = excluded.count, total = excluded.total, "
+            "average = excluded.average, score = excluded.score").bindparams(
+                bindparam('restaurant_ids', expanding=True)),
+            {'restaurant_ids': list(restaurant_ids), 'mean': mean, 'weight': weight})
+
+    @classmethod
+    def rebuild(cls):
+        """Recalculate every summary from the rating table"""
+        cls.query.delete()
+        aggregate = db.session.query(Rating.restaurant_id, func.count(Rating.id), func.sum(Rating.rating),
+                                     func.avg(Rating.rating),
+                                     cls.bayesian(func.count(Rating.id), func.sum(Rating.rating))) \
+            .join(Restaurant, Restaurant.id == Rating.restaurant_id) \
+            .group_by(Rating.restaurant_id)
+        db.session.execute(cls.__table__.insert().from_select(
+            ['restaurant_id', 'count', 'total', 'average', 'score'], aggregate))
+        db.session.commit()
+
+    @classmethod
+    def top(cls, limit):
+        """The best scoring restaurants with their summaries, read straight off the score index"""
+        return db.session.query(Restaurant, cls).join(cls, cls.restaurant_id == Restaurant.id) \
+            .filter(Restaurant.deleted_at.is_(None)) \
+            .order_by(cls.score.desc(), cls.restaurant_id.desc()).limit(limit).all()
+
+#one row per deleted restaurant or user, the purge worker claims it and records how far it has got
+class PurgeJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'restaurant' or 'user'
+    target_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(250))
+    total = db.Column(db.Integer, nullable=False, default=0)  # menu items and ratings to remove
+    purged = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime, index=True)
+    # the process working on the job and when it last made progress, a stale heartbeat can be taken over
+    worker = db.Column(db.String(64))
+    heartbeat = db.Column(db.DateTime)
+
+    @property
+    def status(self):
+        if self.finished_at is not None:
+            return 'done'
+        return 'purging' if self.started_at is not None else 'waiting'
+
+    @property
+    def percent(self):
+        if self.finished_at is not None:
+            return 100
+        return min(99, self.purged * 100 // self.total) if self.total else 0
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializable format"""
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'target_id': self.target_id,
+            'name': self.name,
+            'total': self.total,
+            'purged': self.purged,
+            'percent': self.percent,
+            'status': self.status,
+        }
+
 #search form code
 class SearchForm(FlaskForm):
     searched = StringField("Searched", validators=[DataRequired()])
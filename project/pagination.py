@@ -0,0 +1,79 @@
+import base64
+import json as pyjs
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+
+#cursors are the sort key of the first/last row on a page, encoded so they can go in a url
+def encode_cursor(values):
+    raw = pyjs.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """Turn a cursor back into its key values, returns None for anything malformed"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = pyjs.loads(raw.decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    # only plain key values, anything else would fail when it is bound into the comparison
+    if not all(isinstance(value, (str, int, float)) and not isinstance(value, bool) for value in values):
+        return None
+    return values
+
+
+def page_size(value, default=DEFAULT_PAGE_SIZE):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+class KeysetPage(object):
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def keyset_page(query, columns, key, after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """Fetch one page of query ordered by columns.
+
+    Pages are found by comparing the sort key against the cursor instead of using
+    OFFSET, so with an index on columns every page costs the same as the first one.
+    key pulls the sort key values out of a result row.
+    """
+    after = decode_cursor(after, len(columns))
+    before = decode_cursor(before, len(columns)) if after is None else None
+    sort_key = tuple_(*columns)
+
+    if before is not None:
+        # walk backwards from the cursor then flip the rows back into display order
+        rows = query.filter(sort_key < tuple_(*before)) \
+            .order_by(*[column.desc() for column in columns]) \
+            .limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+        has_prev, has_next = has_more, True
+    else:
+        if after is not None:
+            query = query.filter(sort_key > tuple_(*after))
+        rows = query.order_by(*[column.asc() for column in columns]).limit(limit + 1).all()
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+        has_prev = after is not None
+
+    next_cursor = encode_cursor(key(rows[-1])) if rows and has_next else None
+    prev_cursor = encode_cursor(key(rows[0])) if rows and has_prev else None
+    return KeysetPage(rows, next_cursor, prev_cursor)
@@ -0,0 +1,77 @@
+import re
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+# Prices are stored as whole cents (MenuItem.price_cents) so SQL can sort, range and sum them.
+# These turn the "$2.99" style strings people type (and older databases hold) into cents and back.
+MAX_PRICE_CENTS = 100000 * 100
+
+SORTS = {
+    'price': 'asc',
+    '-price': 'desc',
+}
+
+
+def parse_price(value):
+    """'$2.99', '2.99', '$.99', '25' or '1,299.50' -> cents as an int, ValueError if it isn't a price"""
+    text = re.sub(r'[\s$,]', '', str(value if value is not None else ''))
+    try:
+        amount = Decimal(text)
+        whole_cents = amount.is_finite() and amount == amount.quantize(Decimal('0.01'))
+    except InvalidOperation:
+        whole_cents = False
+    if not whole_cents:
+        raise ValueError('not a price: %r' % value)
+    cents = int(amount * 100)
+    if cents < 0 or cents > MAX_PRICE_CENTS:
+        raise ValueError('price out of range: %r' % value)
+    return cents
+
+
+def format_price(cents):
+    """cents -> '$2.99', None stays None"""
+    if cents is None:
+        return None
+    return '$%d.%02d' % divmod(cents, 100)
+
+
+class PriceFilter(namedtuple('PriceFilter', 'min_cents max_cents sort')):
+    """?min_price=, ?max_price= and ?sort=price|-price from a request, values that don't parse are ignored"""
+
+    @classmethod
+    def from_args(cls, args):
+        def price(name):
+            try:
+                return parse_price(args.get(name)) if args.get(name) else None
+            except ValueError:
+                return None
+        sort = args.get('sort')
+        return cls(price('min_price'), price('max_price'), sort if sort in SORTS else None)
+
+    @property
+    def active(self):
+        return self != NO_FILTER
+
+    def apply(self, query, column):
+        """Push the range and ordering into the query on column (a price_cents column)"""
+        if self.min_cents is not None:
+            query = query.filter(column >= self.min_cents)
+        if self.max_cents is not None:
+            query = query.filter(column <= self.max_cents)
+        if self.sort:
+            query = query.order_by(getattr(column, SORTS[self.sort])())
+        return query
+
+    def args(self):
+        """Back to query string arguments, for links that keep the filter"""
+        args = {}
+        if self.min_cents is not None:
+            args['min_price'] = '%d.%02d' % divmod(self.min_cents, 100)
+        if self.max_cents is not None:
+            args['max_price'] = '%d.%02d' % divmod(self.max_cents, 100)
+        if self.sort:
+            args['sort'] = self.sort
+        return args
+
+
+NO_FILTER = PriceFilter(None, None, None)
@@ -0,0 +1,97 @@
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Per request SQL accounting.
+#
+# Every statement run through SQLAlchemy is counted and timed against the current request. The totals go
+# out in a Server-Timing header (visible in the browser dev tools) and a warning is logged when an endpoint
+# runs more queries than its budget, which is how N+1 loops show up. QUERY_BUDGETS maps endpoint names
+# to a budget, anything else gets QUERY_BUDGET_DEFAULT.
+DEFAULTS = {
+    'QUERY_PROFILING': True,
+    'QUERY_BUDGET_DEFAULT': 20,
+    'QUERY_BUDGETS': {},
+}
+
+# count_queries() blocks active in this thread
+_local = threading.local()
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries():
+    """Count the statements run in this thread inside the block
+
+        with count_queries() as queries:
+            client.get('/restaurant/')
+        assert queries.count <= 3, queries.statements
+    """
+    counter = QueryCounter()
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    elapsed = time.perf_counter() - started
+    for counter in getattr(_local, 'counters', ()):
+        counter.add(statement, elapsed)
+    if has_app_context() and getattr(g, 'queries', None) is not None:
+        g.queries.add(statement, elapsed)
+
+
+def query_budget(app, endpoint):
+    return app.config['QUERY_BUDGETS'].get(endpoint, app.config['QUERY_BUDGET_DEFAULT'])
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    if not app.config['QUERY_PROFILING']:
+        return
+
+    @app.before_request
+    def start_query_count():
+        g.queries = QueryCounter()
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def report_query_count(response):
+        queries = getattr(g, 'queries', None)
+        if queries is None:
+            return response
+        total = time.perf_counter() - g.request_started
+        response.headers.add('Server-Timing', 'db;desc="%d queries";dur=%.1f' % (queries.count, queries.seconds * 1000))
+        response.headers.add('Server-Timing', 'app;dur=%.1f' % (total * 1000))
+        budget = query_budget(app, request.endpoint)
+        if queries.count > budget:
+            app.logger.warning("%s ran %d queries (budget %d, %.1fms in the database) for %s",
+                               request.endpoint, queries.count, budget, queries.seconds * 1000, request.path)
+        return response
@@ -0,0 +1,229 @@
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import or_, func
+from . import db
+from . import search as search_index
+from .models import User, Restaurant, MenuItem, Rating, RatingSummary, PurgeJob
+
+# Deleting a restaurant or user only sets deleted_at and queues a PurgeJob, so the request is a couple of
+# small statements however big the restaurant is. Every query filters on deleted_at IS NULL from then on.
+#
+# A background thread in each process claims queued jobs and deletes the menu items and ratings
+# PURGE_BATCH_SIZE rows at a time, committing and pausing between batches so other writers get the
+# database lock, then deletes the row itself. Jobs are claimed through the purge_job table, so several
+# worker processes never purge the same thing, and a job whose worker died (no heartbeat for
+# PURGE_STALE_SECONDS) is picked up by another one. Progress shows on the admin panel.
+#
+#   python purge_deleted.py      - run the queued jobs in the foreground, e.g. with PURGE_ENABLED off
+DEFAULTS = {
+    'PURGE_ENABLED': True,
+    'PURGE_BATCH_SIZE': 500,
+    'PURGE_PAUSE_SECONDS': 0.05,
+    'PURGE_POLL_SECONDS': 30.0,
+    'PURGE_STALE_SECONDS': 120,
+}
+
+
+def _ids(query):
+    return [row[0] for row in query]
+
+
+def delete_restaurants(restaurant_ids):
+    """Soft delete restaurants and queue their purge inside the caller's transaction, returns the number deleted"""
+    restaurants = db.session.query(Restaurant.id, Restaurant.name) \
+        .filter(Restaurant.id.in_(restaurant_ids), Restaurant.deleted_at.is_(None)).all()
+    if not restaurants:
+        return 0
+    ids = [restaurant_id for restaurant_id, name in restaurants]
+    now = datetime.utcnow()
+    Restaurant.query.filter(Restaurant.id.in_(ids)).update({
+        Restaurant.deleted_at: now,
+        Restaurant.version: Restaurant.version + 1,
+        Restaurant.updated_at: now,
+    }, synchronize_session=False)
+    totals = _counts(MenuItem.restaurant_id, ids)
+    for restaurant_id, count in _counts(Rating.restaurant_id, ids).items():
+        totals[restaurant_id] = totals.get(restaurant_id, 0) + count
+    _queue('restaurant', [(restaurant_id, name, totals.get(restaurant_id, 0)) for restaurant_id, name in restaurants])
+    search_index.search_cache.clear()
+    return len(ids)
+
+
+def delete_users(user_ids):
+    """Soft delete users and queue their purge, their restaurants go to the admin account straight away.
+    Callers invalidate the cached users after committing"""
+    users = db.session.query(User.id, User.username) \
+        .filter(User.id.in_(user_ids), User.deleted_at.is_(None), User.username != 'admin').all()
+    if not users:
+        return 0
+    ids = [user_id for user_id, username in users]
+    now = datetime.utcnow()
+    admin_id = db.session.query(User.id).filter_by(username='admin').scalar()
+    Restaurant.query.filter(Restaurant.ownerid.in_(ids)).update({
+        Restaurant.ownerid: admin_id,
+        Restaurant.version: Restaurant.version + 1,
+        Restaurant.updated_at: now,
+    }, synchronize_session=False)
+    User.query.filter(User.id.in_(ids)).update({User.deleted_at: now}, synchronize_session=False)
+    totals = _counts(Rating.user_id, ids)
+    _queue('user', [(user_id, username, totals.get(user_id, 0)) for user_id, username in users])
+    return len(ids)
+
+
+def _counts(column, ids):
+    return dict(db.session.query(column, func.count()).filter(column.in_(ids)).group_by(column))
+
+
+def _queue(kind, targets):
+    db.session.execute(PurgeJob.__table__.insert(), [
+        {'kind': kind, 'target_id': target_id, 'name': name, 'total': total, 'purged': 0,
+         'created_at': datetime.utcnow()} for target_id, name, total in targets])
+
+
+def recent_jobs(limit=10):
+    """Unfinished jobs and the latest finished ones, newest first, for the admin panel"""
+    return PurgeJob.query.order_by(PurgeJob.finished_at.isnot(None), PurgeJob.id.desc()).limit(limit).all()
+
+
+class Purger(object):
+    def __init__(self):
+        self.app = None
+        self._pid = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        for key, value in DEFAULTS.items():
+            app.config.setdefault(key, value)
+        if not app.config['PURGE_ENABLED']:
+            return
+        self.app = app
+
+        # started by the first request of each process, so a forked worker gets its own thread
+        @app.before_request
+        def start_purge_worker():
+            self.start()
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name='purge-worker', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """Check for new jobs now instead of at the next poll, call after committing a delete"""
+        self._wake.set()
+
+    def _loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            self._wake.wait(self.app.config['PURGE_POLL_SECONDS'])
+            self._wake.clear()
+            with self.app.app_context():
+                try:
+                    run_pending(self.app.config)
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('purge worker failed, retrying at the next poll')
+                finally:
+                    db.session.remove()
+
+
+def run_pending(config, worker=None):
+    """Claim and purge queued jobs until there are none left, returns how many were finished"""
+    worker = worker or '%s:%d' % (socket.gethostname(), os.getpid())
+    done = 0
+    while True:
+        job = _claim(worker, config['PURGE_STALE_SECONDS'])
+        if job is None:
+            return done
+        if job.kind == 'restaurant':
+            _purge_restaurant(job, config)
+        else:
+            _purge_user(job, config)
+        done += 1
+
+
+def _claim(worker, stale_seconds):
+    while True:
+        now = datetime.utcnow()
+        claimable = [PurgeJob.finished_at.is_(None),
+                     or_(PurgeJob.worker.is_(None), PurgeJob.heartbeat < now - timedelta(seconds=stale_seconds))]
+        job_id = db.session.query(PurgeJob.id).filter(*claimable).order_by(PurgeJob.id).limit(1).scalar()
+        if job_id is None:
+            db.session.commit()
+            return None
+        # only one worker's UPDATE can match the unclaimed row
+        claimed = PurgeJob.query.filter(PurgeJob.id == job_id, *claimable).update({
+            PurgeJob.worker: worker,
+            PurgeJob.heartbeat: now,
+            PurgeJob.started_at: func.coalesce(PurgeJob.started_at, now),
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return PurgeJob.query.get(job_id)
+
+
+def _batch_done(job_id, count, config):
+    # the commit ends the write transaction, the pause lets waiting writers have the lock
+    PurgeJob.query.filter_by(id=job_id).update({
+        PurgeJob.purged: PurgeJob.purged + count,
+        PurgeJob.heartbeat: datetime.utcnow(),
+    }, synchronize_session=False)
+    db.session.commit()
+    time.sleep(config['PURGE_PAUSE_SECONDS'])
+
+
+def _finish(job_id):
+    PurgeJob.query.filter_by(id=job_id).update({PurgeJob.finished_at: datetime.utcnow()},
+                                               synchronize_session=False)
+    db.session.commit()
+
+
+def _purge_restaurant(job, config):
+    job_id, restaurant_id, size = job.id, job.target_id, config['PURGE_BATCH_SIZE']
+    while True:
+        ids = _ids(db.session.query(MenuItem.id).filter(MenuItem.restaurant_id == restaurant_id).limit(size))
+        if not ids:
+            break
+        search_index.remove_menu_items(ids)
+        MenuItem.query.filter(MenuItem.id.in_(ids)).delete(synchronize_session=False)
+        _batch_done(job_id, len(ids), config)
+    while True:
+        ids = _ids(db.session.query(Rating.id).filter(Rating.restaurant_id == restaurant_id).limit(size))
+        if not ids:
+            break
+        Rating.query.filter(Rating.id.in_(ids)).delete(synchronize_session=False)
+        _batch_done(job_id, len(ids), config)
+    # nothing is left to cascade to but the rating summary
+    search_index.remove_restaurants([restaurant_id])
+    Restaurant.query.filter(Restaurant.id == restaurant_id, Restaurant.deleted_at.isnot(None)) \
+        .delete(synchronize_session=False)
+    _finish(job_id)
+
+
+def _purge_user(job, config):
+    job_id, user_id, size = job.id, job.target_id, config['PURGE_BATCH_SIZE']
+    while True:
+        rows = db.session.query(Rating.id, Rating.restaurant_id).filter(Rating.user_id == user_id).limit(size).all()
+        if not rows:
+            break
+        Rating.query.filter(Rating.id.in_([rating_id for rating_id, restaurant_id in rows])) \
+            .delete(synchronize_session=False)
+        RatingSummary.refresh_many(set(restaurant_id for rating_id, restaurant_id in rows))
+        _batch_done(job_id, len(rows), config)
+    # anything handed to the user after they were deleted goes to the admin account too
+    admin_id = db.session.query(User.id).filter_by(username='admin').scalar()
+    Restaurant.query.filter(Restaurant.ownerid == user_id).update({Restaurant.ownerid: admin_id},
+                                                                  synchronize_session=False)
+    User.query.filter(User.id == user_id, User.deleted_at.isnot(None)).delete(synchronize_session=False)
+    _finish(job_id)
+
+
+purger = Purger()
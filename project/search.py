@@ -0,0 +1,265 @@
+import re
+import weakref
+from sqlalchemy import text, bindparam
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import contains_eager
+from . import db
+from .cache import LRUCache
+from .models import Restaurant, MenuItem
+from .prices import NO_FILTER, SORTS
+
+# Full text search over restaurants and menu items backed by an SQLite FTS5 table.
+# Each row's rowid encodes what it points at: id * 2 for a restaurant, id * 2 + 1 for a menu item,
+# so rows can be replaced or removed by rowid without scanning the index.
+SEARCH_TABLE = 'search_index'
+RESTAURANT = 0
+MENU_ITEM = 1
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+# column weights for bm25 ranking (name, description, course, restaurant_id)
+RANK_WEIGHTS = (10.0, 2.0, 1.0, 0.0)
+
+# keyed by engine rather than url, two apps can point at different databases with the same url
+# (e.g. in memory sqlite in the tests)
+_available = weakref.WeakKeyDictionary()
+
+# recent results keyed by (normalised term, limit). Any index write clears it and the
+# short ttl bounds how stale other worker processes can get.
+search_cache = LRUCache(maxsize=256, ttl=30)
+
+
+def fts_available():
+    """Make sure the FTS5 table exists, returns False if the database can't provide one.
+
+    The first call in a process may create and fill the table and commits, so it is
+    made before each request (see main.prepare_search) rather than mid transaction.
+    """
+    engine = db.engine
+    if engine in _available:
+        return _available[engine]
+    if db.engine.dialect.name != 'sqlite':
+        _available[engine] = False
+        return False
+    exists = db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                                {'name': SEARCH_TABLE}).first()
+    try:
+        create_index()
+    except OperationalError:
+        # sqlite was built without fts5, searches fall back to LIKE
+        db.session.rollback()
+        _available[engine] = False
+        return False
+    _available[engine] = True
+    if not exists:
+        rebuild_index()
+    return True
+
+
+def create_index():
+    db.session.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5("
+        "name, description, course, restaurant_id UNINDEXED, "
+        "tokenize = 'unicode61', prefix = '2 3')" % SEARCH_TABLE))
+    db.session.commit()
+
+
+def rebuild_index():
+    """Repopulate the whole index from the restaurant and menu_item tables, leaving out deleted restaurants"""
+    search_cache.clear()
+    db.session.execute(text("DELETE FROM %s" % SEARCH_TABLE))
+    db.session.execute(text(
+        "INSERT INTO %s (rowid, name, description, course, restaurant_id) "
+        "SELECT id * 2, name, '', '', id FROM restaurant WHERE deleted_at IS NULL" % SEARCH_TABLE))
+    db.session.execute(text(
+        "INSERT INTO %s (rowid, name, description, course, restaurant_id) "
+        "SELECT menu_item.id * 2 + 1, menu_item.name, coalesce(menu_item.description, ''), "
+        "coalesce(menu_item.course, ''), menu_item.restaurant_id "
+        "FROM menu_item JOIN restaurant ON restaurant.id = menu_item.restaurant_id "
+        "AND restaurant.deleted_at IS NULL" % SEARCH_TABLE))
+    db.session.commit()
+
+
+def _rowid(kind, ref_id):
+    return ref_id * 2 + kind
+
+
+def _write(kind, ref_id, name, description, course, restaurant_id):
+    _delete(kind, ref_id)
+    db.session.execute(text(
+        "INSERT INTO %s (rowid, name, description, course, restaurant_id) "
+        "VALUES (:rowid, :name, :description, :course, :restaurant_id)" % SEARCH_TABLE),
+        {'rowid': _rowid(kind, ref_id), 'name': str(name or ''), 'description': str(description or ''),
+         'course': str(course or ''), 'restaurant_id': restaurant_id})
+
+
+def _delete(kind, ref_id):
+    search_cache.clear()
+    db.session.execute(text("DELETE FROM %s WHERE rowid = :rowid" % SEARCH_TABLE),
+                       {'rowid': _rowid(kind, ref_id)})
+
+
+# The index_/remove_ helpers run inside the caller's session so the index
+# changes commit (or roll back) together with the row they describe.
+# Callers must flush first so new rows have an id.
+def index_restaurant(restaurant):
+    if fts_available():
+        _write(RESTAURANT, restaurant.id, restaurant.name, '', '', restaurant.id)
+
+
+def index_menu_item(item):
+    if fts_available():
+        _write(MENU_ITEM, item.id, item.name, item.description, item.course, item.restaurant_id)
+
+
+def remove_menu_item(menu_id):
+    if fts_available():
+        _delete(MENU_ITEM, menu_id)
+
+
+def index_menu_items(items):
+    """index_menu_item for many items at once, one DELETE and one executemany INSERT"""
+    if items and fts_available():
+        remove_menu_items([item.id for item in items])
+        db.session.execute(text(
+            "INSERT INTO %s (rowid, name, description, course, restaurant_id) "
+            "VALUES (:rowid, :name, :description, :course, :restaurant_id)" % SEARCH_TABLE),
+            [{'rowid': _rowid(MENU_ITEM, item.id), 'name': str(item.name or ''),
+              'description': str(item.description or ''), 'course': str(item.course or ''),
+              'restaurant_id': item.restaurant_id} for item in items])
+
+
+def remove_menu_items(menu_ids):
+    if menu_ids and fts_available():
+        search_cache.clear()
+        for start in range(0, len(menu_ids), 500):
+            rowids = [_rowid(MENU_ITEM, menu_id) for menu_id in menu_ids[start:start + 500]]
+            db.session.execute(text("DELETE FROM %s WHERE rowid IN (%s)"
+                                    % (SEARCH_TABLE, ', '.join(str(rowid) for rowid in rowids))))
+
+
+def remove_restaurant(restaurant_id):
+    remove_restaurants([restaurant_id])
+
+
+def remove_restaurants(restaurant_ids):
+    """Take restaurants and their menu items out of the index, call before the rows are deleted"""
+    if restaurant_ids and fts_available():
+        search_cache.clear()
+        db.session.execute(text("DELETE FROM %s WHERE rowid IN :rowids" % SEARCH_TABLE)
+                           .bindparams(bindparam('rowids', expanding=True)),
+                           {'rowids': [_rowid(RESTAURANT, restaurant_id) for restaurant_id in restaurant_ids]})
+        db.session.execute(text(
+            "DELETE FROM %s WHERE rowid IN (SELECT id * 2 + 1 FROM menu_item WHERE restaurant_id IN :restaurant_ids)"
+            % SEARCH_TABLE).bindparams(bindparam('restaurant_ids', expanding=True)),
+            {'restaurant_ids': list(restaurant_ids)})
+
+
+def match_expression(term):
+    """Turn a search term into an FTS5 query where every word is a quoted prefix match"""
+    words = re.findall(r'\w+', term or '')
+    return ' '.join('"%s"*' % word for word in words)
+
+
+def _ranked_ids(expression, kind, limit):
+    # soft deleted restaurants keep their rows until the purge gets to them, so they are joined
+    # out before the LIMIT or a big deleted restaurant could take every slot
+    rows = db.session.execute(text(
+        "SELECT %s.rowid FROM %s JOIN restaurant ON restaurant.id = %s.restaurant_id "
+        "AND restaurant.deleted_at IS NULL "
+        "WHERE %s MATCH :expression AND %s.rowid %% 2 = :kind "
+        "ORDER BY bm25(%s, %s) LIMIT :limit"
+        % (SEARCH_TABLE, SEARCH_TABLE, SEARCH_TABLE, SEARCH_TABLE, SEARCH_TABLE, SEARCH_TABLE,
+           ', '.join(str(w) for w in RANK_WEIGHTS))),
+        {'expression': expression, 'kind': kind, 'limit': limit})
+    return [row[0] // 2 for row in rows]
+
+
+def _ranked_item_ids(expression, limit, price_filter):
+    if not price_filter.active:
+        return _ranked_ids(expression, MENU_ITEM, limit)
+    # join the matches to menu_item so the price range and price order apply before the limit
+    conditions, params = [], {'expression': expression, 'limit': limit}
+    if price_filter.min_cents is not None:
+        conditions.append("AND menu_item.price_cents >= :min_cents")
+        params['min_cents'] = price_filter.min_cents
+    if price_filter.max_cents is not None:
+        conditions.append("AND menu_item.price_cents <= :max_cents")
+        params['max_cents'] = price_filter.max_cents
+    order = 'menu_item.price_cents %s, ' % SORTS[price_filter.sort].upper() if price_filter.sort else ''
+    rows = db.session.execute(text(
+        "SELECT menu_item.id FROM %s JOIN menu_item ON menu_item.id = %s.rowid / 2 "
+        "JOIN restaurant ON restaurant.id = menu_item.restaurant_id AND restaurant.deleted_at IS NULL "
+        "WHERE %s MATCH :expression AND %s.rowid %% 2 = 1 %s "
+        "ORDER BY %sbm25(%s, %s) LIMIT :limit"
+        % (SEARCH_TABLE, SEARCH_TABLE, SEARCH_TABLE, SEARCH_TABLE, ' '.join(conditions), order,
+           SEARCH_TABLE, ', '.join(str(w) for w in RANK_WEIGHTS))), params)
+    return [row[0] for row in rows]
+
+
+def normalise(term):
+    return ' '.join(re.findall(r'\w+', (term or '').lower()))
+
+
+def _item_result(item):
+    restaurant = item.restaurant
+    return {
+        'id': item.id,
+        'name': item.name,
+        'description': item.description,
+        'price': item.price,
+        'price_cents': item.price_cents,
+        'course': item.course,
+        'restaurant_id': item.restaurant_id,
+        'restaurant': {'id': restaurant.id, 'name': restaurant.name} if restaurant else None,
+    }
+
+
+def _restaurant_result(restaurant):
+    return {'id': restaurant.id, 'name': restaurant.name}
+
+
+def _in_rank_order(query, ids):
+    if not ids:
+        return []
+    entity = query.column_descriptions[0]['entity']
+    found = dict((obj.id, obj) for obj in query.filter(entity.id.in_(ids)))
+    return [found[i] for i in ids if i in found]
+
+
+def _run_search(term, limit, price_filter):
+    # menu items come back with their restaurant in the same query (no lazy load per hit),
+    # anything belonging to a deleted restaurant is dropped
+    items_query = MenuItem.query.join(MenuItem.restaurant).options(contains_eager(MenuItem.restaurant)) \
+        .filter(Restaurant.deleted_at.is_(None))
+    expression = match_expression(term)
+
+    if fts_available():
+        items = _in_rank_order(items_query, _ranked_item_ids(expression, limit, price_filter))
+        restaurants = _in_rank_order(Restaurant.live(), _ranked_ids(expression, RESTAURANT, limit))
+    else:
+        # no FTS5 on this database, fall back to unranked LIKE matching
+        pattern = '%' + term + '%'
+        items = price_filter.apply(items_query.filter(MenuItem.name.like(pattern) | MenuItem.description.like(pattern)),
+                                   MenuItem.price_cents).limit(limit).all()
+        restaurants = Restaurant.live().filter(Restaurant.name.like(pattern)).limit(limit).all()
+
+    return [_item_result(item) for item in items], [_restaurant_result(r) for r in restaurants]
+
+
+def search(term, limit=DEFAULT_LIMIT, price_filter=NO_FILTER):
+    """Return (menu items, restaurants) matching term as plain dicts, best matches first.
+
+    price_filter limits the menu items to a price range and/or orders them by price.
+    """
+    limit = max(1, min(limit, MAX_LIMIT))
+    term = normalise(term)
+    if not term:
+        return [], []
+
+    key = (term, limit, price_filter)
+    results = search_cache.get(key)
+    if results is None:
+        results = _run_search(term, limit, price_filter)
+        search_cache.set(key, results)
+    return results
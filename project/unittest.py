@@ -1,12 +1,36 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
-from project import create_app, db
-from project.models import User
-from werkzeug.security import check_password_hash
+from project import create_app, db, dataset
+from project import purge, search
+from project.models import User, Restaurant, Rating, RatingSummary, MenuItem, PurgeJob
+from project.profiling import count_queries
+from project.pagination import encode_cursor
+from project.user_cache import user_cache
+from project.search import search_cache
+from project.main import menu_cache
+from project.hashing import passwords
+from project.audit_index import AuditQuery, parse_ts
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# in memory database so the tests never touch restaurantmenu.db, and cheap inline password hashing
+TEST_CONFIG = {
+    'DATABASE_URL': 'sqlite://',
+    'WTF_CSRF_ENABLED': False,
+    'PASSWORD_HASH_WORKERS': 0,
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+    'PURGE_ENABLED': False,
+    # keep the audit log and metrics files out of the working tree
+    'AUDIT_LOG_FILE': os.path.join(tempfile.mkdtemp(prefix='restaurant-tests-'), 'log_file.txt'),
+    'METRICS_ENABLED': False,
+}
 
 
 class TestWebApp(unittest.TestCase):
     def setUp(self):
-        self.app = create_app()
+        self.app = create_app(TEST_CONFIG)
         self.app.config['WTF_CSRF_ENABLED'] = False  
         self.appctx = self.app.app_context()
         self.appctx.push()
@@ -75,7 +99,7 @@ class TestWebApp(unittest.TestCase):
     def test_XSS(self):
         response = self.client.post('/register', data={
             'username': '<script> alert("XSS");</script>',
-            'password' : 'COMPLEX123'
+            'password' : 'COMPLEX123',
             'confirm_password': 'COMPLEX123'
         }, follow_redirects=True)
         assert response.status_code == 200
@@ -90,7 +114,7 @@ class TestWebApp(unittest.TestCase):
     def test_Password_Hashes(self):
         response = self.client.post('/register', data = {
             'username' : 'alice',
-            'password' : 'COMPLEX123'
+            'password' : 'COMPLEX123',
             'confirm_password': 'COMPLEX123'
         }, follow_redirects = True)
         assert response.status_code == 200
@@ -101,10 +125,19 @@ class TestWebApp(unittest.TestCase):
         assert user is not None
         assert check_password_hash(user.password, 'COMPLEX123')
 
+    def test_needs_rehash_with_default_cost(self):
+        # 'pbkdf2:sha256' hashes come out as pbkdf2:sha256:<iterations>, they shouldn't be rehashed every login
+        passwords.configure(method='pbkdf2:sha256')
+        try:
+            assert not passwords.needs_rehash(passwords.hash('COMPLEX123'))
+            assert passwords.needs_rehash(generate_password_hash('COMPLEX123', 'pbkdf2:sha256:1000'))
+        finally:
+            passwords.configure(method=TEST_CONFIG['PASSWORD_HASH_METHOD'])
+
     def test_sqli(self):
         response = self.client.post('/register', data = {
             'username' : 'alice"; drop table user; --',
-            'password' : 'COMPLEX123'
+            'password' : 'COMPLEX123',
             'confirm_password': 'COMPLEX123'
         }, follow_redirects = True)
         assert response.status_code == 200 
@@ -128,4 +161,265 @@ class TestWebApp(unittest.TestCase):
     # Checking for any input sanitization or output encoding is applied to prevent XSS attacks
     #assert '&lt;script&gt;alert("XSS attack!");&lt;/script&gt;' in response.get_data(as_text=True) 
 
-    
\ No newline at end of file
+    
+
+
+#query count checks, seeded with the synthetic dataset so a per row query (N+1) would blow the budget
+class TestQueryCounts(unittest.TestCase):
+    BASE_URL = 'https://localhost'
+
+    def setUp(self):
+        self.app = create_app(TEST_CONFIG)
+        self.appctx = self.app.app_context()
+        self.appctx.push()
+        db.create_all()
+        dataset.generate(restaurants=30, menu_items=300, users=30, ratings=300, seed=3310)
+        admin = User(username='admin', role='admin')
+        admin.set_password('Admin123!')
+        db.session.add(admin)
+        db.session.commit()
+        for cache in (user_cache, search_cache, menu_cache):
+            cache.clear()
+        self.restaurant_id = Restaurant.query.order_by(Restaurant.id).first().id
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.appctx.pop()
+
+    def login(self):
+        response = self.client.post('/login', data={'username': 'admin', 'password': 'Admin123!'},
+                                    base_url=self.BASE_URL)
+        self.assertEqual(response.status_code, 302)
+        self.client.get('/restaurant/', base_url=self.BASE_URL) # loads the user into the user cache
+
+    def assertMaxQueries(self, url, budget):
+        with count_queries() as queries:
+            response = self.client.get(url, base_url=self.BASE_URL)
+        self.assertEqual(response.status_code, 200, url)
+        self.assertLessEqual(queries.count, budget, '%s ran %d queries:\n%s'
+                             % (url, queries.count, '\n'.join(queries.statements)))
+        return response
+
+    def test_public_pages(self):
+        self.assertMaxQueries('/restaurant/', 1)
+        self.assertMaxQueries('/restaurant/%d/menu' % self.restaurant_id, 2)
+        self.assertMaxQueries('/search_results/user', 3)
+
+    def test_json_pages(self):
+        self.assertMaxQueries('/restaurant/JSON', 1)
+        self.assertMaxQueries('/restaurant/%d/menu/JSON' % self.restaurant_id, 1)
+
+    def test_bad_cursor_is_first_page(self):
+        first = self.client.get('/restaurant/JSON', base_url=self.BASE_URL).get_json()
+        cursor = encode_cursor([{}, 1])
+        response = self.client.get('/restaurant/JSON?after=%s' % cursor, base_url=self.BASE_URL)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), first)
+        # the page links keep ?limit=
+        page = self.client.get('/restaurant/?limit=5', base_url=self.BASE_URL).get_data(as_text=True)
+        self.assertIn('limit=5', page)
+
+    def test_top_restaurants(self):
+        self.assertMaxQueries('/restaurant/top', 1)
+        top = self.assertMaxQueries('/restaurant/top/JSON?limit=10', 1).get_json()['restaurants']
+        self.assertEqual(len(top), 10)
+        scores = [restaurant['score'] for restaurant in top]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        # the stored score matches the bayesian average worked out from the ratings
+        ratings = [rating.rating for rating in Rating.query.filter_by(restaurant_id=top[0]['id'])]
+        self.assertAlmostEqual(top[0]['score'], (sum(ratings) + 10 * 3.0) / (len(ratings) + 10), places=3)
+
+    def test_logged_in_pages(self):
+        self.login()
+        self.assertMaxQueries('/restaurant/', 1)
+        self.assertMaxQueries('/restaurant/%d/menu' % self.restaurant_id, 2)
+        self.assertMaxQueries('/restaurant/%d/ratings' % self.restaurant_id, 4)
+        self.assertMaxQueries('/restaurant/%d/ratings/JSON' % self.restaurant_id, 3)
+        self.assertMaxQueries('/admin', 3)
+
+    def test_rating_submit_adjusts_summary(self):
+        self.login()
+        url = '/restaurant/%d/ratings' % self.restaurant_id
+        for rating in (2, 5):  # a new rating, then the same user changing it
+            self.client.post(url, data={'rating': rating}, base_url=self.BASE_URL)
+            admin = User.query.filter_by(username='admin').one()
+            self.assertEqual(Rating.query.filter_by(restaurant_id=self.restaurant_id, user_id=admin.id).one().rating, rating)
+            ratings = [r.rating for r in Rating.query.filter_by(restaurant_id=self.restaurant_id)]
+            summary = RatingSummary.query.get(self.restaurant_id)
+            db.session.refresh(summary)
+            self.assertEqual((summary.count, summary.total), (len(ratings), sum(ratings)))
+            self.assertAlmostEqual(summary.average, sum(ratings) / float(len(ratings)))
+
+    def test_server_timing_header(self):
+        response = self.assertMaxQueries('/restaurant/', 1)
+        timings = response.headers.getlist('Server-Timing')
+        assert timings[0].startswith('db;desc="1 queries";dur=')
+        assert timings[1].startswith('app;dur=')
+
+    def test_budget_warning(self):
+        self.app.config['QUERY_BUDGETS'] = {'main.showRestaurants': 0}
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/restaurant/', base_url=self.BASE_URL)
+        assert 'main.showRestaurants ran 1 queries (budget 0' in logs.output[0]
+
+
+#bulk menu upload, the whole document is applied in one go or not at all
+class TestMenuUpload(unittest.TestCase):
+    BASE_URL = 'https://localhost'
+
+    def setUp(self):
+        self.app = create_app(TEST_CONFIG)
+        self.appctx = self.app.app_context()
+        self.appctx.push()
+        db.create_all()
+        owner = User(username='owner', role='owner')
+        owner.set_password('Owner123!')
+        db.session.add(owner)
+        db.session.flush()
+        restaurant = Restaurant(name='Diner', ownerid=owner.id)
+        db.session.add(restaurant)
+        db.session.flush()
+        db.session.add_all([MenuItem(name='Burger', description='beef', price_cents=900, course='Entree',
+                                     restaurant_id=restaurant.id),
+                            MenuItem(name='Cola', description='', price_cents=300, course='Beverage',
+                                     restaurant_id=restaurant.id)])
+        db.session.commit()
+        self.restaurant_id = restaurant.id
+        self.client = self.app.test_client()
+        self.client.post('/login', data={'username': 'owner', 'password': 'Owner123!'}, base_url=self.BASE_URL)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.appctx.pop()
+
+    def upload(self, data, content_type):
+        return self.client.post('/restaurant/%d/menu/upload' % self.restaurant_id, data=data,
+                                content_type=content_type, base_url=self.BASE_URL)
+
+    def test_upload_diffs_menu(self):
+        response = self.upload('name,description,price,course\nBurger,beef,9.50,Entree\n'
+                               'Fish & Chips,<b>fresh</b>,$12,Entree\n', 'text/csv')
+        self.assertEqual(response.status_code, 200)
+        result = response.get_json()
+        self.assertEqual([item['name'] for item in result['created']], ['Fish &amp; Chips'])
+        self.assertEqual([item['price'] for item in result['updated']], ['$9.50'])
+        self.assertEqual([item['name'] for item in result['deleted']], ['Cola'])
+        items = dict((item.name, item) for item in MenuItem.query.filter_by(restaurant_id=self.restaurant_id))
+        self.assertEqual(sorted(items), ['Burger', 'Fish &amp; Chips'])
+        self.assertEqual(items['Fish &amp; Chips'].description, 'bfreshb')
+        self.assertEqual(Restaurant.query.get(self.restaurant_id).version, 2)
+
+    def test_rows_without_a_price(self):
+        response = self.upload('name,description,price,course\nBurger,beef,,Entree\nCola,,9.00,Beverage\n'
+                               'Water,,,Beverage\n', 'text/csv')
+        self.assertEqual(response.status_code, 200)
+        response = self.upload('[{"name": "Burger", "price": null}, {"name": "Cola", "price": "9.00"}, {"name": "Water"}]',
+                               'application/json')
+        self.assertEqual(response.status_code, 200)
+        prices = dict((item.name, item.price_cents) for item in MenuItem.query.filter_by(restaurant_id=self.restaurant_id))
+        self.assertEqual(prices, {'Burger': None, 'Cola': 900, 'Water': None})
+
+    def test_bad_row_changes_nothing(self):
+        response = self.upload('[{"name": "Burger", "price": "9.50"}, {"name": "Soup", "price": "cheap"}]',
+                               'application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['errors'], ["row 2: 'cheap' is not a price like 2.99"])
+        self.assertEqual(MenuItem.query.filter_by(restaurant_id=self.restaurant_id).count(), 2)
+
+
+#admin bulk actions are a handful of statements however many rows are ticked, and deletes cascade
+class TestAdminBulk(unittest.TestCase):
+    BASE_URL = 'https://localhost'
+
+    def setUp(self):
+        self.app = create_app(TEST_CONFIG)
+        self.appctx = self.app.app_context()
+        self.appctx.push()
+        db.create_all()
+        dataset.generate(restaurants=20, menu_items=200, users=20, ratings=200, seed=3310)
+        admin = User(username='admin', role='admin')
+        admin.set_password('Admin123!')
+        db.session.add(admin)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/login', data={'username': 'admin', 'password': 'Admin123!'}, base_url=self.BASE_URL)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.appctx.pop()
+
+    def purge(self):
+        return purge.run_pending(dict(self.app.config, PURGE_BATCH_SIZE=7, PURGE_PAUSE_SECONDS=0))
+
+    def test_bulk_delete_restaurants_cascades(self):
+        ids = [restaurant_id for (restaurant_id,) in db.session.query(Restaurant.id).limit(10)]
+        with count_queries() as queries:
+            response = self.client.post('/admin/restaurants/bulk', base_url=self.BASE_URL,
+                                        data={'action': 'delete', 'restaurant_ids': [str(i) for i in ids]})
+        self.assertEqual(response.status_code, 302)
+        self.assertLessEqual(queries.count, 6)
+        # hidden straight away, the rows go when the purge runs
+        self.assertEqual(Restaurant.live().filter(Restaurant.id.in_(ids)).count(), 0)
+        self.assertEqual(self.client.get('/restaurant/%d/menu' % ids[0], base_url=self.BASE_URL).status_code, 404)
+        self.assertNotIn(ids[0], [r['id'] for r in self.client.get('/restaurant/JSON?limit=100', base_url=self.BASE_URL)
+                                  .get_json()['restaurants']])
+        self.assertEqual(PurgeJob.query.filter_by(kind='restaurant').count(), 10)
+        # their search rows are still there until the purge, but they don't take up any of the results
+        course = MenuItem.query.filter(MenuItem.restaurant_id == ids[0], MenuItem.course != '').first().course
+        items, restaurants = search.search(course, limit=5)
+        self.assertEqual(len(items), 5)
+        self.assertFalse(set(item['restaurant_id'] for item in items) & set(ids))
+
+        self.assertEqual(self.purge(), 10)
+        self.assertEqual(Restaurant.query.filter(Restaurant.id.in_(ids)).count(), 0)
+        self.assertEqual(MenuItem.query.filter(MenuItem.restaurant_id.in_(ids)).count(), 0)
+        self.assertEqual(Rating.query.filter(Rating.restaurant_id.in_(ids)).count(), 0)
+        for job in PurgeJob.query:
+            self.assertEqual((job.status, job.purged), ('done', job.total))
+
+    def test_bulk_delete_users(self):
+        ids = [user_id for (user_id,) in db.session.query(User.id).filter(User.username != 'admin').limit(10)]
+        with count_queries() as queries:
+            self.client.post('/admin/users/bulk', base_url=self.BASE_URL,
+                             data={'action': 'delete', 'user_ids': [str(i) for i in ids]})
+        self.assertLessEqual(queries.count, 7)
+        self.assertEqual(User.live().filter(User.id.in_(ids)).count(), 0)
+        self.assertEqual(Restaurant.query.filter(Restaurant.ownerid.in_(ids)).count(), 0)
+
+        self.assertEqual(self.purge(), 10)
+        self.assertEqual(User.query.filter(User.id.in_(ids)).count(), 0)
+        self.assertEqual(Rating.query.filter(Rating.user_id.in_(ids)).count(), 0)
+        # the summaries were recalculated without the deleted users' ratings
+        for summary in RatingSummary.query:
+            self.assertEqual(summary.count, Rating.query.filter_by(restaurant_id=summary.restaurant_id).count())
+
+
+#audit log queries read the byte ranges the index points at
+class TestAuditIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='restaurant-audit-')
+        self.path = os.path.join(self.directory, 'log_file.txt')
+        with open(self.path, 'w') as f:
+            for hour in (9, 10, 11):
+                f.write(json.dumps({'ts': '2023-06-04T%02d:30:00Z' % hour, 'action': 'login', 'user_id': hour}) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_offset_bounds(self):
+        self.assertEqual(parse_ts('2023-06-04T20:00+10:00'), parse_ts('2023-06-04T10:00'))
+        entries = AuditQuery(self.path).search(start=parse_ts('2023-06-04T20:00+10:00'))
+        self.assertEqual(sorted(entry['user_id'] for entry in entries), [10, 11])
+
+    def test_rotated_after_refresh(self):
+        query = AuditQuery(self.path)
+        indexes = query.refresh()
+        # the writer rotates between the refresh and the read, leaving an empty active file
+        os.rename(self.path, self.path + '.20230604-120000-000000')
+        open(self.path, 'w').close()
+        query.refresh = lambda: indexes
+        self.assertEqual(query.search(), [])
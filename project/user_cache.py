@@ -0,0 +1,37 @@
+from sqlalchemy.orm import make_transient_to_detached
+from . import db
+from .cache import LRUCache
+from .models import User
+
+# Column values of recently loaded users for the Flask-Login user loader, keyed by user id.
+# Anything that changes a user calls invalidate_user(). The cache is per process, so the ttl
+# bounds how long another worker can keep serving an old role.
+user_cache = LRUCache(maxsize=10000, ttl=60)
+
+USER_COLUMNS = [column.key for column in User.__table__.columns]
+
+
+def init_app(app):
+    user_cache.maxsize = app.config.setdefault('USER_CACHE_SIZE', 10000)
+    user_cache.ttl = app.config.setdefault('USER_CACHE_TTL', 60)
+
+
+def load_user(user_id):
+    """Return the user for a session, only querying the database on a cache miss"""
+    data = user_cache.get(user_id)
+    if data is None:
+        # a deleted user's sessions stop working straight away
+        user = User.live().filter(User.id == user_id).first()
+        if user is not None:
+            user_cache.set(user_id, dict((column, getattr(user, column)) for column in USER_COLUMNS))
+        return user
+
+    # rebuild the row without a query and attach it to this request's session,
+    # so changes to current_user are still saved on commit
+    user = User(**data)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def invalidate_user(user_id):
+    user_cache.pop(int(user_id))
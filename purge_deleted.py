@@ -0,0 +1,27 @@
+import argparse
+import time
+from project import create_app
+from project.models import PurgeJob
+from project import purge
+
+# Runs the queued purges of deleted restaurants and users in the foreground. The web processes do this
+# in the background already, this is for when PURGE_ENABLED is off or to finish a backlog by hand.
+def parse_args():
+    parser = argparse.ArgumentParser(description='Purge deleted restaurants and users')
+    parser.add_argument('--batch-size', type=int, help='rows deleted per transaction')
+    parser.add_argument('--pause', type=float, help='seconds to wait between batches')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+  args = parse_args()
+  app = create_app({'PURGE_ENABLED': False})
+  with app.app_context():
+    config = dict(app.config)
+    for key, value in (('PURGE_BATCH_SIZE', args.batch_size), ('PURGE_PAUSE_SECONDS', args.pause)):
+        if value is not None:
+            config[key] = value
+    started = time.time()
+    done = purge.run_pending(config)
+    print("purged %d deleted restaurants/users in %.1fs, %d still queued!"
+          % (done, time.time() - started, PurgeJob.query.filter(PurgeJob.finished_at.is_(None)).count()))
@@ -0,0 +1,15 @@
+from project import db, create_app
+from project.models import RatingSummary
+
+# Rebuilds the per restaurant rating summaries from the rating table.
+# Run this after importing ratings directly into the database or if the summaries drift.
+def rebuild_ratings():
+    RatingSummary.rebuild()
+    print("rebuilt %d rating summaries!" % RatingSummary.query.count())
+
+
+if __name__ == '__main__':
+  app = create_app()
+  with app.app_context():
+    db.create_all()
+    rebuild_ratings()
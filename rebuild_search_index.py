@@ -0,0 +1,18 @@
+from project import db, create_app
+from project import search
+
+# Rebuilds the full text search index over restaurant names and menu item names, descriptions and courses.
+# Run this after loading data directly into the database.
+def rebuild_search_index():
+    if not search.fts_available():
+        print("FTS5 is not available for this database, searches will use LIKE matching")
+        return
+    search.rebuild_index()
+    print("rebuilt search index!")
+
+
+if __name__ == '__main__':
+  app = create_app()
+  with app.app_context():
+    db.create_all()
+    rebuild_search_index()
@@ -1,6 +1,98 @@
-from project import create_app
+import argparse
+import multiprocessing
+from project import create_app, db
+from project.audit import audit
+from project.metrics import metrics
+
+# python run.py                 - werkzeug development server on https://0.0.0.0:8000
+# python run.py serve ...       - pre-fork production server (needs: pip install gunicorn)
+#
+# In serve mode the app is created once in the master before forking so the workers share its memory
+# copy-on-write. Send the master SIGHUP for a graceful reload (new workers start, old ones finish their
+# requests within --graceful-timeout) and SIGTERM to shut down. The audit log is written by a single
+# process started here, see project/audit.py.
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the restaurant website')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--certfile', help='TLS certificate file (defaults to a throwaway adhoc certificate in dev mode)')
+    parser.add_argument('--keyfile', help='TLS private key file')
+    commands = parser.add_subparsers(dest='command')
+
+    serve = commands.add_parser('serve', help='pre-fork multi-process server for production')
+    serve.add_argument('--workers', type=int, default=multiprocessing.cpu_count() * 2 + 1, help='worker processes')
+    serve.add_argument('--threads', type=int, default=4, help='request threads per worker')
+    serve.add_argument('--keepalive', type=int, default=5, help='seconds to hold an idle keep-alive connection open')
+    serve.add_argument('--timeout', type=int, default=30, help='seconds before a silent worker is killed and restarted')
+    serve.add_argument('--graceful-timeout', dest='graceful_timeout', type=int, default=30,
+                       help='seconds workers get to finish in-flight requests on reload or shutdown')
+    serve.add_argument('--max-requests', dest='max_requests', type=int, default=0,
+                       help='recycle a worker after this many requests (0 = never)')
+    serve.add_argument('--backlog', type=int, default=2048, help='pending connections the listen socket holds')
+    serve.add_argument('--access-log', dest='access_log', default='-', help="access log file ('-' for stdout)")
+    return parser.parse_args()
+
+
+def dev(args):
+    app = create_app()
+    metrics.clear() # a new server counts from zero
+    ssl_context = (args.certfile, args.keyfile) if args.certfile else 'adhoc'
+    app.run(host=args.host, port=args.port, debug=False, ssl_context=ssl_context) # turned off debugger to remove rce exploit with werkzeug debugger
+    # added ssl context adhoc so application can be run over https
+
+
+def serve(args):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("run.py serve needs gunicorn, install it with: pip install gunicorn")
+
+    if bool(args.certfile) != bool(args.keyfile):
+        raise SystemExit("--certfile and --keyfile have to be given together")
+
+    app = create_app()
+    metrics.clear() # a new server counts from zero, before any worker writes its file
+    # one process owns log_file.txt, the workers send it their audit lines
+    audit.start_writer()
+
+    def post_fork(server, worker):
+        # connections opened in the master while preloading must not be shared with the workers
+        with app.app_context():
+            db.engine.dispose()
+
+    options = {
+        'bind': '%s:%d' % (args.host, args.port),
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'keepalive': args.keepalive,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests // 10,
+        'backlog': args.backlog,
+        'accesslog': args.access_log,
+        'preload_app': True,
+        'post_fork': post_fork,
+        'certfile': args.certfile,
+        'keyfile': args.keyfile,
+    }
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                if value is not None:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
 
 if __name__ == '__main__':
-  app = create_app()
-  app.run(host='0.0.0.0', port=8000, debug=False, ssl_context='adhoc') # turned off debugger to remove rce exploit with werkzeug debugger
-  # added ssl context adhoc so application can be run over https
+  args = parse_args()
+  if args.command == 'serve':
+    serve(args)
+  else:
+    dev(args)